@@ -1,30 +1,52 @@
-from decouple import config
 from fastapi import APIRouter
 import fastapi as _fastapi
 from fastapi.param_functions import Depends
+import asyncio
 from bigfastapi.db.database import get_db
-from bigfastapi.models import user_models as userModel
+from bigfastapi.db.bulk import soft_delete
 import fastapi as _fastapi
 from uuid import uuid4
 from bigfastapi.utils import settings as settings
 from bigfastapi.schemas.activity_log_schemas import ActivitiesLogBase
 from bigfastapi.schemas.activity_log_schemas import ActivitiesLogOutput as ActivitiesSchema
 from bigfastapi.schemas.activity_log_schemas import DeleteActivitiesLogBase
+from bigfastapi.schemas.activity_log_schemas import ActivitiesLogPage
 # from .auth_api import *
 from bigfastapi.services.auth_service import is_authenticated
 from bigfastapi.models.activity_log_models import Activitylog as ActivitiesModel
 from fastapi import APIRouter, Depends, status, HTTPException
 from bigfastapi.models.organization_models import Organization
 from fastapi.responses import JSONResponse
+from sqlalchemy import and_, or_
 from sqlalchemy.orm import Session
 from .core.helpers import Helpers
-import requests
-from starlette.background import BackgroundTask
+from bigfastapi.services import activity_log_services
 from datetime import datetime
 
 
 app = APIRouter(tags=["Activitieslog"])
 
+
+maintenance_scheduler = None
+
+
+@app.on_event("startup")
+async def start_activity_log_maintenance():
+    global maintenance_scheduler
+    maintenance_scheduler = asyncio.create_task(activity_log_services.activity_log_maintenance_scheduler())
+
+
+@app.on_event("shutdown")
+async def stop_activity_log_maintenance():
+    if maintenance_scheduler is not None:
+        maintenance_scheduler.cancel()
+
+
+@app.on_event("shutdown")
+def flush_activity_logs():
+    activity_log_services.buffer.close()
+
+
 @app.post("/logs/{model_name}/{object_id}")
 def addActivitiesLog(
     model_name: str,
@@ -56,27 +78,30 @@ def addActivitiesLog(
         return JSONResponse({"message": "Organization does not exist"},
             status_code=status.HTTP_400_BAD_REQUEST)
     
-    #send log to background task
-    BackgroundTask(createActivityLog, model_name, object_id, user, log,  db)
+    createActivityLog(model_name, object_id, user, log, db)
 
     return JSONResponse({"message": "log successfully recorded"},
             status_code=status.HTTP_200_OK)
 
 
-@app.get("/logs/details")
+@app.get("/logs/details", response_model=ActivitiesLogPage)
 def getActivitiesLog(
     organization_id: str,    
+    cursor: str = None,
+    size: int = 50,
     db: Session = Depends(get_db),
     user: str = _fastapi.Depends(is_authenticated),
 
 ):
-    """intro-->This endpoint allows you retrieve details of all logs. To use this endpoint you need to make a get request to the /logs/details endpoint
+    """intro-->This endpoint allows you retrieve details of the logs of an organization, newest first. To use this endpoint you need to make a get request to the /logs/details endpoint
 
         paramDesc-->On get request, the url takes the parameter, organization_id
             param-->organization_id: This is the user's current organization
+            param-->cursor: Optional, the next_cursor of a previous response, older logs are returned
+            param-->size: The number of logs to return, this is 50 by default
         
     returnDesc--> On sucessful request, it returns 
-        returnBody--> details of the organization's activity logs
+        returnBody--> a page of the organization's activity logs and the cursor of the next page, if any
     """
     organization = db.query(Organization).filter(
         Organization.id == organization_id).first()
@@ -84,9 +109,10 @@ def getActivitiesLog(
         return JSONResponse({"message": "Organization does not exist"},
                             status_code=status.HTTP_400_BAD_REQUEST)
 
-    logs = getOrganizationActivitiesLog(organization_id, db)
+    page_size = 50 if size < 1 or size > 200 else size
+    logs, next_cursor = getOrganizationActivitiesLog(organization_id, db, cursor=cursor, size=page_size)
 
-    return logs
+    return {"items": logs, "next_cursor": next_cursor}
 
 
 
@@ -118,29 +144,23 @@ def deleteAllActivitiesLog(body: DeleteActivitiesLogBase, db: Session = Depends(
             reqBody-->organization_id: This is the user's current organization
         
     returnDesc--> On sucessful request, it returns message,
-        returnBody--> "deleted successfully"
+        returnBody--> "deleted successfully" and the number of deleted logs
     """
-    logs = (db.query(ActivitiesModel)
-            .filter(ActivitiesModel.is_deleted == False)
-            .filter(ActivitiesModel.organization_id == body.organization_id))
-    
-    
-    
-    for log in logs:
-        #log = db.query(ActivitiesModel).filter(ActivitiesModel.id == logger.id).first()
-        log.is_deleted = True
-        db.commit()
-        db.refresh(log)
+    # logs still waiting in the write-behind buffer belong to the organization too
+    activity_log_services.buffer.flush()
+    deleted = soft_delete(ActivitiesModel, organization_id=body.organization_id, db=db)
 
-    return JSONResponse({"message": "deleted successfully"},
+    return JSONResponse({"message": "deleted successfully", "deleted": deleted},
             status_code=status.HTTP_200_OK)
 
 #======================= LOG SERVICES ===============================
 
-def createActivityLog(model_name, model_id, user, log, db, created_for_id: str=None, created_for_model: str=None):
-    
+def createActivityLog(model_name, model_id, user, log, db=None, created_for_id: str=None, created_for_model: str=None):
+    """Queue an activity log, it is written in a batch shortly after and announced on Slack"""
+    if not isinstance(log, dict):
+        log = log.dict()
 
-    activityLog = ActivitiesModel(
+    entry = dict(
         id= uuid4().hex, 
         organization_id = log["organization_id"], 
         user_id= user.id, 
@@ -149,44 +169,37 @@ def createActivityLog(model_name, model_id, user, log, db, created_for_id: str=N
         created_for_id=None if not created_for_id else created_for_id,
         created_for_model=None if not created_for_model else created_for_model,
         object_url=log["object_url"],
-        model_name=model_name, action=log["action"], created_at=datetime.now()
-    )
-
-    db.add(activityLog)
-    db.commit()
-    db.refresh(activityLog)
-
-    organization = db.query(Organization).filter(
-        Organization.id == activityLog.organization_id).first()
-
-    userInfo = db.query(userModel.User).filter(
-        userModel.User.id == user.id).first()
-
-    setattr(activityLog, 'user', userInfo)
-    setattr(activityLog, 'organization', organization)
-
-    # send request to slack
-    requests.post(url=config('LOG_WEBHOOK_URL'), 
-        json={"text" : str(" " if user.first_name is None else user.first_name) +' '+ str(" " if user.last_name is None else user.last_name) +' '+ log["action"]},headers={"Content-Type": "application/json"}, verify=True
+        model_name=model_name, action=log["action"], created_at=datetime.now(),
+        is_deleted=False
     )
+    announcement = str(" " if user.first_name is None else user.first_name) +' '+ str(" " if user.last_name is None else user.last_name) +' '+ log["action"]
 
+    activity_log_services.buffer.add(entry, announcement=announcement)
 
-    return activityLog
+    return ActivitiesModel(**entry)
 
 
-def getOrganizationActivitiesLog(organization_id, db):
-    
+def getOrganizationActivitiesLog(organization_id, db, cursor: str = None, size: int = 50):
+    """Retrieve a page of an organization's logs newest first, older than the log `cursor`
+    points at. Returns the logs and the cursor of the next page, None on the last page"""
     logs = (db.query(ActivitiesModel)
         .filter(ActivitiesModel.organization_id == organization_id)
         .filter(ActivitiesModel.is_deleted == False)
     )
-    # organization = db.query(Organization).filter(Organization.id == organization_id).first()
-
-    logCollection = list(map(ActivitiesSchema.from_orm, logs))
 
-    # for log in logCollection:
-    #     userInfo = (db.query(userModel.User).filter(userModel.User.id == log.user_id).first())
-    #     setattr(log, 'user', userInfo)
-    #     setattr(log, 'organization', organization)
-    
-    return logCollection
+    if cursor:
+        last_seen = (db.query(ActivitiesModel.created_at, ActivitiesModel.id)
+            .filter(ActivitiesModel.id == cursor)
+            .filter(ActivitiesModel.organization_id == organization_id)
+            .first())
+        if last_seen is None:
+            raise HTTPException(status_code=400, detail="Invalid logs cursor")
+        logs = logs.filter(or_(
+            ActivitiesModel.created_at < last_seen.created_at,
+            and_(ActivitiesModel.created_at == last_seen.created_at, ActivitiesModel.id < last_seen.id)
+        ))
+
+    logs = logs.order_by(ActivitiesModel.created_at.desc(), ActivitiesModel.id.desc()).limit(size + 1).all()
+    next_cursor = logs[size - 1].id if len(logs) > size else None
+
+    return list(map(ActivitiesSchema.from_orm, logs[:size])), next_cursor
@@ -27,6 +27,8 @@ from .services.auth_service import *
 from bigfastapi.schemas import users_schemas
 from bigfastapi.services.auth_service import is_authenticated
 from bigfastapi.utils import paginator
+from sqlalchemy import and_, case, func, insert, literal, or_, select, tuple_
+from sqlalchemy.exc import IntegrityError
 
 from bigfastapi.services.notification_services import (
     get_mentions,
@@ -63,18 +65,23 @@ def get_all_comments_related_to_model(
     return {"status": True, "data": qs}
 
 
-@app.get("/comments/{model_type}/{object_id}")
+@app.get("/comments/{model_type}/{object_id}", response_model=comments_schemas.CommentThreadPage)
 async def get_all_comments_for_object(
     model_type: str, 
     object_id: str, 
     page: int = 1,
     size: int = 10,
+    depth: int = None,
+    replies: int = None,
     db_Session=Depends(get_db)
 ):
     """intro-->This endpoint allows you to retrieve all comments related to a specific object. To use this endpoint you need to make a get request to the /comments/{model_type}/{object_id} endpoint 
             paramDesc-->On get request the url takes two parameters, model_type & object_id
                 param-->model_type: This is the model type of the comment
                 param-->object_id: This is the id of the object that contains the comment
+                param-->depth: Optional, the deepest level of replies to include, 1 only includes direct replies
+                param-->replies: Optional, the most replies to include per comment. When a comment has more, 
+                    its replies_cursor can be passed to /comments/{model_type}/comment/{comment_id}/replies to load them
 
     returnDesc--> On sucessful request, it returns 
         returnBody--> an array of comments and their threads for a specified object
@@ -90,8 +97,10 @@ async def get_all_comments_for_object(
     )
     
     comments = qs.offset(offset=offset).limit(limit=page_size).all()
+    threads = db_load_comment_threads(comments, db=db_Session, max_depth=depth, replies_limit=replies)
     
-    total_items = qs.count()
+    summary = db_Session.get(comments_models.CommentSummary, (model_type, object_id))
+    total_items = summary.threads if summary else qs.count()
 
     pointers = await paginator.page_urls(
             page=page_number, size=page_size, count=total_items, endpoint=f"/comments/{model_type}/{object_id}"
@@ -103,12 +112,64 @@ async def get_all_comments_for_object(
             "total": total_items,
             "previous_page": pointers["previous"],
             "next_page": pointers["next"],
-            "items": comments,
+            "items": threads,
     }    
     # return {"status": True, "data": qs}
     return response
 
 
+@app.post("/comments/summaries", response_model=List[comments_schemas.CommentSummary])
+def get_comment_summaries(
+    objects: List[comments_schemas.CommentedObject],
+    db_Session=Depends(get_db)
+):
+    """intro-->This endpoint returns the number of comments and the latest comment of many objects at once, e.g. for a feed showing "N comments". 
+            To use this endpoint you need to make a post request to the /comments/summaries endpoint 
+            paramDesc-->On post request the body is a list of objects, at most 100
+                reqBody-->model_type: This is the model type of the object
+                reqBody-->rel_id: This is the id of the object
+
+    returnDesc--> On sucessful request, it returns 
+        returnBody--> for every requested object, in the same order, its comments count, its top-level comments count and its latest comment
+    """
+    if len(objects) > MAX_SUMMARIES:
+        raise _fastapi.HTTPException(status_code=400, detail=f"At most {MAX_SUMMARIES} objects can be summarised at once")
+
+    return db_retrieve_comment_summaries(objects, db=db_Session)
+
+
+@app.get("/comments/{model_type}/comment/{comment_id}/replies", response_model=comments_schemas.CommentReplies)
+def get_comment_replies(
+    model_type: str,
+    comment_id: str,
+    cursor: str = None,
+    size: int = 10,
+    depth: int = None,
+    replies: int = None,
+    db_Session=Depends(get_db)
+):
+    """intro-->This endpoint loads more replies of a comment, with their own replies. To use this endpoint you need to make a get request to the /comments/{model_type}/comment/{comment_id}/replies endpoint 
+            paramDesc-->On get request the url takes two parameters, model_type & comment_id
+                param-->model_type: This is the model type of the comment
+                param-->comment_id: This is the id of the comment whose replies are loaded
+                param-->cursor: Optional, the replies_cursor or next_cursor of a previous response, replies after it are returned
+                param-->size: The number of replies to return, this is 10 by default
+                param-->depth: Optional, the deepest level of nested replies to include, relative to the comment
+                param-->replies: Optional, the most nested replies to include per reply
+
+    returnDesc--> On sucessful request, it returns 
+        returnBody--> the replies with their threads and the cursor of the next page of replies, if any
+    """
+    page_size = 10 if size < 1 or size > 50 else size
+    parent = db_retrieve_specific_comment_based_on_model_type(comment_id, model_type, db=db_Session)
+
+    children, next_cursor = db_retrieve_replies_page(parent, cursor=cursor, size=page_size, db=db_Session)
+    nested_depth = depth - 1 if depth is not None else None
+    threads = db_load_comment_threads(children, db=db_Session, max_depth=nested_depth, replies_limit=replies)
+
+    return {"items": threads, "next_cursor": next_cursor}
+
+
 @app.get("/comments/{model_type}/comment/{comment_id}")
 def get_specific_comment(
     model_type: str, comment_id: str, db_Session=Depends(get_db)):    
@@ -129,7 +190,7 @@ def get_specific_comment(
 @app.post("/comments/{model_type}/{comment_id}/reply")
 def reply_to_comment(
     model_type: str,
-    comment_id: int,
+    comment_id: str,
     comment: comments_schemas.CommentCreate,
     db_Session=Depends(get_db),
 ):
@@ -188,6 +249,7 @@ async def create_new_comment_for_object(
         organization_id=comment.org_id, 
         module="comments", 
         mentions=mentions,
+        target=object_id,
         db=db_Session,
         user=user
     )    
@@ -199,8 +261,7 @@ async def create_new_comment_for_object(
         db=db_Session
     )
 
-    background_tasks.add_task(
-        createActivityLog, 
+    createActivityLog(
         model_name="Comment", model_id=obj.id, user=user, 
         log=log, db=db_Session, created_for_id=object_id, 
         created_for_model="biz_partner"
@@ -233,7 +294,7 @@ def update_comment_by_id(
 
 @app.delete("/comments/{model_type}/{comment_id}/delete")
 def delete_comment_by_id(
-    model_type: str, comment_id:int, db_Session=Depends(get_db)
+    model_type: str, comment_id: str, db_Session=Depends(get_db)
 ):
     """intro-->This endpoint is used to delete a comment. To use this endpoint you need to make a delete request to the /comments/{model_type}/{comment_id}/delete endpoint 
             paramDesc-->On delete request the url takes two parameters, model_type & comment_id
@@ -251,9 +312,11 @@ def delete_comment_by_id(
 
 @app.post("/comments/{model_type}/{comment_id}/vote")
 def vote_on_comment(
-    model_type: str, comment_id:int, action: str, db_Session=Depends(get_db)
+    model_type: str, comment_id: str, action: str, db_Session=Depends(get_db),
+    user: users_schemas.User = Depends(is_authenticated)
 ):  
     """intro-->This endpoint allows you to downvote or upvote a comment. To use this endpoint you need to make a post request to the /comments/{model_type}/{comment_id}/vote endpoint 
+            A user has a single vote per comment, voting again with the same action changes nothing and voting with the other action switches the vote.
             paramDesc-->On post request the url takes in three parameters 
                 param-->model_type: This is the model type of the comment
                 param-->comment_id: This is the comment id of the comment to vote for
@@ -265,7 +328,7 @@ def vote_on_comment(
         returnBody--> a refreshed Comment object reflecting the changed votes
     """
    
-    if action not in ["upvote", "downvote"]:
+    if action not in VOTE_COLUMNS:
         return {
             "status": False,
             "message": {
@@ -273,7 +336,7 @@ def vote_on_comment(
             },
         }
     response = db_vote_for_comments(
-        comment_id=comment_id, model_type=model_type, action=action, db=db_Session
+        comment_id=comment_id, model_type=model_type, action=action, user_id=user.id, db=db_Session
     )
     error_message = "Vote Failed"
     if response:
@@ -305,14 +368,76 @@ def create_log_comment(
     return log
 
 
-def db_vote_for_comments(comment_id: int, model_type:str, action: str, db: _orm.Session):
-    
-    comment_obj = db_retrieve_comment_by_id(comment_id, model_type, db=db)
-    if action == "upvote": comment_obj.upvote(),
-    elif action == "downvote": comment_obj.downvote()
+VOTE_COLUMNS = {"upvote": "upvotes", "downvote": "downvotes"}
+
+
+def db_vote_for_comments(comment_id: str, model_type: str, action: str, user_id: str, db: _orm.Session):
+    """Record a user's vote and apply it to the comment's counters atomically
+
+    The counters are changed with `UPDATE comment SET upvotes = upvotes + 1`, so concurrent
+    votes never overwrite each other, and the unique (comment_id, user_id) vote record
+    keeps a user from voting twice.
+
+    Args:
+        comment_id (str): ID of the Comment to vote for
+        model_type (str): model type of comment
+        action (str): "upvote" or "downvote"
+        user_id (str): ID of the voting user
+        db (_orm.Session): DB Session to commit to. Automatically determined by FastAPI
+
+    Returns:
+        Comment: The Comment with its updated votes
+    """
+    Comment = comments_models.Comment
+    Vote = comments_models.CommentVote
+    column = VOTE_COLUMNS[action]
+
+    updated = db.query(Comment).filter(Comment.id == comment_id, Comment.model_type == model_type).update(
+        {column: getattr(Comment, column) + 1}, synchronize_session=False)
+    if not updated:
+        db.rollback()
+        raise _fastapi.HTTPException(status_code=404, detail="Comment does not exist")
+
+    db.add(Vote(id=uuid4().hex, comment_id=comment_id, user_id=user_id, action=action))
+    try:
+        db.commit()
+    except IntegrityError:
+        # the user already voted, undo the increment and only switch sides if asked to
+        db.rollback()
+        db_switch_comment_vote(comment_id=comment_id, action=action, user_id=user_id, db=db)
+
+    return db_retrieve_specific_comment_based_on_model_type(comment_id, model_type, db=db)
+
+
+def db_switch_comment_vote(comment_id: str, action: str, user_id: str, db: _orm.Session):
+    """Turn a user's existing vote into `action`, a no-op when it already is
+
+    Args:
+        comment_id (str): ID of the voted Comment
+        action (str): "upvote" or "downvote"
+        user_id (str): ID of the voting user
+        db (_orm.Session): DB Session to commit to
+
+    Returns:
+        bool: Whether the vote was switched
+    """
+    Comment = comments_models.Comment
+    Vote = comments_models.CommentVote
+    previous = "downvote" if action == "upvote" else "upvote"
+    column, previous_column = VOTE_COLUMNS[action], VOTE_COLUMNS[previous]
+
+    switched = db.query(Vote).filter(
+        Vote.comment_id == comment_id, Vote.user_id == user_id, Vote.action == previous
+    ).update({"action": action, "last_updated": datetime.utcnow()}, synchronize_session=False)
+    if switched:
+        db.query(Comment).filter(Comment.id == comment_id).update({
+            column: getattr(Comment, column) + 1,
+            previous_column: getattr(Comment, previous_column) - 1
+        }, synchronize_session=False)
     db.commit()
-    db.refresh(comment_obj)
-    return comment_obj
+
+    return bool(switched)
+
 
 def db_retrieve_comment_by_id(object_id: str, model_type:str, db: _orm.Session):
     """Retrieves a Comment by ID
@@ -380,9 +505,18 @@ def db_reply_to_comment(model_type:str, comment_id:int, comment: comments_schema
     p_comment = db.query(comments_models.Comment).filter(comments_models.Comment.model_type == model_type, 
         comments_models.Comment.id == comment_id).first()
     if p_comment:
-        reply = comments_models.Comment(model_type=model_type, rel_id=p_comment.rel_id, email=comment.email, 
-                name=comment.name, text=comment.text, p_id=p_comment.id, commenter_id=comment.commenter_id)
+        _ensure_comment_paths([p_comment], db)
+        id = uuid4().hex
+        path = f"{p_comment.path}{id}{comments_models.PATH_SEPARATOR}"
+        if len(path) > comments_models.Comment.path.type.length:
+            raise _fastapi.HTTPException(status_code=400, detail="This thread is too deep to reply to")
+
+        reply = comments_models.Comment(id=id, model_type=model_type, rel_id=p_comment.rel_id, email=comment.email, 
+                name=comment.name, text=comment.text, p_id=p_comment.id, commenter_id=comment.commenter_id,
+                path=path, depth=p_comment.depth + 1)
         db.add(reply)
+        db.flush()
+        db_count_comment(reply, db=db)
         db.commit()
         db.refresh(reply)
         return reply
@@ -399,10 +533,18 @@ def db_delete_comment(object_id: int, model_type:str, db: _orm.Session):
     Returns:
         Comment: Deleted Comment data
     """
-    object = db_retrieve_comment_by_id(object_id=object_id, model_type=model_type, db=db)
-    db.delete(object)
+    object = db_retrieve_specific_comment_based_on_model_type(object_id=object_id, model_type=model_type, db=db)
+    deleted = db_load_comment_threads([object], db=db)[0]
+
+    # the comment and its whole subtree go in one statement
+    subtree = comments_models.Comment.path.startswith(object.path, autoescape=True)
+    db.query(comments_models.CommentVote).filter(comments_models.CommentVote.comment_id.in_(
+        select(comments_models.Comment.id).where(subtree)
+    )).delete(synchronize_session=False)
+    db.query(comments_models.Comment).filter(subtree).delete(synchronize_session=False)
+    db_rebuild_comment_summaries(db, model_type=object.model_type, rel_id=object.rel_id)
     db.commit()
-    return comments_schemas.Comment.from_orm(object)
+    return deleted
     
 def db_create_comment_for_object(object_id: str, comment: comments_schemas.CommentBase, db: _orm.Session, model_type:str):
     """Create a top-level Comment for an object
@@ -420,8 +562,11 @@ def db_create_comment_for_object(object_id: str, comment: comments_schemas.Comme
     id = comment.id if comment.id else uuid4().hex
     obj = comments_models.Comment(id=id, rel_id=object_id, model_type=model_type, text=comment.text, 
                     name=comment.name, email=comment.email, commenter_id=comment.commenter_id, 
-                    date_created=comment.date_created, last_updated=comment.last_updated)
+                    date_created=comment.date_created, last_updated=comment.last_updated,
+                    path=f"{id}{comments_models.PATH_SEPARATOR}", depth=0)
     db.add(obj)
+    db.flush()
+    db_count_comment(obj, db=db)
     db.commit()
     db.refresh(obj)
     
@@ -468,3 +613,232 @@ def db_retrieve_specific_comment_based_on_model_type(object_id:str, model_type:s
         )
 
     return comment_obj                         
+
+
+def db_load_comment_threads(comments: list, db: _orm.Session, max_depth: int = None, replies_limit: int = None):
+    """Load the replies of `comments` at every depth in one query and assemble their threads
+
+    Args:
+        comments (List[Comment]): The comments whose threads are loaded, usually a page of top-level comments
+        db (_orm.Session): DB Session to commit to. Automatically determined by FastAPI
+        max_depth (int): How many levels of replies to load below each comment, all of them when None
+        replies_limit (int): The most replies kept per comment, the others are left for the replies cursor
+
+    Returns:
+        List[comments_schemas.CommentThread]: The comments, in the same order, with their nested replies
+    """
+    if not comments:
+        return []
+
+    _ensure_comment_paths(comments, db)
+    Comment = comments_models.Comment
+
+    def in_thread(comment):
+        criteria = [Comment.path.startswith(comment.path, autoescape=True), Comment.depth > comment.depth]
+        if max_depth is not None:
+            criteria.append(Comment.depth <= comment.depth + max_depth)
+        return and_(*criteria)
+
+    descendants = (db.query(Comment).filter(or_(*[in_thread(comment) for comment in comments]))
+                   .order_by(Comment.date_created, Comment.id).all())
+
+    nodes = {comment.id: _comment_node(comment) for comment in [*comments, *descendants]}
+    for reply in descendants:
+        parent = nodes.get(reply.p_id)
+        if parent is None:
+            continue
+        if replies_limit is not None and len(parent["replies"]) >= replies_limit:
+            parent["replies_cursor"] = parent["replies"][-1]["id"] if parent["replies"] else None
+            continue
+        parent["replies"].append(nodes[reply.id])
+
+    return [comments_schemas.CommentThread.parse_obj(nodes[comment.id]) for comment in comments]
+
+
+def _comment_node(comment: comments_models.Comment):
+    node = {column.name: getattr(comment, column.name) for column in comments_models.Comment.__table__.columns}
+    node.update(replies=[], replies_cursor=None)
+    return node
+
+
+def db_retrieve_replies_page(parent: comments_models.Comment, cursor: str, size: int, db: _orm.Session):
+    """Retrieve the direct replies of a comment that come after `cursor`, oldest first
+
+    Args:
+        parent (Comment): The comment whose replies are retrieved
+        cursor (str): ID of the last reply already seen, the first page when None
+        size (int): The number of replies to return
+        db (_orm.Session): DB Session to commit to. Automatically determined by FastAPI
+
+    Returns:
+        Tuple[List[Comment], str]: The replies and the cursor of the next page, None on the last page
+    """
+    Comment = comments_models.Comment
+    replies = db.query(Comment).filter(Comment.p_id == parent.id)
+
+    if cursor:
+        last_seen = db.query(Comment.date_created, Comment.id).filter(
+            Comment.id == cursor, Comment.p_id == parent.id).first()
+        if last_seen is None:
+            raise _fastapi.HTTPException(status_code=400, detail="Invalid replies cursor")
+        replies = replies.filter(or_(
+            Comment.date_created > last_seen.date_created,
+            and_(Comment.date_created == last_seen.date_created, Comment.id > last_seen.id)
+        ))
+
+    replies = replies.order_by(Comment.date_created, Comment.id).limit(size + 1).all()
+    next_cursor = replies[size - 1].id if len(replies) > size else None
+
+    return replies[:size], next_cursor
+
+
+def db_rebuild_comment_paths(db: _orm.Session):
+    """Fill in path and depth for comments created before threads had materialized paths
+
+    Args:
+        db (_orm.Session): DB Session to commit to
+
+    Returns:
+        int: The number of comments updated
+    """
+    Comment = comments_models.Comment
+    parent = _orm.aliased(Comment)
+
+    updated = db.query(Comment).filter(Comment.p_id == None, Comment.path == None).update(
+        {"path": Comment.id + comments_models.PATH_SEPARATOR, "depth": 0}, synchronize_session=False)
+
+    # one level of the forest per round, until no reply is left without a path
+    while True:
+        level = (db.query(Comment.id, parent.path, parent.depth)
+                 .join(parent, parent.id == Comment.p_id)
+                 .filter(Comment.path == None, parent.path != None)
+                 .all())
+        if not level:
+            break
+        db.bulk_update_mappings(Comment, [
+            {"id": id, "path": f"{path}{id}{comments_models.PATH_SEPARATOR}", "depth": depth + 1}
+            for id, path, depth in level
+        ])
+        updated += len(level)
+
+    db.commit()
+    return updated
+
+
+def _ensure_comment_paths(comments: list, db: _orm.Session):
+    if any(comment.path is None for comment in comments):
+        db_rebuild_comment_paths(db)
+        for comment in comments:
+            db.refresh(comment)
+
+
+MAX_SUMMARIES = 100
+
+
+def db_count_comment(comment: comments_models.Comment, db: _orm.Session):
+    """Add a new comment to its object's counters and make it the latest comment, without committing
+
+    Args:
+        comment (Comment): The Comment just added, already flushed
+        db (_orm.Session): DB Session to commit to
+    """
+    Summary = comments_models.CommentSummary
+    updated = db.query(Summary).filter(
+        Summary.model_type == comment.model_type, Summary.rel_id == comment.rel_id
+    ).update({
+        "comments": Summary.comments + 1,
+        "threads": Summary.threads + (1 if comment.p_id is None else 0),
+        "latest_comment_id": comment.id,
+        "last_updated": datetime.utcnow()
+    }, synchronize_session=False)
+
+    if not updated:
+        # first comment since summaries exist, count the object's comments once
+        try:
+            with db.begin_nested():
+                db_rebuild_comment_summaries(db, model_type=comment.model_type, rel_id=comment.rel_id, commit=False)
+        except IntegrityError:
+            db_count_comment(comment, db=db)
+
+
+def db_rebuild_comment_summaries(db: _orm.Session, model_type: str = None, rel_id: str = None, commit: bool = False):
+    """Recompute comment summaries from the comment table, for one object or all of them
+
+    Args:
+        db (_orm.Session): DB Session to commit to
+        model_type (str): Only rebuild summaries of this model type
+        rel_id (str): Only rebuild the summary of this object
+        commit (bool): Commit once rebuilt
+
+    Returns:
+        int: The number of summaries written
+    """
+    Comment = comments_models.Comment
+    Summary = comments_models.CommentSummary
+    latest = _orm.aliased(Comment)
+
+    scope, summary_scope = [], []
+    if model_type is not None:
+        scope.append(Comment.model_type == model_type)
+        summary_scope.append(Summary.model_type == model_type)
+    if rel_id is not None:
+        scope.append(Comment.rel_id == rel_id)
+        summary_scope.append(Summary.rel_id == rel_id)
+
+    latest_comment_id = (select(latest.id)
+                         .where(latest.model_type == Comment.model_type, latest.rel_id == Comment.rel_id)
+                         .order_by(latest.date_created.desc(), latest.id.desc())
+                         .limit(1)
+                         .scalar_subquery())
+    summaries = (select(
+        Comment.model_type,
+        Comment.rel_id,
+        func.count(Comment.id),
+        func.count(case((Comment.p_id == None, 1))),
+        latest_comment_id,
+        literal(datetime.utcnow())
+    ).where(Comment.model_type != None, Comment.rel_id != None, *scope)
+     .group_by(Comment.model_type, Comment.rel_id))
+
+    db.query(Summary).filter(*summary_scope).delete(synchronize_session=False)
+    written = db.execute(insert(Summary.__table__).from_select(
+        ["model_type", "rel_id", "comments", "threads", "latest_comment_id", "last_updated"], summaries
+    )).rowcount
+
+    if commit:
+        db.commit()
+    return written
+
+
+def db_retrieve_comment_summaries(objects: List[comments_schemas.CommentedObject], db: _orm.Session):
+    """Retrieve the comment summaries of many objects in one query
+
+    Args:
+        objects (List[comments_schemas.CommentedObject]): The (model_type, rel_id) pairs to summarise
+        db (_orm.Session): DB Session to commit to. Automatically determined by FastAPI
+
+    Returns:
+        List[comments_schemas.CommentSummary]: A summary per requested object, in the same order
+    """
+    if not objects:
+        return []
+
+    Summary = comments_models.CommentSummary
+    rows = (db.query(Summary, comments_models.Comment)
+            .outerjoin(comments_models.Comment, comments_models.Comment.id == Summary.latest_comment_id)
+            .filter(tuple_(Summary.model_type, Summary.rel_id).in_(
+                [(obj.model_type, obj.rel_id) for obj in objects]))
+            .all())
+    found = {(summary.model_type, summary.rel_id): (summary, latest) for summary, latest in rows}
+
+    summaries = []
+    for obj in objects:
+        summary, latest = found.get((obj.model_type, obj.rel_id), (None, None))
+        summaries.append(comments_schemas.CommentSummary(
+            model_type=obj.model_type,
+            rel_id=obj.rel_id,
+            comments=summary.comments if summary else 0,
+            threads=summary.threads if summary else 0,
+            latest_comment=comments_schemas.LatestComment.from_orm(latest) if latest else None
+        ))
+    return summaries
@@ -1,6 +1,5 @@
 from typing import Optional, Union
 
-import requests
 import sqlalchemy.orm as orm
 from decouple import config
 from fastapi import status
@@ -10,6 +9,7 @@ from fastapi.responses import JSONResponse
 from bigfastapi.core import messages
 from bigfastapi.db.database import SessionLocal
 from bigfastapi.models.organization_models import Organization, OrganizationUser
+from bigfastapi.services import slack_services
 
 
 class Helpers:
@@ -94,12 +94,8 @@ class Helpers:
         return organization
 
     # Sends a notification to slack.
-    # NOTE: DO NOT CALL THIS METHOD IN THE SAME THREAD AS YOUR REQUEST. USE A BACKGROUND TASK
+    # Messages are queued and posted by slack_services.notifier, so this is safe to call inline.
     @staticmethod
     def slack_notification(url: str, text: str, verify: bool = True):
-        requests.post(
-            url=config(url),
-            json={"text": text},
-            headers={"Content-Type": "application/json"},
-            verify=verify,
-        )
+        """Queue a message for the webhook in the `url` env variable, it is posted in a batch shortly after"""
+        slack_services.notifier.notify(config(url, default=""), text, verify=verify)
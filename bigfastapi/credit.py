@@ -1,11 +1,10 @@
+import asyncio
 import datetime as _dt
 import time
 from uuid import uuid4
 
 import fastapi
-import requests
 import sqlalchemy.orm as _orm
-import stripe
 from decouple import config
 from fastapi import APIRouter
 from fastapi_pagination import Page, paginate, add_pagination
@@ -22,9 +21,36 @@ from bigfastapi.schemas import credit_wallet_schemas as schema, credit_wallet_co
 from bigfastapi.schemas import users_schemas
 from bigfastapi.schemas.wallet_schemas import PaymentProvider
 from bigfastapi.utils.utils import generate_payment_link
-from bigfastapi.wallet import update_wallet
+from bigfastapi.services import exchange_rate_services, payment_services, wallet_services
+from bigfastapi.utils import settings
 
 app = APIRouter(tags=["CreditWallet"], )
+payment_scheduler = None
+exchange_rate_scheduler = None
+
+
+@app.on_event("startup")
+async def start_payment_callbacks():
+    global payment_scheduler
+    payment_scheduler = asyncio.create_task(payment_services.payment_callback_scheduler())
+
+
+@app.on_event("shutdown")
+async def stop_payment_callbacks():
+    if payment_scheduler is not None:
+        payment_scheduler.cancel()
+
+
+@app.on_event("startup")
+async def start_exchange_rates():
+    global exchange_rate_scheduler
+    exchange_rate_scheduler = asyncio.create_task(exchange_rate_services.exchange_rate_scheduler())
+
+
+@app.on_event("shutdown")
+async def stop_exchange_rates():
+    if exchange_rate_scheduler is not None:
+        exchange_rate_scheduler.cancel()
 
 
 @app.post("/credits/rates", response_model=credit_wallet_conversion_schemas.CreditWalletConversion)
@@ -42,14 +68,16 @@ async def add_rate(
         returnBody--> details of the newly created credit rate
     """
     if user.is_superuser:
-        conversion = await _get_credit_wallet_conversion(currency=body.currency_code, db=db)
+        conversion = exchange_rate_services.find_conversion(body.currency_code, db)
         if conversion is not None:
             raise fastapi.HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                                         detail="Currency " + body.currency_code.upper() + " already has a conversion rate")
 
         rate = model.CreditWalletConversion(id=uuid4().hex,
                                                                       rate=body.rate,
-                                                                      currency_code=body.currency_code.upper())
+                                                                      currency_code=body.currency_code.upper(),
+                                                                      source='manual',
+                                                                      last_updated=_dt.datetime.utcnow())
 
         db.add(rate)
         db.commit()
@@ -93,15 +121,18 @@ async def get_rate(
     returnDesc--> On sucessful request, it returns
         returnBody--> the details of the queried currency
     """
-    rate = db.query(model.CreditWalletConversion).filter_by(
-        currency_code=currency).first()
+    rate = await _get_credit_wallet_conversion(currency=currency, db=db)
+    if rate is None and exchange_rate_services.exchange_rates.stale:
+        # the first request for a rate waits for the market rates, joining any refresh under way
+        try:
+            await exchange_rate_services.exchange_rates.refresh(db=db)
+        except Exception:
+            raise fastapi.HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                        detail="Could not get exchange rate. Please try again later")
+        rate = await _get_credit_wallet_conversion(currency=currency, db=db)
     if rate is None:
-        freeCurrencyApiKey = config("FREECURRENCY_API_KEY")
-        if freeCurrencyApiKey.strip() == '':
-            raise fastapi.HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                                        detail="Currency " + currency + " does not have a conversion rate")
-        else:
-            rate = await _get_market_rate(currency=currency, db=db)
+        raise fastapi.HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                    detail="Currency " + currency + " does not have a conversion rate")
 
     return rate
 
@@ -124,12 +155,14 @@ async def update_rate(
         returnBody--> the details of the updated rate
     """
     rate = db.query(model.CreditWalletConversion).filter_by(
-        currency_code=currency).first()
+        currency_code=currency.upper()).first()
     if rate is None:
         raise fastapi.HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                                     detail="Currency " + currency + " does not have a conversion rate")
     else:
         rate.rate = body.rate
+        rate.source = 'manual'
+        rate.last_updated = _dt.datetime.utcnow()
         db.commit()
         db.refresh(rate)
 
@@ -138,6 +171,7 @@ async def update_rate(
 
 @app.get("/credits/callback/stripe")
 async def verify_stripe_payment(status: str, tx_ref: str, transaction_id: str,
+                                background_tasks: fastapi.BackgroundTasks,
                                 db: _orm.Session = fastapi.Depends(get_db)):
     """intro-->This endpoint allows you to verify a stripe payment. To use this endpoint you need to make a get request to the /credits/callback/stripe endpoint
 
@@ -146,74 +180,18 @@ async def verify_stripe_payment(status: str, tx_ref: str, transaction_id: str,
             param-->tx_ref: This is the transaction reference 
             param-->transaction_id: This is the unique id of the transaction
 
-    returnDesc--> On sucessful request, it returns the
-        returnBody--> details of the transacation
+    returnDesc--> On sucessful request, it redirects to the frontend with
+        returnBody--> the status of the payment and its tx_ref, the payment is verified in the background and its status can be polled at /credits/payments/{tx_ref}
     """
-    stripe.api_key = config('STRIPE_SEC_KEY')
-    session = stripe.checkout.Session.retrieve(transaction_id)
-    frontendUrl = session.metadata.redirect_url
-    if status == 'successful' and session.url is None:
-        rootUrl = config('API_URL')
-        retryLink = rootUrl + '/credits/callback&tx_ref=' + tx_ref + '&transaction_id=' + transaction_id
-        ref = session.client_reference_id
-        wallet_transaction = db.query(wallet_models.WalletTransaction).filter_by(id=ref).first()
-        if wallet_transaction is not None:
-            ref = wallet_transaction.transaction_ref
-
-            if wallet_transaction.status:
-                response = RedirectResponse(
-                    url=frontendUrl + '?status=error&message=Transaction already processed')
-                return response
-
-            user_id, organization_id, _ = ref.split('-')
-            amount = session.amount_total
-            currency = session.currency.upper()
-            wallet = await _get_wallet(organization_id=organization_id, currency=currency, db=db)
-            if currency == "NGN":
-                amount /= 100
-
-            try:
-                # add money to wallet
-                await update_wallet(wallet=wallet, amount=amount, db=db, currency=currency,
-                                    wallet_transaction_id=wallet_transaction.id,
-                                    reason="Stripe: " + currency + " " + str(amount) + " Top Up")
-
-                conversion = await _get_credit_wallet_conversion(currency=currency, db=db)
-                credits_to_add = round(amount / conversion.rate)
-
-                # debit money from wallet to buy credits
-                reference = str(credits_to_add) + ' credits Top Up'
-                await update_wallet(wallet=wallet, amount=-amount, db=db, currency=currency,
-                                    reason=organization_id + ": " + reference)
-
-                # update credit here
-                await _update_credit_wallet(organization_id=organization_id, reference=reference,
-                                            credits_to_add=credits_to_add,
-                                            db=db)
-
-                response = RedirectResponse(url=frontendUrl + '?status=success&message=Credit refilled')
-                return response
-            except fastapi.HTTPException:
-                response = RedirectResponse(
-                    url=frontendUrl + '?status=error&message=An error occurred while refilling your credit. '
-                                      'Please try again&link=' + retryLink)
-                return response
-
-
-        else:
-            response = RedirectResponse(
-                url=frontendUrl + '?status=error&message=Transaction not found Please try again&link=' + retryLink)
-            return response
-
-    else:
-        response = RedirectResponse(url=frontendUrl + '?status=error&message=Payment was not successful')
-        return response
+    return _record_payment_callback(provider=PaymentProvider.STRIPE.value, status=status, tx_ref=tx_ref,
+                                    transaction_id=transaction_id, background_tasks=background_tasks, db=db)
 
 
 @app.get("/credits/callback/flutterwave")
 async def verify_flutterwave_payment(
         status: str,
         tx_ref: str,
+        background_tasks: fastapi.BackgroundTasks,
         transaction_id='',
         db: _orm.Session = fastapi.Depends(get_db),
 ):
@@ -224,78 +202,32 @@ async def verify_flutterwave_payment(
             param-->tx_ref: This is the transaction reference 
             param-->transaction_id: This is the unique id of the transaction
 
-    returnDesc--> On sucessful request, it returns the
-        returnBody--> details of the transacation
+    returnDesc--> On sucessful request, it redirects to the frontend with
+        returnBody--> the status of the payment and its tx_ref, the payment is verified in the background and its status can be polled at /credits/payments/{tx_ref}
     """
-    frontendUrl = config("FRONTEND_URL")
-    if status == 'successful':
-        flutterwaveKey = config('FLUTTERWAVE_SEC_KEY')
-        headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer ' + flutterwaveKey}
-        url = 'https://api.flutterwave.com/v3/transactions/' + transaction_id + '/verify'
-        verificationRequest = requests.get(url, headers=headers)
-        rootUrl = config('API_URL')
-        retryLink = rootUrl + '/credits/callback&tx_ref=' + tx_ref
-        retryLink += '' if transaction_id == '' else ('&transaction_id=' + transaction_id)
-        if verificationRequest.status_code == 200:
-            jsonResponse = verificationRequest.json()
-            ref = jsonResponse['data']['tx_ref']
-            frontendUrl = jsonResponse['data']['meta']['redirect_url']
-            wallet_transaction = db.query(wallet_models.WalletTransaction).filter_by(id=ref).first()
-            if wallet_transaction is not None:
-                ref = wallet_transaction.transaction_ref
-
-                if wallet_transaction.status:
-                    response = RedirectResponse(
-                        url=frontendUrl + '?status=error&message=Transaction already processed')
-                    return response
-
-                if jsonResponse['status'] == 'success' and jsonResponse['data']['status'] == 'successful':
-                    user_id, organization_id, _ = ref.split('-')
-                    amount = jsonResponse['data']['amount']
-                    currency = jsonResponse['data']['currency']
-                    wallet = await _get_wallet(organization_id=organization_id, currency=currency, db=db)
-
-                    try:
-                        # add money to wallet
-                        await update_wallet(wallet=wallet, amount=amount, db=db, currency=currency,
-                                            wallet_transaction_id=wallet_transaction.id,
-                                            reason="Flutterwave: " + currency + " " + str(amount) + " Top Up")
-
-                        conversion = await _get_credit_wallet_conversion(currency=currency, db=db)
-                        credits_to_add = round(amount / conversion.rate)
-
-                        # debit money from wallet to buy credits
-                        reference = str(credits_to_add) + ' credits Top Up'
-                        await update_wallet(wallet=wallet, amount=-amount, db=db, currency=currency,
-                                            reason=organization_id + ": " + reference)
-
-                        # update credit here
-                        await _update_credit_wallet(organization_id=organization_id, reference=reference,
-                                                    credits_to_add=credits_to_add,
-                                                    db=db)
-
-                        response = RedirectResponse(url=frontendUrl + '?status=success&message=Credit refilled')
-                        return response
-                    except fastapi.HTTPException:
-                        response = RedirectResponse(
-                            url=frontendUrl + '?status=error&message=An error occurred while refilling your credit. '
-                                              'Please try again&link=' + retryLink)
-                        return response
-
-                else:
-                    response = RedirectResponse(url=frontendUrl + '?status=error&message=Transaction not found')
-                    return response
-            else:
-                response = RedirectResponse(url=frontendUrl + '?status=error&message=Transaction not found')
-                return response
-
-        response = RedirectResponse(
-            url=frontendUrl + '?status=error&message=An error occurred. Please try again&link=' + retryLink)
-        return response
+    return _record_payment_callback(provider=PaymentProvider.FLUTTERWAVE.value, status=status, tx_ref=tx_ref,
+                                    transaction_id=transaction_id, background_tasks=background_tasks, db=db)
 
-    else:
-        response = RedirectResponse(url=frontendUrl + '?status=error&message=Payment was not successful')
-        return response
+
+@app.get("/credits/payments/{tx_ref}", response_model=schema.CreditPaymentStatus)
+async def get_payment_status(
+        tx_ref: str,
+        user: users_schemas.User = fastapi.Depends(is_authenticated),
+        db: _orm.Session = fastapi.Depends(get_db),
+):
+    """intro-->This endpoint allows you to retrieve the status of a credit top up, e.g to poll it after the payment provider redirects back. To use this endpoint you need to make a get request to the /credits/payments/{tx_ref} endpoint
+
+        ParamDesc-->On get request, the request url takes the parameter, tx_ref
+            param-->tx_ref: This is the transaction reference of the payment
+
+    returnDesc--> On sucessful request, it returns
+        returnBody--> the status of the payment, created, queued, processing, succeeded, failed or cancelled, and the credits it bought once it succeeded
+    """
+    payment = payment_services.get_payment(tx_ref, db)
+    if payment is None:
+        raise fastapi.HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Payment does not exist")
+    await _get_organization(organization_id=payment.organization_id, db=db, user=user)
+    return payment
 
 
 @app.get("/credits/{organization_id}", response_model=schema.CreditWalletResponse)
@@ -360,6 +292,9 @@ async def add_credit(body: schema.CreditWalletFund,
                                                              transaction_date=_dt.datetime.utcnow(),
                                                              transaction_ref=txRef)
         db.add(wallet_transaction)
+        # the callback of the provider is processed against this record
+        payment_services.create_payment(tx_ref=transaction_id, provider=body.provider.value,
+                                        organization_id=organization_id, redirect_url=body.redirect_url, db=db)
         db.commit()
         db.refresh(wallet_transaction)
 
@@ -403,53 +338,25 @@ async def get_credit_history(
 # Services #
 ############
 
-async def _update_credit_wallet(organization_id: str, credits_to_add: int, reference: str, db: _orm.Session):
-    credit = db.query(model.CreditWallet).filter_by(organization_id=organization_id).first()
-
-    credit.amount += credits_to_add
-    credit.last_updated = _dt.datetime.utcnow()
-    db.commit()
-    db.refresh(credit)
-
-    credit_wallet_history = model.CreditWalletHistory(id=uuid4().hex,
-                                                                             credit_wallet_id=credit.id,
-                                                                             amount=credits_to_add,
-                                                                             date=_dt.datetime.utcnow(),
-                                                                             reference=reference)
-    db.add(credit_wallet_history)
-    db.commit()
-    db.refresh(credit_wallet_history)
-
-
-async def _get_market_rate(currency: str, db: _orm.Session):
-    usd_rate = db.query(model.CreditWalletConversion).filter_by(
-        currency_code='USD').first()
-    if usd_rate is None:
-        raise fastapi.HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                                    detail="Currency " + currency + " does not have a conversion rate")
-    currency = currency.upper()
-
-    freeCurrencyApiKey = config("FREECURRENCY_API_KEY")
-    url = 'https://api.currencyapi.com/v2/latest?apikey=' + freeCurrencyApiKey
-    response = requests.get(url)
-    if response.status_code == 200:
-        jsonResponse = response.json()
-        rates = jsonResponse['data']
-        # rates['USD'] = 1
-        if currency in rates:
-            rate = usd_rate.rate * jsonResponse['data'][currency]
-            conversion_rate = model.CreditWalletConversion(id=uuid4().hex,
-                                                                                     rate=rate,
-                                                                                     currency_code=currency)
+def _record_payment_callback(provider: str, status: str, tx_ref: str, transaction_id: str,
+                             background_tasks: fastapi.BackgroundTasks, db: _orm.Session):
+    payment = payment_services.record_callback(tx_ref=tx_ref, provider=provider, successful=status == 'successful',
+                                               transaction_id=transaction_id, db=db)
+    if payment is None:
+        return RedirectResponse(url=settings.FRONTEND_URL + '?status=error&message=Transaction not found')
 
-            db.add(conversion_rate)
-            db.commit()
-            db.refresh(conversion_rate)
+    frontendUrl = payment.redirect_url or settings.FRONTEND_URL
+    if payment.status == payment_services.CANCELLED:
+        return RedirectResponse(url=frontendUrl + '?status=error&message=Payment was not successful')
+    if payment.status == payment_services.QUEUED:
+        background_tasks.add_task(payment_services.process_payment, tx_ref)
+    return RedirectResponse(url=frontendUrl + '?status=' + payment.status + '&tx_ref=' + tx_ref)
 
-            return conversion_rate
 
-    raise fastapi.HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
-                                detail="Could not get exchange rate. Please try again later")
+async def _update_credit_wallet(organization_id: str, credits_to_add: int, reference: str, db: _orm.Session,
+                                commit: bool = True):
+    return wallet_services.add_credits(organization_id=organization_id, credits=credits_to_add,
+                                       reference=reference, db=db, commit=commit)
 
 
 async def _get_organization(organization_id: str, db: _orm.Session,
@@ -476,13 +383,8 @@ async def _get_organization(organization_id: str, db: _orm.Session,
 
 
 async def _get_credit_wallet_conversion(currency: str, db: _orm.Session):
-    conversion = (
-        db.query(model.CreditWalletConversion)
-            .filter_by(currency_code=currency)
-            .first()
-    )
-
-    return conversion
+    # never waits on the exchange rate provider, stale market rates are refreshed in the background
+    return exchange_rate_services.credit_rate(currency, db)
 
 
 async def _get_wallet(organization_id: str, currency: str, db: _orm.Session):
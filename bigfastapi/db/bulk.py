@@ -0,0 +1,39 @@
+"""
+Set based write helpers shared by the collections that support bulk actions.
+"""
+
+from typing import Iterable, Optional
+
+import sqlalchemy.orm as orm
+from sqlalchemy import update
+
+# ids bound per statement, comfortably below the parameter limits of every supported backend
+CHUNK_SIZE = 1000
+
+
+def soft_delete(model, organization_id: str, db: orm.Session, ids: Optional[Iterable[str]] = None,
+                chunk_size: int = CHUNK_SIZE, commit: bool = True) -> int:
+    """
+    Flag an organization's rows of `model` as deleted with
+    `UPDATE ... SET is_deleted = true WHERE organization_id = :org [AND id IN (...)]`.
+    Without `ids` every row of the organization is deleted in a single statement, long
+    id lists are split into chunks of `chunk_size` within one transaction. Rows that are
+    already deleted are left alone. Returns the number of rows deleted.
+    """
+    criteria = [model.organization_id == organization_id, model.is_deleted == False]
+
+    def run(*extra):
+        statement = (update(model).where(*criteria, *extra).values(is_deleted=True)
+                     .execution_options(synchronize_session=False))
+        return db.execute(statement).rowcount
+
+    if ids is None:
+        deleted = run()
+    else:
+        ids = list(dict.fromkeys(ids))
+        deleted = sum(run(model.id.in_(ids[start:start + chunk_size]))
+                      for start in range(0, len(ids), chunk_size))
+
+    if commit:
+        db.commit()
+    return deleted
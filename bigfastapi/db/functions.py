@@ -0,0 +1,34 @@
+"""
+SQL functions that differ between the database backends bigfastapi supports.
+"""
+
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+from sqlalchemy.types import String
+
+
+class random_hex_id(FunctionElement):
+    """
+    A 32 character random hex string generated by the database, the SQL side
+    equivalent of `uuid4().hex`. Lets set based statements such as
+    `INSERT ... SELECT` give every inserted row its own primary key.
+    """
+
+    type = String()
+    name = "random_hex_id"
+    inherit_cache = True
+
+
+@compiles(random_hex_id)
+def _random_hex_id_default(element, compiler, **kw):
+    return "lower(hex(randomblob(16)))"
+
+
+@compiles(random_hex_id, "postgresql")
+def _random_hex_id_postgresql(element, compiler, **kw):
+    return "md5(random()::text || clock_timestamp()::text)"
+
+
+@compiles(random_hex_id, "mysql")
+def _random_hex_id_mysql(element, compiler, **kw):
+    return "replace(uuid(), '-', '')"
@@ -3,55 +3,85 @@ A collection of filter endpoints to filter data in
 an organization based on a string query
 """
 
+from typing import List
+
 import sqlalchemy.orm as orm
 from fastapi import APIRouter, Depends
 
+from bigfastapi.core.helpers import Helpers
 from bigfastapi.db.database import get_db
+from bigfastapi.models.filter_models import SavedFilter
+from bigfastapi.schemas import filter_schemas, users_schemas
+from bigfastapi.services import filter_services
+from bigfastapi.services.auth_service import is_authenticated
 
-app = APIRouter(tags=["Receipts"])
+app = APIRouter(tags=["Filters"])
 
 
-@app.post("/filters", status_code=201)
-def create_filter(
-    organization_id: str,
-    table_name: str,
-    filter_query: str,
+@app.post("/filters", status_code=201, response_model=filter_schemas.Filter)
+async def create_filter(
+    body: filter_schemas.FilterCreate,
+    user: users_schemas.User = Depends(is_authenticated),
     db: orm.Session = Depends(get_db),
 ):
-    """
-    Create a filter for an organization data.
-    e.g A filter for `receipts`.
+    """intro-->This endpoint allows you to save a filter of an organization's data, e.g a filter of its `receipts`. To use this endpoint you need to make a post request to the /filters endpoint
 
-    Parameters
-    ----------
-    organization_id: The id of the organization
-    table_name: The name of the table
-
-    Raises
-    ------
-    UnauthorizedException
-
-    BadRequestException
+            reqBody-->organization_id: This is the organization the filter belongs to
+            reqBody-->table_name: This is the table the filter applies to, receipts, banks or notifications
+            reqBody-->name: This is the name of the filter
+            reqBody-->filter_query: This is the filter, e.g subject contains "invoice" and (recipient = "ada@example.com" or date_created >= "2022-01-01"). Conditions compare a field with =, !=, <, <=, >, >=, contains or startswith, or test it with in (...) or is [not] null, and combine with and, or, not and parentheses
 
+    returnDesc--> On sucessful request, it returns
+        returnBody--> the filter
     """
+    await Helpers.check_user_org_validity(user.id, body.organization_id, db)
+    return filter_services.create_filter(body, user.id, db)
 
 
-@app.post("/filters", status_code=201)
-def get_table_filters(
-    organization_id: str, table: str, db: orm.Session = Depends(get_db)
+@app.get("/filters", status_code=200, response_model=List[filter_schemas.Filter])
+async def get_table_filters(
+    organization_id: str,
+    table_name: str,
+    user: users_schemas.User = Depends(is_authenticated),
+    db: orm.Session = Depends(get_db),
 ):
-    """
-    Retrieve all filters for a table.
-    e.g A filter for `receipts`.
+    """intro-->This endpoint allows you to retrieve the filters of a table of an organization. To use this endpoint you need to make a get request to the /filters endpoint
 
-    Parameters
-    ----------
+            paramDesc-->On get request, the url takes the parameters, organization_id and table_name
+                param-->organization_id: This is the organization whose filters are retrieved
+                param-->table_name: This is the table the filters apply to
+
+    returnDesc--> On sucessful request, it returns
+        returnBody--> a list of filters
+    """
+    await Helpers.check_user_org_validity(user.id, organization_id, db)
+    return (db.query(SavedFilter)
+        .filter(SavedFilter.organization_id == organization_id)
+        .filter(SavedFilter.table_name == table_name)
+        .order_by(SavedFilter.date_created)
+        .all())
 
 
-    Raises
-    ------
-    UnauthorizedException
+@app.get("/filters/{filter_id}/results", status_code=200, response_model=filter_schemas.FilterResults)
+async def get_filter_results(
+    filter_id: str,
+    organization_id: str,
+    cursor: str = None,
+    size: int = 50,
+    user: users_schemas.User = Depends(is_authenticated),
+    db: orm.Session = Depends(get_db),
+):
+    """intro-->This endpoint allows you to retrieve the rows a filter matches. To use this endpoint you need to make a get request to the /filters/{filter_id}/results endpoint
 
-    BadRequestException
+            paramDesc-->On get request, the url takes the parameters, filter_id, organization_id, cursor and size
+                param-->filter_id: This is the id of the filter
+                param-->organization_id: This is the organization the filter belongs to
+                param-->cursor: Optional, the next_cursor of a previous response, the rows after it are returned
+                param-->size: The number of rows to return, this is 50 by default
 
+    returnDesc--> On sucessful request, it returns
+        returnBody--> the number of rows the filter matches, a page of them and the cursor of the next page, if any
     """
+    await Helpers.check_user_org_validity(user.id, organization_id, db)
+    saved_filter = filter_services.get_filter(filter_id, organization_id, db)
+    return filter_services.run_filter(saved_filter, db, cursor=cursor, size=max(1, min(size, 1000)))
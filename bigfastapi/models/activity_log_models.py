@@ -1,7 +1,7 @@
 import datetime as _dt
 from uuid import uuid4
 
-from sqlalchemy import ForeignKey
+from sqlalchemy import DDL, ForeignKey, Index, event
 from sqlalchemy.schema import Column
 from sqlalchemy.types import String, DateTime, Float, Boolean
 
@@ -10,6 +10,17 @@ from bigfastapi.db.database import Base
 
 class Activitylog(Base):
     __tablename__ = "activity_logs"
+    # Postgres and MySQL partition the table by month on created_at, see
+    # activity_log_services.ensure_activity_log_partitions. The partition key has to be
+    # part of the primary key. MySQL needs at least one partition when the table is
+    # created, p_future holds everything until monthly partitions are split off it.
+    __table_args__ = (
+        Index("ix_activity_logs_org_created_at", "organization_id", "created_at", "id"),
+        {
+            "postgresql_partition_by": "RANGE (created_at)",
+            "mysql_partition_by": "RANGE COLUMNS(created_at) (PARTITION p_future VALUES LESS THAN (MAXVALUE))",
+        },
+    )
     id = Column(String(255), primary_key=True, index=True, default=uuid4().hex)
     organization_id = Column(String(255))
     user_id = Column(String(255))
@@ -19,7 +30,14 @@ class Activitylog(Base):
     object_url = Column(String(255),default='')
     model_name = Column(String(255))
     action = Column(String(255), default='')
-    created_at = Column(DateTime, default=_dt.datetime.now())
+    created_at = Column(DateTime, primary_key=True, default=_dt.datetime.now)
     is_deleted = Column(Boolean, default=False)
 
 
+# rows outside every monthly partition land here instead of failing the insert
+event.listen(
+    Activitylog.__table__,
+    "after_create",
+    DDL("CREATE TABLE IF NOT EXISTS activity_logs_default PARTITION OF activity_logs DEFAULT").execute_if(
+        dialect="postgresql"),
+)
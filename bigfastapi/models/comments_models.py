@@ -5,7 +5,7 @@ import sqlalchemy.orm as _orm
 import passlib.hash as _hash
 from sqlalchemy.schema import Column
 from sqlalchemy.types import String, Integer, Enum, DateTime, Boolean, ARRAY, Text
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, Index, UniqueConstraint
 from uuid import UUID, uuid4
 from sqlalchemy.ext.hybrid import hybrid_property, hybrid_method
 from sqlalchemy.sql import func
@@ -13,8 +13,12 @@ from fastapi_utils.guid_type import GUID, GUID_DEFAULT_SQLITE
 from bigfastapi.utils.utils import generate_short_id
 import bigfastapi.db.database as _database
 
+PATH_SEPARATOR = "/"
+
+
 class Comment(_database.Base):
     __tablename__ = "comment"
+    __table_args__ = (Index("ix_comment_model_type_rel_id_p_id", "model_type", "rel_id", "p_id"),)
 
     id = Column(String(255), primary_key=True, index=True, default=uuid4().hex)
     model_type = Column(String(255), ) 
@@ -31,6 +35,11 @@ class Comment(_database.Base):
     last_updated_db = Column(DateTime(timezone=True), onupdate=func.now(), server_default=func.now())
     
     p_id = Column(String(255), ForeignKey("comment.id", ondelete="cascade"))
+    # materialized path, the ids from the thread's root down to this comment, each
+    # followed by PATH_SEPARATOR. A comment's descendants are the rows whose path
+    # starts with its own, so a whole thread loads with one indexed prefix scan.
+    path = Column(String(760), index=True)
+    depth = Column(Integer, default=0, nullable=False)
     parent = _orm.relationship("Comment", backref=_orm.backref('replies',  cascade="all, delete-orphan"), remote_side=[id], post_update=True, single_parent=True, uselist=True)
 
     # def __init__(self, *args, **kwargs):
@@ -51,3 +60,28 @@ class Comment(_database.Base):
     @hybrid_method
     def downvote(self):
         self.downvotes += 1
+
+
+class CommentVote(_database.Base):
+    """A user's vote on a comment, at most one per user and comment"""
+    __tablename__ = "comment_votes"
+    __table_args__ = (UniqueConstraint("comment_id", "user_id", name="uq_comment_votes_comment_user"),)
+
+    id = Column(String(255), primary_key=True, index=True)
+    comment_id = Column(String(255), ForeignKey("comment.id", ondelete="cascade"), nullable=False)
+    user_id = Column(String(255), nullable=False, index=True)
+    action = Column(String(10), nullable=False)
+    date_created = Column(DateTime, default=datetime.datetime.utcnow)
+    last_updated = Column(DateTime, default=datetime.datetime.utcnow)
+
+
+class CommentSummary(_database.Base):
+    """Maintained comment counters and latest comment of an object"""
+    __tablename__ = "comment_summaries"
+
+    model_type = Column(String(255), primary_key=True)
+    rel_id = Column(String(255), primary_key=True)
+    comments = Column(Integer, default=0, nullable=False)
+    threads = Column(Integer, default=0, nullable=False)
+    latest_comment_id = Column(String(255), ForeignKey("comment.id", ondelete="set null"), nullable=True)
+    last_updated = Column(DateTime, default=datetime.datetime.utcnow)
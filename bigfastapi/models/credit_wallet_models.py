@@ -3,7 +3,7 @@ from uuid import uuid4
 
 from sqlalchemy import ForeignKey
 from sqlalchemy.schema import Column
-from sqlalchemy.types import String, DateTime, Float
+from sqlalchemy.types import String, DateTime, Float, Integer
 
 import bigfastapi.db.database as database
 
@@ -32,3 +32,26 @@ class CreditWalletConversion(database.Base):
     credit_wallet_type = Column(String(255), default='bfacredit')
     rate = Column(Float, default=0)
     currency_code = Column(String(4))
+    # manual rates are set by a super user, market rates follow the exchange rate of USD
+    source = Column(String(255), default='manual')
+    last_updated = Column(DateTime, default=_dt.datetime.utcnow)
+
+
+class CreditPayment(database.Base):
+    """A credit top up paid through a provider, and where processing its callback is"""
+    __tablename__ = "credit_payments"
+    id = Column(String(255), primary_key=True, index=True, default=uuid4().hex)
+    # the id of the pending wallet transaction, the reference the provider calls back with
+    tx_ref = Column(String(255), unique=True)
+    provider = Column(String(255))
+    organization_id = Column(String(255))
+    redirect_url = Column(String(1000), default=None)
+    # the provider's id of the payment
+    transaction_id = Column(String(255), default=None)
+    status = Column(String(50), index=True, default='created')
+    attempts = Column(Integer, default=0)
+    error = Column(String(1000), default=None)
+    credits = Column(Integer, default=None)
+    next_attempt_at = Column(DateTime, default=None)
+    date_created = Column(DateTime, default=_dt.datetime.utcnow)
+    last_updated = Column(DateTime, default=_dt.datetime.utcnow)
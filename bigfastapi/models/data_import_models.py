@@ -1,7 +1,7 @@
 from datetime import datetime
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, Index
 from sqlalchemy.schema import Column
-from sqlalchemy.types import String, DateTime, Boolean
+from sqlalchemy.types import BigInteger, Integer, String, DateTime, Boolean
 from uuid import uuid4
 from bigfastapi.db.database import Base
 from sqlalchemy import JSON
@@ -14,6 +14,9 @@ class FileImports(Base):
     model_name = Column(String(255))
     current_line = Column(String(255))
     total_line = Column(String(255))
+    # bytes of the file imported so far and its size, imports resume from current_offset
+    current_offset = Column(BigInteger, default=0)
+    total_bytes = Column(BigInteger, default=None)
     in_progress = Column(Boolean, default=False)
     organization_id = Column(String(255))
     user_id = Column(String(255))
@@ -33,11 +36,38 @@ class FailedFileImports(Base):
     last_updated = Column(DateTime, default=datetime.now())
 
 
+class FileImportChunks(Base):
+    """A byte range of an import file, imported by one worker in one transaction"""
+    __tablename__ = "import_chunks"
+    id = Column(String(255), primary_key=True, index=True, default=uuid4().hex)
+    import_id = Column(String(255), ForeignKey("imports.id"), index=True)
+    start = Column(BigInteger)
+    end = Column(BigInteger)
+    first_line = Column(Integer)
+    # pending, claimed (its unique keys are recorded), done or failed
+    status = Column(String(20), default="pending")
+    rows = Column(Integer, default=0)
+    failed = Column(Integer, default=0)
+    error = Column(String(255), default=None)
+    last_updated = Column(DateTime, default=datetime.now)
+
+
+class ImportKeys(Base):
+    """The line each unique key of a parallel import was seen on, the first line wins"""
+    __tablename__ = "import_keys"
+    __table_args__ = (Index("ix_import_keys_import_id_key", "import_id", "key"),)
+    import_id = Column(String(255), primary_key=True)
+    line = Column(Integer, primary_key=True)
+    key = Column(String(64))
+
+
 class FileExports(Base):
     __tablename__= "Exports"
     id = Column(String(255), primary_key=True, index=True, default=uuid4().hex)
     organization_id = Column(String(255), index=True)
-    biz_partner_id = Column(String(255), ForeignKey("biz_partners.id"), index=True)
+    # business partners are defined by the applications built on this package, there is no
+    # biz_partners table here to reference
+    biz_partner_id = Column(String(255), index=True)
     biz_partner_type = Column(String(255),)
     business_name = Column(String(255),)
     file_name = Column(String(255), unique=True)
@@ -48,6 +78,9 @@ class FileExports(Base):
     last_id = Column(String(255))
     current_line = Column(String(255))
     totat_count = Column(String(255))
+    # bytes written up to last_id, an interrupted export truncates its file back to it
+    current_offset = Column(BigInteger, default=0)
+    in_progress = Column(Boolean, default=False)
     is_deleted= Column(Boolean, default=False)
     date_created = Column(DateTime, default=datetime.now())
     last_updated = Column(DateTime, default=datetime.now())
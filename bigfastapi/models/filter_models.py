@@ -0,0 +1,21 @@
+import datetime
+from uuid import uuid4
+
+from sqlalchemy import Index
+from sqlalchemy.schema import Column
+from sqlalchemy.types import DateTime, String, Text
+
+from bigfastapi.db.database import Base
+
+
+class SavedFilter(Base):
+    __tablename__ = "saved_filters"
+    __table_args__ = (Index("ix_saved_filters_organization_id_table_name", "organization_id", "table_name"),)
+    id = Column(String(255), primary_key=True, index=True, default=uuid4().hex)
+    organization_id = Column(String(255))
+    table_name = Column(String(255))
+    name = Column(String(255))
+    filter_query = Column(Text)
+    creator_id = Column(String(255))
+    date_created = Column(DateTime, default=datetime.datetime.utcnow)
+    last_updated = Column(DateTime, default=datetime.datetime.utcnow)
@@ -1,6 +1,6 @@
 from datetime import datetime
 from sqlalchemy.schema import Column
-from sqlalchemy.types import String, DateTime, Boolean, Enum
+from sqlalchemy.types import String, DateTime, Boolean, Enum, Integer
 from uuid import uuid4
 import bigfastapi.db.database as database
 from bigfastapi.schemas import users_schemas as schema
@@ -35,7 +35,10 @@ class Notification(database.Base):
     message = Column(String(500), index=True)
     organization_id = Column(String(50), ForeignKey("organizations.id"))
     access_level = Column(String(100), index=True, default="admin")
-    date_created = Column(DateTime, default=datetime.utcnow)
+    module = Column(String(100), index=True)
+    target = Column(String(255), index=True)
+    occurrences = Column(Integer, default=1, nullable=False)
+    date_created = Column(DateTime, default=datetime.utcnow, index=True)
     last_updated = Column(DateTime, default=datetime.utcnow)
 
     creator = relationship("User", backref="notification_creator", lazy="selectin")
@@ -59,10 +62,20 @@ class NotificationRecipient(database.Base):
         "users.id"))  # foreign key to users table
     is_read = Column(Boolean, default=False)
     is_cleared = Column(Boolean, default=False)
+    digested_at = Column(DateTime, nullable=True)
     date_created = Column(DateTime, default=datetime.utcnow)
     last_updated = Column(DateTime, default=datetime.utcnow)
 
 
+class NotificationUnreadCount(database.Base):
+    """Materialized number of unread notifications a user has in an organization"""
+    __tablename__ = "notification_unread_counts"
+    recipient_id = Column(String(50), ForeignKey("users.id"), primary_key=True)
+    organization_id = Column(String(50), ForeignKey("organizations.id"), primary_key=True)
+    unread = Column(Integer, default=0, nullable=False)
+    last_updated = Column(DateTime, default=datetime.utcnow)
+
+
 class NotificationSetting(database.Base):
     __tablename__ = "notification_settings"
     id = Column(String(50), primary_key=True, index=True, default=uuid4().hex)
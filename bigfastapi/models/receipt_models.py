@@ -1,8 +1,8 @@
 from datetime import datetime
 from uuid import uuid4
-from sqlalchemy import ForeignKey
+from sqlalchemy import DDL, ForeignKey, event
 from sqlalchemy.schema import Column
-from sqlalchemy.types import BOOLEAN, DateTime, String, Text
+from sqlalchemy.types import BOOLEAN, JSON, DateTime, Integer, String, Text
 from bigfastapi.db.database import Base
 
 
@@ -20,3 +20,57 @@ class Receipt(Base):
     last_updated = Column(DateTime, default=datetime.now())
     date_created_db = Column(DateTime, default=datetime.now())
     last_updated_db = Column(DateTime, default=datetime.now())
+    # what the pipeline of receipts_services renders, files and sends
+    template = Column(String(255))
+    template_dir = Column(String(255))
+    data = Column(JSON(), default=None)
+    recipients = Column(JSON(), default=None)
+    create_file = Column(BOOLEAN, default=False)
+    # where the receipt is in the pipeline, status is None for receipts sent before it
+    status = Column(String(50), index=True, default=None)
+    stage = Column(String(50), default=None)
+    attempts = Column(Integer, default=0)
+    error = Column(Text(), default=None)
+    next_attempt_at = Column(DateTime, index=True, default=None)
+
+
+# ================================ FULL-TEXT SEARCH ================================#
+# Receipts are searched by recipient, subject, sender and message through the database's
+# own full-text index, see receipts_services.search_receipts. SQLite keeps an FTS5 table
+# over the receipts rows up to date with triggers, Postgres indexes SEARCH_DOCUMENT with
+# GIN and MySQL has a FULLTEXT index. receipts_services.ensure_receipt_search_index adds
+# them to databases created before receipts were searchable.
+SEARCH_INDEX = "ix_receipts_search"
+SEARCH_COLUMNS = ("recipient", "subject", "sender_email", "message")
+
+# the expression the GIN index is built on, queries have to use it verbatim
+SEARCH_DOCUMENT = "to_tsvector('simple', " + " || ' ' || ".join(
+    f"coalesce({column}, '')" for column in SEARCH_COLUMNS) + ")"
+
+_columns = ", ".join(SEARCH_COLUMNS)
+_new = ", ".join(f"new.{column}" for column in SEARCH_COLUMNS)
+_old = ", ".join(f"old.{column}" for column in SEARCH_COLUMNS)
+
+SEARCH_INDEX_DDL = {
+    "sqlite": [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS receipts_fts USING fts5({_columns}, "
+        f"content='receipts', content_rowid='rowid')",
+        f"CREATE TRIGGER IF NOT EXISTS receipts_fts_insert AFTER INSERT ON receipts BEGIN "
+        f"INSERT INTO receipts_fts(rowid, {_columns}) VALUES (new.rowid, {_new}); END",
+        f"CREATE TRIGGER IF NOT EXISTS receipts_fts_delete AFTER DELETE ON receipts BEGIN "
+        f"INSERT INTO receipts_fts(receipts_fts, rowid, {_columns}) VALUES ('delete', old.rowid, {_old}); END",
+        f"CREATE TRIGGER IF NOT EXISTS receipts_fts_update AFTER UPDATE OF {_columns} ON receipts BEGIN "
+        f"INSERT INTO receipts_fts(receipts_fts, rowid, {_columns}) VALUES ('delete', old.rowid, {_old}); "
+        f"INSERT INTO receipts_fts(rowid, {_columns}) VALUES (new.rowid, {_new}); END",
+    ],
+    "postgresql": [
+        f"CREATE INDEX IF NOT EXISTS {SEARCH_INDEX} ON receipts USING GIN (({SEARCH_DOCUMENT}))",
+    ],
+    "mysql": [
+        f"CREATE FULLTEXT INDEX {SEARCH_INDEX} ON receipts ({_columns})",
+    ],
+}
+
+for _dialect, _statements in SEARCH_INDEX_DDL.items():
+    for _statement in _statements:
+        event.listen(Receipt.__table__, "after_create", DDL(_statement).execute_if(dialect=_dialect))
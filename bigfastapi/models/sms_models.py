@@ -1,9 +1,7 @@
 import datetime as dt
-from re import T
-from sqlite3 import Timestamp
+import enum
 import sqlalchemy as _sql
 import sqlalchemy.orm as _orm
-import passlib.hash as _hash
 from sqlalchemy.schema import Column
 from sqlalchemy.types import String, Integer, Enum, DateTime, Boolean, ARRAY, Text
 from sqlalchemy import ForeignKey
@@ -13,10 +11,27 @@ from sqlalchemy.sql import func
 from fastapi_utils.guid_type import GUID, GUID_DEFAULT_SQLITE
 import bigfastapi.db.database as database
 
+
+class SMSStatus(str, enum.Enum):
+    queued = "queued"
+    sending = "sending"
+    retrying = "retrying"
+    sent = "sent"
+    failed = "failed"
+
+
 class SMS(database.Base):
     __tablename__ = "sms"
     id = Column(String(255), primary_key=True, index=True, default=uuid4().hex)
     sender = Column(String(255), index=True)
     recipient = Column(String(255), index=True)
     body = Column(String(255), index=True)
-    date_created = Column(DateTime, default=dt.datetime.utcnow)
\ No newline at end of file
+    message_type = Column(String(50), default="sms")
+    status = Column(String(50), index=True, default=SMSStatus.queued.value)
+    attempts = Column(Integer, default=0, nullable=False)
+    last_error = Column(Text(), nullable=True)
+    batch_id = Column(String(255), index=True, nullable=True)
+    next_attempt_at = Column(DateTime, index=True, default=dt.datetime.utcnow)
+    date_sent = Column(DateTime, nullable=True)
+    date_created = Column(DateTime, default=dt.datetime.utcnow)
+    last_updated = Column(DateTime, default=dt.datetime.utcnow)
@@ -1,9 +1,9 @@
 import datetime as datetime
 from uuid import uuid4
 
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, Index
 from sqlalchemy.schema import Column
-from sqlalchemy.types import DateTime, String
+from sqlalchemy.types import BigInteger, DateTime, Integer, String
 
 from bigfastapi.db.database import Base
 
@@ -20,27 +20,32 @@ class VirtualTable(Base):
 
 class VirtualTableData(Base):
     __tablename__ = "virtual_table_data"
+    # rows of a table are paged in id order, indexes on the value columns are only created
+    # once a column is filtered often, see virtual_table_services.ensure_column_index
+    __table_args__ = (Index("ix_virtual_table_data_table_id_id", "virtual_table_id", "id"),)
     id = Column(String(255), primary_key=True, index=True, default=uuid4().hex)
-    virtual_table_id = Column(String(255), ForeignKey("organizations.id"), index=True)
+    virtual_table_id = Column(String(255), ForeignKey("virtual_tables.id"), index=True)
     str_column_1 = Column(String(191))
     str_column_2 = Column(String(191))
     str_column_3 = Column(String(191))
-    int_column_1 = Column(String(191))
-    int_column_2 = Column(String(191))
-    int_column_3 = Column(String(191))
+    int_column_1 = Column(BigInteger)
+    int_column_2 = Column(BigInteger)
+    int_column_3 = Column(BigInteger)
     organization_id = Column(String(255), index=True)
-    date_created = Column(DateTime, default=datetime.datetime.now())
-    last_updated = Column(DateTime, default=datetime.datetime.now())
+    date_created = Column(DateTime, default=datetime.datetime.now)
+    last_updated = Column(DateTime, default=datetime.datetime.now)
 
 
 class VirtualTableColumn(Base):
     __tablename__ = "virtual_table_columns"
     id = Column(String(255), primary_key=True, index=True, default=uuid4().hex)
-    virtual_table_id = Column(String(255), ForeignKey("organizations.id"), index=True)
+    virtual_table_id = Column(String(255), ForeignKey("virtual_tables.id"), index=True)
     virtual_column_name = Column(String(191))
     db_table_name = Column(String(191))
     db_table_column_name = Column(String(191))
     type = Column(String(50), nullable=True)
+    # how many queries filtered on the column, frequently filtered columns get an index
+    filter_count = Column(Integer, default=0)
     organization_id = Column(String(255), index=True)
     date_created = Column(DateTime, default=datetime.datetime.now())
     last_updated = Column(DateTime, default=datetime.datetime.now())
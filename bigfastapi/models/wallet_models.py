@@ -1,9 +1,9 @@
 import datetime as _dt
 from uuid import uuid4
 
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, Index
 from sqlalchemy.schema import Column
-from sqlalchemy.types import String, DateTime, Float, Boolean
+from sqlalchemy.types import String, DateTime, Date, Float, Boolean, Integer
 
 import bigfastapi.db.database as _database
 
@@ -15,6 +15,8 @@ class Wallet(_database.Base):
     user_id = Column(String(255), ForeignKey("users.id"))
     currency_code = Column(String(4))
     balance = Column(Float, default=0)
+    # incremented with every transaction applied to the balance
+    version = Column(Integer, default=0, server_default="0")
     last_updated = Column(DateTime, default=_dt.datetime.utcnow)
 
 
@@ -26,4 +28,32 @@ class WalletTransaction(_database.Base):
     amount = Column(Float, default=0)
     currency_code = Column(String(4))
     transaction_date = Column(DateTime, default=_dt.datetime.utcnow)
-    transaction_ref = Column(String(255), default='')
\ No newline at end of file
+    transaction_ref = Column(String(255), default='')
+    # set by callers that may retry, a key is applied to a wallet once
+    idempotency_key = Column(String(255), unique=True, default=None)
+    # the version of the wallet and its balance once the transaction was applied
+    sequence = Column(Integer, default=None)
+    balance_after = Column(Float, default=None)
+
+    __table_args__ = (
+        Index("ix_wallet_transactions_wallet_sequence", "wallet_id", "sequence", unique=True),
+    )
+
+
+class WalletBalanceSnapshot(_database.Base):
+    """The balance of a wallet at the end of a day it had transactions, with the day's totals"""
+    __tablename__ = "wallet_balance_snapshots"
+    id = Column(String(255), primary_key=True, index=True, default=uuid4().hex)
+    wallet_id = Column(String(255), ForeignKey("wallets.id"))
+    day = Column(Date)
+    # the last transaction of the day
+    sequence = Column(Integer)
+    balance = Column(Float, default=0)
+    credits = Column(Float, default=0)
+    debits = Column(Float, default=0)
+    transactions = Column(Integer, default=0)
+    date_created = Column(DateTime, default=_dt.datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_wallet_balance_snapshots_wallet_day", "wallet_id", "day", unique=True),
+    )
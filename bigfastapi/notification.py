@@ -1,16 +1,18 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Request, WebSocket, WebSocketDisconnect
 from datetime import datetime
 from bigfastapi.db.database import get_db
 from fastapi import Depends, status, HTTPException
 from .models import notification_models as model
 from .schemas import notification_schemas as schema, users_schemas as user_schema
 from typing import List
-from bigfastapi.services.auth_service import is_authenticated
+from bigfastapi.services.auth_service import is_authenticated, verify_access_token
+from bigfastapi.services import notification_broker
 from bigfastapi.utils import paginator
 import sqlalchemy.orm as orm
 from uuid import uuid4
 from bigfastapi.models.organization_models import Organization
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
+from jose import JWTError
 from .models.user_models import User
 from .services.notification_services import (
     create_notification,
@@ -19,11 +21,35 @@ from .services.notification_services import (
     update_notification_setting,
     get_notifications,
     check_group_member_exists,
-    get_recipient_notification, get_notification_with_recipient
+    get_recipient_notification, get_notification_with_recipient,
+    get_notifications_since,
+    decrement_unread_counts,
+    get_unread_count,
+    bulk_mark_notifications,
+    bulk_delete_notifications,
+    notification_digest_scheduler,
+    unread_count_scheduler
 )
 from bigfastapi.core.helpers import Helpers
+import asyncio
 
 app = APIRouter(tags=["Notification"])
+digest_scheduler = None
+reconcile_scheduler = None
+
+
+@app.on_event("startup")
+async def start_notification_digests():
+    global digest_scheduler, reconcile_scheduler
+    digest_scheduler = asyncio.create_task(notification_digest_scheduler())
+    reconcile_scheduler = asyncio.create_task(unread_count_scheduler())
+
+
+@app.on_event("shutdown")
+async def stop_notification_digests():
+    for scheduler in (digest_scheduler, reconcile_scheduler):
+        if scheduler is not None:
+            scheduler.cancel()
 
 
 @app.get("/notification/{notification_id}", response_model=schema.Notification)
@@ -85,6 +111,145 @@ async def get_user_notifications(
     return response
 
 
+@app.get("/notifications/unread-count", response_model=schema.UnreadCountResponse)
+async def get_unread_notifications_count(
+        organization_id: str,
+        user: user_schema.User = Depends(is_authenticated),
+        db: orm.Session = Depends(get_db)):
+
+    """intro-->This endpoint returns the number of unread notifications an authenticated user has in an organization.
+               It reads a maintained counter, so it is cheap enough to poll for a badge. 
+               To use it, make a get request to the /notifications/unread-count endpoint.
+
+    paramDesc--> On get request, the request url takes the query parameter "organization_id".
+        param--> organization_id: This is the unique identifier of the organization in which the user belongs.
+
+    returnDesc-->On sucessful request, it returns:
+        returnBody--> the organization_id and the unread count.
+    """
+    await Helpers.check_user_org_validity(
+        user_id=user.id, organization_id=organization_id, db=db
+    )
+
+    return {"organization_id": organization_id, "unread": get_unread_count(user.id, organization_id, db)}
+
+
+@app.get("/notifications/stream")
+async def stream_user_notifications(
+        organization_id: str,
+        request: Request,
+        since: datetime = None,
+        user: user_schema.User = Depends(is_authenticated),
+        db: orm.Session = Depends(get_db)):
+
+    """intro-->This endpoint opens a server-sent events stream that pushes new notifications for an authenticated user
+               as they are created, so clients do not need to poll the /notifications endpoint. 
+               To use it, make a get request to the /notifications/stream endpoint with an EventSource.
+
+    paramDesc--> On get request, the request url takes query parameters - "organization_id" and "since".
+                since is optional.
+        param--> organization_id: This is the unique identifier of the organization in which the user belongs.
+        param--> since: If provided, notifications created after this time are sent first, use it to catch up after a reconnect.
+
+    returnDesc-->On sucessful request, it returns:
+        returnBody--> a text/event-stream of "notification" events, each carrying a notification item.
+    """
+    await Helpers.check_user_org_validity(
+        user_id=user.id, organization_id=organization_id, db=db
+    )
+
+    subscription = notification_broker.broker.subscribe(organization_id)
+
+    return StreamingResponse(
+        notification_events(
+            subscription=subscription, user_id=user.id, organization_id=organization_id,
+            since=since, db=db, is_disconnected=request.is_disconnected
+        ),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.websocket("/notifications/ws")
+async def notifications_websocket(
+        websocket: WebSocket,
+        organization_id: str,
+        token: str,
+        since: datetime = None,
+        db: orm.Session = Depends(get_db)):
+
+    """intro-->This websocket pushes new notifications for a user as they are created. Connect to /notifications/ws
+               with the access token as the "token" query parameter. Each message is a notification item in json.
+    """
+    credentials_exception = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                                          detail="Could not validate credentials")
+    try:
+        token_data = verify_access_token(token, credentials_exception, db)
+    except HTTPException:
+        token_data = None
+    if token_data is None or isinstance(token_data, JWTError):
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    is_member = await Helpers.is_organization_member(
+        user_id=token_data.id, organization_id=organization_id, db=db)
+    if not is_member:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    await websocket.accept()
+    subscription = notification_broker.broker.subscribe(organization_id)
+    events = notification_events(
+        subscription=subscription, user_id=token_data.id, organization_id=organization_id,
+        since=since, db=db, as_sse=False
+    )
+    try:
+        async for event in events:
+            await websocket.send_text(event)
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
+        await events.aclose()
+
+
+KEEPALIVE_SECONDS = 15
+
+
+def format_notification_event(item, as_sse: bool = True) -> str:
+    data = schema.NotificationItem.from_orm(item).json()
+    if not as_sse:
+        return data
+    return f"id: {item.Notification.id}\nevent: notification\ndata: {data}\n\n"
+
+
+async def notification_events(
+        subscription, user_id: str, organization_id: str, db: orm.Session,
+        since: datetime = None, is_disconnected=None, as_sse: bool = True):
+    """
+    Yield the notifications a user receives in an organization. Each broker message is
+    checked against the user's NotificationRecipient row, so only the recipient's own
+    notifications are forwarded. The session is released between events so an idle
+    connection does not pin a database connection.
+    """
+    async with subscription:
+        if since is not None:
+            for item in await get_notifications_since(user_id, organization_id, since, db):
+                yield format_notification_event(item, as_sse)
+            db.close()
+
+        while is_disconnected is None or not await is_disconnected():
+            message = await subscription.get(timeout=KEEPALIVE_SECONDS)
+            if message is None:
+                yield ": keepalive\n\n" if as_sse else '{"event": "keepalive"}'
+                continue
+
+            item = await get_notification_with_recipient(
+                recipient_id=user_id, notification_id=message["notification_id"], db=db)
+            db.close()
+            if item is not None:
+                yield format_notification_event(item, as_sse)
+
+
 @app.post("/notification", response_model=schema.Notification)
 async def create_user_notification(
         notification: schema.NotificationCreate,
@@ -663,7 +828,11 @@ async def mark_notification_read(req_body: schema.NotificationStatus, notificati
     notification = await get_recipient_notification(
         recipient_id=recipient_id, notification_id=notification_id, db=db)
 
-    if req_body.is_read:
+    if not notification:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Notification does not exist")
+
+    if req_body.is_read and not notification.is_read:
+        decrement_unread_counts(db, model.NotificationRecipient.id == notification.id)
         notification.is_read = True
 
     if req_body.is_cleared:
@@ -679,26 +848,80 @@ async def mark_notification_read(req_body: schema.NotificationStatus, notificati
     return updated_notification
 
 
-@app.put("/notifications/read", response_model=List[schema.Notification])
-def mark_notifications_read(db: orm.Session = Depends(get_db)):
-    """intro-->This endpoint allows you mark all notifications as read. To use, you need to make a put request to the /notification/read enpoint. 
+@app.put("/notifications/read", response_model=schema.NotificationBulkUpdateResponse)
+async def mark_notifications_read(
+        filters: schema.NotificationBulkUpdate = schema.NotificationBulkUpdate(),
+        user: user_schema.User = Depends(is_authenticated),
+        db: orm.Session = Depends(get_db)):
+    """intro-->This endpoint allows you mark an authenticated user's notifications as read. To use, you need to make a put request to the /notifications/read enpoint. 
+               Without a request body every notification of the user is marked as read.
+
+    paramDesc--> 
+        reqBody-->organization_id: Optional, only mark notifications of this organization
+        reqBody-->notification_ids: Optional, only mark these notifications
+        reqBody-->before: Optional, only mark notifications received before this time
 
     returnDesc-->On sucessful request it returns 
-        returnBody--> an array of the notifications.
+        returnBody--> the number of notifications that were marked as read.
     """
+    await _check_bulk_filters(filters, user, db)
 
-    notifications = db.query(model.Notification).all()
-    for notification in notifications:
-        if notification.has_read:
-            pass
-        else:
-            notification.has_read = True
-            notification.last_updated = datetime.utcnow()
+    affected = bulk_mark_notifications(user.id, db, is_read=True, **filters.dict())
 
-        db.commit()
-        db.refresh(notification)
+    return {"affected": affected}
 
-    return list(map(schema.Notification.from_orm, notifications))
+
+@app.put("/notifications/clear", response_model=schema.NotificationBulkUpdateResponse)
+async def mark_notifications_cleared(
+        filters: schema.NotificationBulkUpdate = schema.NotificationBulkUpdate(),
+        user: user_schema.User = Depends(is_authenticated),
+        db: orm.Session = Depends(get_db)):
+    """intro-->This endpoint allows you mark an authenticated user's notifications as cleared. To use, you need to make a put request to the /notifications/clear enpoint. 
+               Without a request body every notification of the user is marked as cleared.
+
+    paramDesc--> 
+        reqBody-->organization_id: Optional, only clear notifications of this organization
+        reqBody-->notification_ids: Optional, only clear these notifications
+        reqBody-->before: Optional, only clear notifications received before this time
+
+    returnDesc-->On sucessful request it returns 
+        returnBody--> the number of notifications that were cleared.
+    """
+    await _check_bulk_filters(filters, user, db)
+
+    affected = bulk_mark_notifications(user.id, db, is_cleared=True, **filters.dict())
+
+    return {"affected": affected}
+
+
+@app.delete("/notifications", response_model=schema.NotificationBulkUpdateResponse)
+async def delete_user_notifications(
+        filters: schema.NotificationBulkUpdate = schema.NotificationBulkUpdate(),
+        user: user_schema.User = Depends(is_authenticated),
+        db: orm.Session = Depends(get_db)):
+    """intro-->This endpoint allows you remove notifications from an authenticated user's inbox. To use, you need to make a delete request to the /notifications enpoint. 
+               Other recipients of the same notifications are not affected.
+
+    paramDesc--> 
+        reqBody-->organization_id: Optional, only delete notifications of this organization
+        reqBody-->notification_ids: Optional, only delete these notifications
+        reqBody-->before: Optional, only delete notifications received before this time
+
+    returnDesc-->On sucessful request it returns 
+        returnBody--> the number of notifications that were deleted.
+    """
+    await _check_bulk_filters(filters, user, db)
+
+    affected = bulk_delete_notifications(user.id, db, **filters.dict())
+
+    return {"affected": affected}
+
+
+async def _check_bulk_filters(filters: schema.NotificationBulkUpdate, user: user_schema.User, db: orm.Session):
+    if filters.organization_id:
+        await Helpers.check_user_org_validity(
+            user_id=user.id, organization_id=filters.organization_id, db=db
+        )
 
 
 @app.put("/notifications/{notification_id}", response_model=schema.Notification)
@@ -746,6 +969,14 @@ def delete_notification(notification_id: str, db: orm.Session = Depends(get_db))
 
     notification = model.notification_selector(id=notification_id, db=db)
 
+    if not notification:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Notification does not exist")
+
+    decrement_unread_counts(db, model.NotificationRecipient.notification_id == notification_id)
+    db.query(model.NotificationRecipient).filter(
+        model.NotificationRecipient.notification_id == notification_id
+    ).delete(synchronize_session=False)
+
     db.delete(notification)
     db.commit()
 
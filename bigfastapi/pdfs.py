@@ -41,6 +41,12 @@ def pdf_converter( file_name:str,db:orm.Session,url:str=None, filepath:str=None,
     if url != None:
         pdfkit.from_url(url, file_name, options)
 
+    return store_pdf(file_name=file_name, db=db)
+
+
+def store_pdf(file_name: str, db: orm.Session):
+    """Move a pdf written to the working directory into the pdfs bucket and record it"""
+
     #bucketname
     bucketname = 'pdfs' 
     filename = file_name
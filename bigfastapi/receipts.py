@@ -1,34 +1,52 @@
 from datetime import datetime
-import os
-from uuid import uuid4
-from datetime import date
+import asyncio
+import logging
 
 import sqlalchemy.orm as orm
-from bigfastapi.utils.utils import convert_template_to_html
 from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, status
 from fastapi.encoders import jsonable_encoder
 from fastapi.exceptions import HTTPException
 from fastapi.responses import JSONResponse
-from sqlalchemy import and_
 
-from bigfastapi.db.database import get_db
+from bigfastapi.db.database import get_db, SessionLocal
+from bigfastapi.db.bulk import soft_delete
 
 from bigfastapi.services.auth_service import is_authenticated
 from .core import messages
 from .core.helpers import Helpers
-from .services import email_services
 from .models import organization_models
 from .models.organization_models import Organization
 from .models.receipt_models import Receipt
-from .schemas import pdf_schema, receipt_schemas, users_schemas
+from .schemas import receipt_schemas, users_schemas
 from .services import receipts_services
-from .utils import paginator
+from .utils import paginator, settings
 
 app = APIRouter(tags=["Receipts"])
+logger = logging.getLogger(__name__)
+receipt_scheduler = None
+
+
+@app.on_event("startup")
+async def start_receipts():
+    global receipt_scheduler
+    db = SessionLocal()
+    try:
+        receipts_services.ensure_receipt_search_index(db)
+    except Exception:
+        logger.exception("could not create the receipt search index")
+    finally:
+        db.close()
+    receipt_scheduler = asyncio.create_task(receipts_services.receipt_pipeline_scheduler())
+
+
+@app.on_event("shutdown")
+async def stop_receipts():
+    if receipt_scheduler is not None:
+        receipt_scheduler.cancel()
 
 
 @app.post(
-    "/receipts", status_code=201, response_model=receipt_schemas.SendReceiptResponse
+    "/receipts", status_code=202, response_model=receipt_schemas.SendReceiptResponse
 )
 async def send_receipt(
     payload: receipt_schemas.attributes,
@@ -41,12 +59,16 @@ async def send_receipt(
     """
     An endpoint to send receipts.
 
+    Intro -
+
+        The receipt is stored and queued at once. It is rendered, converted to a PDF file when `create_file` is set and emailed in the background, the `status` and `stage` of the receipt show how far it got.
+
     ReturnDesc-
 
         On sucessful request, it returns
 
         returnBody-
-            an object with a key `message` with a string value - `receipt sent` and a key `data` with the created receipt details.
+            an object with a key `message` with a string value - `receipt queued` and a key `data` with the queued receipt details.
     Raises -
 
         HTTP_404_NOT_FOUND: object does not exist in db
@@ -54,9 +76,81 @@ async def send_receipt(
         HTTP_403_FORBIDDEN: User is not a member of organization
         HTTP_422_UNPROCESSABLE_ENTITY: Request validation error
     """
-    # try:
+    await _check_organization_member(payload.organization_id, user, db)
+    if not payload.recipients:
+        raise HTTPException(status_code=400, detail="A receipt needs at least one recipient")
+
+    create_file = payload.create_file if payload.create_file else create_file
+    receipt = receipts_services.create_receipt(payload, create_file=create_file, db=db)
+    db.commit()
+
+    # the workers open their own sessions, the request session is closed by then
+    background_tasks.add_task(receipts_services.process_receipts, [receipt.id])
+
+    return {"message": "receipt queued", "data": receipt}
+
+
+@app.post(
+    "/receipts/bulk", status_code=202, response_model=receipt_schemas.SendReceiptsResponse
+)
+async def send_receipts(
+    payload: receipt_schemas.BulkReceipts,
+    background_tasks: BackgroundTasks,
+    db: orm.Session = Depends(get_db),
+    user: users_schemas.User = Depends(is_authenticated),
+):
+
+    """
+    An endpoint to send many receipts at once.
+
+    Intro -
+
+        The receipts are stored and queued in one go and go through the same background stages as the receipts of the /receipts endpoint.
+
+    ParamDesc -
+
+        reqBody-receipts: The receipts to send, each with the fields the /receipts endpoint takes.
+        reqBody-create_file(optional): Whether to convert every receipt to a PDF file, a receipt's own `create_file` takes precedence.
+
+    ReturnDesc-
+
+        On sucessful request, it returns
+
+        returnBody-
+            an object with a key `message` with a string value - `receipts queued` and a key `data` with the queued receipts.
+    Raises -
+
+        HTTP_400_BAD_REQUEST: More receipts than RECEIPT_BULK_LIMIT or a receipt without recipients
+        HTTP_404_NOT_FOUND: object does not exist in db
+        HTTP_401_UNAUTHORIZED: Not Authenticated
+        HTTP_403_FORBIDDEN: User is not a member of organization
+    """
+    if len(payload.receipts) > settings.RECEIPT_BULK_LIMIT:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {settings.RECEIPT_BULK_LIMIT} receipts can be sent at once",
+        )
+    for organization_id in {receipt.organization_id for receipt in payload.receipts}:
+        await _check_organization_member(organization_id, user, db)
+    if not all(receipt.recipients for receipt in payload.receipts):
+        raise HTTPException(status_code=400, detail="A receipt needs at least one recipient")
+
+    receipts = [
+        receipts_services.create_receipt(
+            receipt, create_file=receipt.create_file if receipt.create_file else payload.create_file, db=db
+        )
+        for receipt in payload.receipts
+    ]
+    db.commit()
+
+    background_tasks.add_task(receipts_services.process_receipts, [receipt.id for receipt in receipts])
+
+    return {"message": "receipts queued", "data": receipts}
+
+
+async def _check_organization_member(organization_id: str, user: users_schemas.User, db: orm.Session):
     organization = await organization_models.fetchOrganization(
-        orgId=payload.organization_id, db=db
+        orgId=organization_id, db=db
     )
     if not organization:
         raise HTTPException(
@@ -72,82 +166,6 @@ async def send_receipt(
             status_code=status.HTTP_403_FORBIDDEN,
             detail=messages.NOT_ORGANIZATION_MEMBER,
         )
-    
-    custom_template_dir = payload.custom_template_dir
-    create_file = payload.create_file if payload.create_file else create_file
-    
-    if not custom_template_dir:
-        template_dir_path = os.path.abspath(
-            os.environ.get("TEMPLATES_DIR", payload.template))
-        if not os.path.exists(template_dir_path):
-            raise HTTPException(
-                status_code=404, detail=f"Template: {payload.template} does not exist")
-        custom_template_dir = "/".join(template_dir_path.split("/")[:-1])
-        template = payload.template.split("/")[-1]
-
-    html_string = convert_template_to_html(
-            template_dir=custom_template_dir,
-            template_file=template,
-            template_data=payload.data
-        )
-
-    receipt = Receipt(
-        id=uuid4().hex,
-        sender_email=payload.sender_email,
-        recipient=payload.recipients[0],
-        subject=payload.subject,
-        message=html_string,
-        organization_id=payload.organization_id,
-    )
-
-    if create_file == True:
-        pdf_name = (payload.subject) + str(uuid4().hex) + ".pdf"
-
-        schema = {"htmlString": html_string, "pdfName": pdf_name}
-        file = receipts_services.convert_to_pdf(pdf_schema.Format(**schema), db=db)
-        receipt.file_id = file.id
-
-        await email_services.send_email(
-            title=payload.subject,
-            recipients=payload.recipients,
-            template=template if template else "mail_receipt.html",
-            template_body=payload.data,
-            custom_template_dir=custom_template_dir,
-            background_tasks=background_tasks,
-            db=db,
-            file="./filestorage/pdfs/" + pdf_name,
-        )
-    else:
-        await email_services.send_email(
-            title=payload.subject,
-            recipients=payload.recipients,
-            template=template if template else "mail_receipt.html",
-            template_body=payload.data,
-            custom_template_dir=custom_template_dir,
-            background_tasks=background_tasks,
-            db=db,
-        )
-
-    db.add(receipt)
-    db.commit()
-    db.refresh(receipt)
-
-    response_data = payload.dict()
-    response_data["receipt_id"] = receipt.id
-    response_data["created_at"] = date.today().strftime("%d %B, %Y")
-    response_data["path"] = os.path.join(
-        os.path.abspath("./filestorage/pdfs/"), pdf_name
-    )
-
-    return {"message": "receipt sent", "data": response_data}, 201
-
-    # except Exception as ex:
-        # db.rollback()
-        # if type(ex) == HTTPException:
-        #     raise ex
-        # raise HTTPException(
-        #     status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(ex)
-        # )
 
 
 @app.get(
@@ -161,6 +179,7 @@ async def get_receipts(
     reverse_sort: bool = True,
     page: int = 1,
     size: int = 50,
+    cursor: str = None,
     db: orm.Session = Depends(get_db),
     user: users_schemas.User = Depends(is_authenticated),
 ):
@@ -175,12 +194,13 @@ async def get_receipts(
     ParamDesc -
 
         reqQuery-organization_id: This is the id of the organization sending the receipt.
-        reqQuery-search_value(optional): This is a string used to filter the receipts.
+        reqQuery-search_value(optional): This is a string used to search the recipient, subject, sender and message of the receipts. Matches are returned best first.
         reqQuery-sorting_key(optional): This is a string used to sort the receipts.
         reqQuery-datetime_constraint: This is the key used for synchronization. If provided, the receipts created after the specified time are returned.
         reqQuery-reverse_sort(optional): This is a boolean specifying the order of the returned data.
         reqQuery-page: This is an integer specifying the page to display. The default value is `1`.
         reqQuery-size: This is an integer used to specify the volume of data to be retrieved in numbers.
+        reqQuery-cursor(optional): When searching, the `next_cursor` of the previous page of matches. It is used instead of `page`.
 
     returnDesc-
 
@@ -219,11 +239,12 @@ async def get_receipts(
                 {"message": "Organization does not exist"},
                 status_code=status.HTTP_404_NOT_FOUND,
             )
+        next_cursor = None
         if search_value:
-            receipts, total_items = await receipts_services.search_receipts(
+            receipts, total_items, next_cursor = await receipts_services.search_receipts(
                 organization_id=organization_id,
                 search_value=search_value,
-                offset=offset,
+                cursor=cursor,
                 size=page_size,
                 db=db,
             )
@@ -247,6 +268,7 @@ async def get_receipts(
             "total": total_items,
             "previous_page": pointers["previous"],
             "next_page": pointers["next"],
+            "next_cursor": next_cursor,
             "items": receipts,
         }
         return JSONResponse({"data": jsonable_encoder(response)}, status_code=200)
@@ -326,7 +348,7 @@ async def delete_selected_receipts(
 
     paramDesc-On delete request the url takes no parameter
 
-    returnDesc-On sucessful request, it returns a `message`
+    returnDesc-On sucessful request, it returns a `message` and the number of receipts `deleted`
     returnBody- "successfully deleted receipts"
     """
 
@@ -339,23 +361,11 @@ async def delete_selected_receipts(
             detail="You are not allowed to delete receipts for this business",
         )
 
-    for receipt_id in receipts.receipt_id_list:
-        receipt = (
-            db.query(Receipt)
-            .filter(
-                and_(
-                    Receipt.id == receipt_id,
-                    Receipt.organization_id == receipts.organization_id,
-                )
-            )
-            .first()
-        )
-        if receipt is not None:
-            receipt.is_deleted = True
-            db.commit()
-            db.refresh(receipt)
+    deleted = soft_delete(
+        Receipt, organization_id=receipts.organization_id, ids=receipts.receipt_id_list, db=db
+    )
 
-    return {"message": "Successfully Deleted Receipts"}
+    return {"message": "Successfully Deleted Receipts", "deleted": deleted}
 
 
 @app.get("/receipts/{receipt_id}/download", status_code=200)
@@ -29,3 +29,8 @@ class ActivitiesLogOutput(pydantic.BaseModel):
     class Config:
         orm_mode = True
 
+
+
+class ActivitiesLogPage(pydantic.BaseModel):
+    items: List[ActivitiesLogOutput]
+    next_cursor: Optional[str] = None
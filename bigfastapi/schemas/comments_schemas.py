@@ -30,6 +30,53 @@ class Comment(CommentBase):
         orm_mode = True
 
 
+class CommentThread(CommentBase):
+    id: str
+    rel_id: str
+    p_id: Optional[str]
+    downvotes: int
+    upvotes: int
+    depth: int = 0
+    replies: List["CommentThread"] = []
+    replies_cursor: Optional[str] = None
+
+    class Config:
+        orm_mode = True
+
+
+CommentThread.update_forward_refs()
+
+
+class CommentThreadPage(pydantic.BaseModel):
+    page: int
+    size: int
+    total: int
+    previous_page: Optional[str]
+    next_page: Optional[str]
+    items: List[CommentThread]
+
+
+class CommentReplies(pydantic.BaseModel):
+    items: List[CommentThread]
+    next_cursor: Optional[str]
+
+
+class CommentedObject(pydantic.BaseModel):
+    model_type: str
+    rel_id: str
+
+
+class LatestComment(CommentBase):
+    class Config:
+        orm_mode = True
+
+
+class CommentSummary(CommentedObject):
+    comments: int = 0
+    threads: int = 0
+    latest_comment: Optional[LatestComment] = None
+
+
 class CommentCreate(CommentBase):
     pass
 
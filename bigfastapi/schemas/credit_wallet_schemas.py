@@ -1,4 +1,5 @@
 import datetime
+from typing import Optional
 
 import pydantic as _pydantic
 
@@ -46,3 +47,18 @@ class CreditWalletResponse(CreditWalletCreate):
 
     class Config:
         orm_mode = True
+
+
+class CreditPaymentStatus(_pydantic.BaseModel):
+    tx_ref: str
+    provider: str
+    organization_id: str
+    status: str
+    attempts: int
+    credits: Optional[int]
+    error: Optional[str]
+    date_created: datetime.datetime
+    last_updated: datetime.datetime
+
+    class Config:
+        orm_mode = True
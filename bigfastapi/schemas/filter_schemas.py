@@ -0,0 +1,30 @@
+import datetime
+from typing import Any, Dict, List, Optional
+
+import pydantic
+
+
+class FilterCreate(pydantic.BaseModel):
+    organization_id: str
+    table_name: str
+    name: str
+    filter_query: pydantic.constr(min_length=1, max_length=2000)
+
+
+class Filter(pydantic.BaseModel):
+    id: str
+    organization_id: str
+    table_name: str
+    name: str
+    filter_query: str
+    creator_id: Optional[str]
+    date_created: Optional[datetime.datetime]
+
+    class Config:
+        orm_mode = True
+
+
+class FilterResults(pydantic.BaseModel):
+    total: int
+    items: List[Dict[str, Any]]
+    next_cursor: Optional[str] = None
@@ -1,4 +1,5 @@
 from datetime import datetime
+from typing import List
 from pydantic import BaseModel
 
 class FailedImportOutput(BaseModel):
@@ -12,4 +13,45 @@ class FailedImportOutput(BaseModel):
     created_at: datetime
 
     class Config:
-        orm_mode = True
\ No newline at end of file
+        orm_mode = True
+
+class ImportChunkProgress(BaseModel):
+    id: str
+    start: int
+    end: int
+    first_line: int
+    status: str
+    rows: int = 0
+    failed: int = 0
+    error: str = None
+
+    class Config:
+        orm_mode = True
+
+
+class ImportProgress(BaseModel):
+    id: str
+    file_name: str = None
+    model_name: str = None
+    current_line: str = None
+    total_line: str = None
+    current_offset: int = None
+    total_bytes: int = None
+    in_progress: bool = False
+    chunks: List[ImportChunkProgress] = []
+
+    class Config:
+        orm_mode = True
+
+
+class ExportProgress(BaseModel):
+    id: str
+    report_type: str
+    file_name: str
+    current_line: str = None
+    totat_count: str = None
+    in_progress: bool = False
+    file_id: str = None
+
+    class Config:
+        orm_mode = True
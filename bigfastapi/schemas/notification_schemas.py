@@ -35,6 +35,9 @@ class NotificationBase(pydantic.BaseModel):
 class Notification(NotificationBase):
     id: str
     creator_id: str
+    module: Optional[str]
+    target: Optional[str]
+    occurrences: Optional[int] = 1
     date_created: datetime
     last_updated: datetime
     creator: Optional[NotificationCreator]
@@ -61,6 +64,7 @@ class NotificationRecipientResponse(NotificationBase):
 class NotificationCreate(NotificationBase):
     creator_id: str
     module: str
+    target: Optional[str] = None
     mentions: Optional[list] = None
 
 
@@ -184,6 +188,21 @@ class NotificationItem(pydantic.BaseModel):
         orm_mode = True
 
 
+class NotificationBulkUpdate(pydantic.BaseModel):
+    organization_id: Optional[str]
+    notification_ids: Optional[List[str]]
+    before: Optional[datetime]
+
+
+class NotificationBulkUpdateResponse(pydantic.BaseModel):
+    affected: int
+
+
+class UnreadCountResponse(pydantic.BaseModel):
+    organization_id: str
+    unread: int
+
+
 class FetchNotificationsResponse(pydantic.BaseModel):
     page: int
     size: int
@@ -15,6 +15,10 @@ class Receipt(BaseModel):
     recipient: Optional[str]
     is_deleted: Optional[bool]
     file_id: Optional[str]
+    status: Optional[str]
+    stage: Optional[str]
+    attempts: Optional[int]
+    error: Optional[str]
 
     class Config:
         orm_mode = True
@@ -23,6 +27,10 @@ class attributes(Receipt):
     recipients: List[EmailStr] = []
     create_file: Optional[bool]
 
+class BulkReceipts(BaseModel):
+    receipts: List[attributes]
+    create_file: bool = False
+
 class DeleteSelectedReceipts(BaseModel):
     organization_id: str
     receipt_id_list: list
@@ -31,6 +39,10 @@ class SendReceiptResponse(BaseModel):
     message: str
     data: Receipt
 
+class SendReceiptsResponse(BaseModel):
+    message: str
+    data: List[Receipt]
+
 class ReceiptsResponse(BaseModel):
     page: int
     size: int
@@ -38,6 +50,7 @@ class ReceiptsResponse(BaseModel):
     items: List[Receipt]
     previous_page: Optional[str]
     next_page: Optional[str]
+    next_cursor: Optional[str]
 
 class FetchReceiptsResponse(BaseModel):
     data: ReceiptsResponse
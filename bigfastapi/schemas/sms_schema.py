@@ -1,3 +1,4 @@
+from datetime import datetime
 from pydantic import BaseModel
 from typing import Optional, List
 
@@ -11,4 +12,24 @@ class SMS(HashableBaseModel):
     sender: str
     recipient: list
     content: str
-    message_type: str = "sms"
\ No newline at end of file
+    message_type: str = "sms"
+
+class SMSOut(BaseModel):
+    id: str
+    sender: str
+    recipient: str
+    body: str
+    message_type: Optional[str]
+    status: str
+    attempts: int
+    last_error: Optional[str]
+    date_sent: Optional[datetime]
+    date_created: datetime
+
+    class Config:
+        orm_mode = True
+
+
+class QueuedSMSResponse(BaseModel):
+    message: str
+    data: List[SMSOut]
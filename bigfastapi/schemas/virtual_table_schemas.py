@@ -0,0 +1,67 @@
+import datetime
+from typing import Any, Dict, List, Optional, Union
+
+import pydantic
+
+
+class VirtualColumnCreate(pydantic.BaseModel):
+    name: pydantic.constr(min_length=1, max_length=191)
+    type: str = "str"
+
+
+class VirtualTableCreate(pydantic.BaseModel):
+    organization_id: str
+    name: str
+    parent_object_name: Optional[str] = None
+    columns: List[VirtualColumnCreate]
+
+
+class VirtualColumn(pydantic.BaseModel):
+    name: str
+    type: str
+
+
+class VirtualTable(pydantic.BaseModel):
+    id: str
+    name: str
+    parent_object_name: Optional[str]
+    organization_id: str
+    columns: List[VirtualColumn] = []
+    date_created: Optional[datetime.datetime]
+
+
+class VirtualRowsCreate(pydantic.BaseModel):
+    rows: List[Dict[str, Union[pydantic.StrictInt, str, None]]]
+
+
+class VirtualRowCreate(pydantic.BaseModel):
+    row: Dict[str, Union[pydantic.StrictInt, str, None]]
+
+
+class VirtualFilter(pydantic.BaseModel):
+    column: str
+    op: str = "eq"
+    value: Any = None
+
+
+class VirtualSort(pydantic.BaseModel):
+    column: str
+    direction: str = "asc"
+
+
+class VirtualTableQuery(pydantic.BaseModel):
+    filters: List[VirtualFilter] = []
+    sort: List[VirtualSort] = []
+    cursor: Optional[str] = None
+    size: int = 50
+
+
+class VirtualRow(pydantic.BaseModel):
+    id: str
+    values: Dict[str, Union[pydantic.StrictInt, str, None]]
+    date_created: Optional[datetime.datetime]
+
+
+class VirtualRowsPage(pydantic.BaseModel):
+    items: List[VirtualRow]
+    next_cursor: Optional[str] = None
@@ -1,6 +1,6 @@
 import datetime as _dt
 from enum import Enum
-from typing import Optional
+from typing import List, Optional
 from pydantic import BaseModel
 
 
@@ -41,3 +41,23 @@ class WalletUpdate(BaseModel):
 class PaymentProvider(Enum):
     FLUTTERWAVE = 'flutterwave'
     STRIPE = 'stripe'
+
+
+class WalletBalance(BaseModel):
+    wallet_id: str
+    at: _dt.datetime
+    balance: float
+
+
+class DailyBalance(BaseModel):
+    day: _dt.date
+    balance: float
+    credits: float
+    debits: float
+    transactions: int
+
+
+class DailyBalances(BaseModel):
+    wallet_id: str
+    opening_balance: float
+    days: List[DailyBalance]
@@ -0,0 +1,372 @@
+import asyncio
+import atexit
+import datetime as _dt
+import logging
+import re
+import threading
+from collections import deque
+from typing import Callable, Dict, List, Optional
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError, TimeoutError as SQLAlchemyTimeoutError
+from sqlalchemy.orm import Session
+
+from bigfastapi.core.helpers import Helpers
+from bigfastapi.db.database import SessionLocal
+from bigfastapi.models.activity_log_models import Activitylog
+from bigfastapi.utils import settings
+
+logger = logging.getLogger(__name__)
+
+
+# =================================== ACTIVITY LOG BUFFER =================================#
+# Activity logs are written behind the request that produced them. Entries are queued in
+# memory and a worker thread bulk inserts them whenever ACTIVITY_LOG_BATCH_SIZE entries
+# are waiting or every ACTIVITY_LOG_FLUSH_INTERVAL seconds, whichever comes first. The
+# queue is drained on shutdown; entries still in memory when the process is killed are lost.
+# A batch that fails because the database is unreachable is requeued for the next flush;
+# any other failure is retried row by row and the rows that still fail are dropped.
+
+
+class ActivityLogBuffer:
+    def __init__(self, batch_size: int, flush_interval: float, max_size: int,
+                 session_factory: Callable = SessionLocal):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.session_factory = session_factory
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._worker: Optional[threading.Thread] = None
+        self._closed = False
+
+    def add(self, entry: dict, announcement: str = None):
+        """Queue an activity log row, and optionally a message announcing it on Slack"""
+        with self._lock:
+            self._pending.append((entry, announcement))
+            pending = len(self._pending)
+            self._start_worker()
+
+        if pending >= self.max_size:
+            # the database is not keeping up, make the producer wait instead of growing memory
+            self.flush()
+        elif pending >= self.batch_size:
+            self._wakeup.set()
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self) -> int:
+        """Write everything queued so far, returns the number of rows inserted"""
+        written = 0
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    batch = [self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+                if not batch:
+                    return written
+
+                try:
+                    self._write([entry for entry, _ in batch])
+                    unwritten = []
+                except Exception as error:
+                    if is_transient(error):
+                        logger.exception("could not write %s activity logs", len(batch))
+                        self._requeue(batch)
+                        return written
+                    logger.exception("could not write %s activity logs, retrying them one by one", len(batch))
+                    batch, unwritten = self._write_each(batch)
+
+                written += len(batch)
+                self._announce([announcement for _, announcement in batch if announcement])
+                if unwritten:
+                    self._requeue(unwritten)
+                    return written
+
+    def close(self):
+        """Stop the worker and write whatever is still queued"""
+        self._closed = True
+        self._wakeup.set()
+        if self._worker is not None and self._worker is not threading.current_thread():
+            self._worker.join(timeout=self.flush_interval + 5)
+        self.flush()
+
+    def _write(self, entries: list):
+        db = self.session_factory()
+        try:
+            db.bulk_insert_mappings(Activitylog, entries)
+            db.commit()
+        finally:
+            db.close()
+
+    def _write_each(self, batch: list):
+        """
+        Write a batch that failed as a whole one row at a time, so a single bad row can not
+        hold back the rest. Rows that still fail are logged and dropped; if the database goes
+        away midway, the rows not yet tried are returned to be requeued.
+        Returns (written, unwritten).
+        """
+        written = []
+        for position, (entry, announcement) in enumerate(batch):
+            try:
+                self._write([entry])
+            except Exception as error:
+                if is_transient(error):
+                    return written, batch[position:]
+                logger.error("dropping activity log that can not be written: %r (%s)", entry, error)
+                continue
+            written.append((entry, announcement))
+        return written, []
+
+    def _requeue(self, batch: list):
+        with self._lock:
+            room = self.max_size - len(self._pending)
+            if room < len(batch):
+                logger.error("activity log buffer is full, dropping %s entries", len(batch) - max(room, 0))
+                batch = batch[:max(room, 0)]
+            self._pending.extendleft(reversed(batch))
+
+    def _announce(self, announcements: list):
+        for announcement in announcements:
+            try:
+                Helpers.slack_notification("LOG_WEBHOOK_URL", text=announcement)
+            except Exception:
+                logger.exception("could not post activity log to slack")
+
+    def _start_worker(self):
+        if self._closed or (self._worker is not None and self._worker.is_alive()):
+            return
+        self._worker = threading.Thread(target=self._run, name="activity-log-buffer", daemon=True)
+        self._worker.start()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+def is_transient(error: Exception) -> bool:
+    """Whether a failed write is worth retrying later: the connection, not the rows, was at fault"""
+    if isinstance(error, DBAPIError) and error.connection_invalidated:
+        return True
+    return isinstance(error, (OperationalError, InterfaceError, SQLAlchemyTimeoutError, ConnectionError))
+
+
+buffer = ActivityLogBuffer(
+    batch_size=settings.ACTIVITY_LOG_BATCH_SIZE,
+    flush_interval=settings.ACTIVITY_LOG_FLUSH_INTERVAL,
+    max_size=settings.ACTIVITY_LOG_MAX_BUFFER,
+)
+
+atexit.register(buffer.close)
+
+
+# =================================== PARTITIONS AND RETENTION =================================#
+# On Postgres and MySQL activity_logs is range partitioned by month on created_at, so the
+# retention job expires old logs by dropping whole partitions instead of deleting rows.
+# Partitions are created ACTIVITY_LOG_PARTITIONS_AHEAD months in advance. Tables created
+# before partitioning, and sqlite, fall back to deleting expired rows in chunks.
+# ACTIVITY_LOG_RETENTION_DAYS of 0 keeps logs forever.
+#
+# create_all never alters a table that already exists, so an activity_logs table created
+# before partitioning keeps its id primary key and stays unpartitioned; maintenance logs a
+# warning for it and keeps deleting rows. To convert one, rename it, restart so create_all
+# creates the partitioned table (its partitions are added on startup), then copy the rows
+# over with INSERT INTO activity_logs SELECT ... FROM the renamed table and drop it.
+
+TABLE = Activitylog.__tablename__
+# MySQL catch-all partition that monthly partitions are split off
+FUTURE_PARTITION = "p_future"
+PARTITION_NAME = re.compile(r"p(\d{4})(\d{2})$")
+DELETE_CHUNK_SIZE = 5000
+
+
+def month_start(moment: _dt.datetime) -> _dt.datetime:
+    return _dt.datetime(moment.year, moment.month, 1)
+
+
+def next_month(month: _dt.datetime) -> _dt.datetime:
+    return _dt.datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def partition_name(month: _dt.datetime) -> str:
+    return f"p{month:%Y%m}"
+
+
+def partitioning(db: Session) -> Optional[str]:
+    """The dialect name when activity_logs is natively partitioned, None otherwise"""
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        query = "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:table)"
+    elif dialect == "mysql":
+        query = ("SELECT 1 FROM information_schema.partitions WHERE table_schema = DATABASE() "
+                 "AND table_name = :table AND partition_name IS NOT NULL LIMIT 1")
+    else:
+        return None
+    return dialect if db.execute(text(query), {"table": TABLE}).first() else None
+
+
+def unpartitioned_table(db: Session) -> bool:
+    """Whether activity_logs was created before partitioning on a database that supports it"""
+    dialect = db.get_bind().dialect.name
+    if dialect not in ("postgresql", "mysql") or partitioning(db) is not None:
+        return False
+    return inspect(db.get_bind()).has_table(TABLE)
+
+
+def existing_partitions(db: Session, dialect: str) -> Dict[str, _dt.datetime]:
+    """Monthly partitions of activity_logs by partition name, with the month each one holds"""
+    if dialect == "postgresql":
+        query = ("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                 "WHERE i.inhparent = to_regclass(:table)")
+    else:
+        query = ("SELECT partition_name FROM information_schema.partitions WHERE table_schema = DATABASE() "
+                 "AND table_name = :table AND partition_name IS NOT NULL")
+
+    partitions = {}
+    for (name,) in db.execute(text(query), {"table": TABLE}):
+        name = name[len(TABLE) + 1:] if name.startswith(f"{TABLE}_") else name
+        match = PARTITION_NAME.match(name)
+        if match:
+            partitions[name] = _dt.datetime(int(match.group(1)), int(match.group(2)), 1)
+    return partitions
+
+
+def create_partitions_ddl(dialect: str, months: List[_dt.datetime]) -> List[str]:
+    if dialect == "postgresql":
+        return [
+            f"CREATE TABLE IF NOT EXISTS {TABLE}_{partition_name(month)} PARTITION OF {TABLE} "
+            f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{next_month(month):%Y-%m-%d}')"
+            for month in months
+        ]
+
+    # MySQL range partitions stay ordered, new months are split off the catch-all partition
+    definitions = [
+        f"PARTITION {partition_name(month)} VALUES LESS THAN ('{next_month(month):%Y-%m-%d}')"
+        for month in months
+    ]
+    definitions.append(f"PARTITION {FUTURE_PARTITION} VALUES LESS THAN (MAXVALUE)")
+    return [f"ALTER TABLE {TABLE} REORGANIZE PARTITION {FUTURE_PARTITION} INTO ({', '.join(definitions)})"]
+
+
+def drop_partitions_ddl(dialect: str, names: List[str]) -> List[str]:
+    if dialect == "postgresql":
+        return [f"DROP TABLE IF EXISTS {TABLE}_{name}" for name in names]
+    return [f"ALTER TABLE {TABLE} DROP PARTITION {', '.join(names)}"]
+
+
+def ensure_activity_log_partitions(db: Session = None, months_ahead: int = None) -> List[str]:
+    """Create the monthly partitions from the current month to `months_ahead` months
+    from now, returns the names of the partitions created"""
+    months_ahead = settings.ACTIVITY_LOG_PARTITIONS_AHEAD if months_ahead is None else months_ahead
+    if db is None:
+        db = SessionLocal()
+        try:
+            return ensure_activity_log_partitions(db, months_ahead)
+        finally:
+            db.close()
+
+    dialect = partitioning(db)
+    if dialect is None:
+        if unpartitioned_table(db):
+            logger.warning("%s is not partitioned, expired logs are deleted row by row; "
+                           "see activity_log_services for how to convert it", TABLE)
+        return []
+
+    existing = existing_partitions(db, dialect)
+    months = [month_start(_dt.datetime.now())]
+    for _ in range(months_ahead):
+        months.append(next_month(months[-1]))
+
+    if dialect == "mysql" and existing:
+        # months before the newest partition are already covered by it
+        months = [month for month in months if month > max(existing.values())]
+    missing = [month for month in months if partition_name(month) not in existing]
+    if not missing:
+        return []
+
+    for statement in create_partitions_ddl(dialect, missing):
+        db.execute(text(statement))
+    db.commit()
+    return [partition_name(month) for month in missing]
+
+
+def expire_activity_logs(db: Session = None, retention_days: int = None) -> dict:
+    """
+    Remove activity logs older than `retention_days` days. Partitions whose whole month
+    is past the cutoff are dropped, the logs of the month the cutoff falls in stay until
+    that month expires too. Returns the dropped partitions and the number of deleted rows.
+    """
+    retention_days = settings.ACTIVITY_LOG_RETENTION_DAYS if retention_days is None else retention_days
+    expired = {"partitions": [], "rows": 0}
+    if retention_days <= 0:
+        return expired
+    if db is None:
+        db = SessionLocal()
+        try:
+            return expire_activity_logs(db, retention_days)
+        finally:
+            db.close()
+
+    cutoff = _dt.datetime.now() - _dt.timedelta(days=retention_days)
+    dialect = partitioning(db)
+    if dialect is None:
+        expired["rows"] = delete_activity_logs_before(cutoff, db)
+        return expired
+
+    names = sorted(name for name, month in existing_partitions(db, dialect).items()
+                   if next_month(month) <= cutoff)
+    if names:
+        for statement in drop_partitions_ddl(dialect, names):
+            db.execute(text(statement))
+        db.commit()
+    expired["partitions"] = names
+    return expired
+
+
+def delete_activity_logs_before(cutoff: _dt.datetime, db: Session, chunk_size: int = DELETE_CHUNK_SIZE) -> int:
+    """Delete logs created before `cutoff` a chunk at a time, so no transaction holds the table for long"""
+    deleted = 0
+    while True:
+        chunk = (db.query(Activitylog.id)
+            .filter(Activitylog.created_at < cutoff)
+            .limit(chunk_size)
+            .subquery())
+        count = (db.query(Activitylog)
+            .filter(Activitylog.created_at < cutoff)
+            .filter(Activitylog.id.in_(db.query(chunk.c.id)))
+            .delete(synchronize_session=False))
+        db.commit()
+        deleted += count
+        if count < chunk_size:
+            return deleted
+
+
+def maintain_activity_logs():
+    db = SessionLocal()
+    try:
+        ensure_activity_log_partitions(db)
+        expire_activity_logs(db)
+    finally:
+        db.close()
+
+
+async def activity_log_maintenance_scheduler(interval: int = None):
+    """
+    Create upcoming partitions and expire old logs on startup and then every `interval`
+    seconds (ACTIVITY_LOG_MAINTENANCE_INTERVAL by default). The activity log router
+    starts it on startup.
+    """
+    interval = interval or settings.ACTIVITY_LOG_MAINTENANCE_INTERVAL
+    while True:
+        try:
+            # DDL and chunked deletes can hold the connection for a while
+            await run_in_threadpool(maintain_activity_logs)
+        except Exception:
+            logger.exception("activity log maintenance failed")
+        await asyncio.sleep(interval)
@@ -1,10 +1,23 @@
 import os
 import csv
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import islice
+from typing import BinaryIO, Callable, Dict, List, Optional, Sequence, Tuple
 
 from uuid import uuid4
 
-from bigfastapi.models.data_import_models import FileImports, FailedFileImports
+import fastapi
+import pydantic
+from sqlalchemy import create_engine, func
+from sqlalchemy.exc import IntegrityError
+
+from bigfastapi.db.database import SessionLocal
+from bigfastapi.models.data_import_models import FileImports, FailedFileImports, FileImportChunks, ImportKeys
+from bigfastapi.schemas.imports_progress_schemas import ImportChunkProgress, ImportProgress
 import sqlalchemy.orm as orm
+from bigfastapi.utils import settings
 from bigfastapi.utils.settings import FILES_BASE_FOLDER
 
 MAX_ROWS = 100
@@ -71,12 +84,16 @@ def isEmpty(imports):
 This is to get the file from the folder after querying the imports table
 """
 def retrieve_file(import_filename, bucket_name):
-    folder = os.path.join(os.path.realpath(FILES_BASE_FOLDER), bucket_name, import_filename)
+    folder = import_file_path(import_filename, bucket_name)
     # base_folder = os.path.join(FILES_BASE_FOLDER)
     file = open(folder, "rt")
     return file
 
 
+def import_file_path(import_filename, bucket_name):
+    return os.path.join(os.path.realpath(FILES_BASE_FOLDER), bucket_name, import_filename)
+
+
 
 def total_csv_rows(field):
 
@@ -90,3 +107,438 @@ def total_csv_rows(field):
     return totalrows
 
 
+# =================================== IMPORT ENGINE =================================#
+# import_csv streams a CSV file once, MAX_ROWS records at a time. Every chunk is converted
+# in one call, its rows are bulk inserted together with the failures of the chunk and the
+# import's progress, all in a single transaction. The byte offset committed with the chunk
+# is where an interrupted import resumes, so a crash redoes at most one chunk and memory
+# stays at one chunk whatever the size of the file. Failures are reported on the line of
+# the file their record starts on.
+
+# converts the records of a chunk and their line numbers to model rows,
+# returns the (line, row) pairs to insert and the (line, error) failures
+Converter = Callable[[List[dict], List[int]], Tuple[List[Tuple[int, dict]], List[Tuple[int, str]]]]
+
+
+class CsvRecords:
+    """Iterates the (line, values) records of a binary CSV file from `offset`, keeping the
+    byte offset and the line right after the last record read. Records starting at or
+    after `end` are not read."""
+
+    def __init__(self, file: BinaryIO, offset: int = 0, end: Optional[int] = None, line: int = 1,
+                 encoding: str = "utf-8-sig"):
+        self.file = file
+        self.offset = offset
+        self.end = end
+        self.line = line
+        self.encoding = encoding
+        file.seek(offset)
+        # csv.reader pulls exactly the lines of the record it returns, never more
+        self._reader = csv.reader(self._lines())
+
+    def _lines(self):
+        while self.end is None or self.offset < self.end:
+            line = self.file.readline()
+            if not line:
+                return
+            self.offset += len(line)
+            self.line += 1
+            yield line.decode(self.encoding)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> Tuple[int, List[str]]:
+        line = self.line
+        return line, next(self._reader)
+
+
+def read_csv_header(file: BinaryIO) -> Tuple[List[str], int, int]:
+    """The column names of a CSV file, the byte offset and the line its first record starts at"""
+    records = CsvRecords(file)
+    _, header = next(records, (None, None))
+    if not header:
+        raise fastapi.HTTPException(status_code=400, detail="The import file is empty")
+    return [name.strip() for name in header], records.offset, records.line
+
+
+def new_id() -> str:
+    return uuid4().hex
+
+
+class SchemaConverter:
+    """
+    Convert records by validating them with a pydantic schema. `values` are added to
+    every row, callables are called once per row, e.g. id=new_id. Parallel imports
+    pickle the converter, its values have to be module level functions or plain values.
+    """
+
+    def __init__(self, schema, **values):
+        self.schema = schema
+        self.values = values
+
+    def __call__(self, records: List[dict], lines: List[int]):
+        rows, failures = [], []
+        for record, line in zip(records, lines):
+            try:
+                row = self.schema.parse_obj(record).dict()
+            except pydantic.ValidationError as error:
+                failures.append((line, "; ".join(
+                    f"{'.'.join(map(str, e['loc']))}: {e['msg']}" for e in error.errors())))
+                continue
+            row.update({key: value() if callable(value) else value for key, value in self.values.items()})
+            rows.append((line, row))
+        return rows, failures
+
+
+def schema_converter(schema, **values) -> Converter:
+    return SchemaConverter(schema, **values)
+
+
+def keep_records(records: List[dict], lines: List[int]):
+    """The default converter, records are inserted as they are"""
+    return list(zip(lines, records)), []
+
+
+def import_csv(import_id: str, path: str, model, convert: Converter = None,
+               db: orm.Session = None, chunk_size: int = MAX_ROWS) -> FileImports:
+    """
+    Import the records of the CSV file at `path` into `model`, resuming where the
+    import stopped if it was interrupted. Returns the finished import.
+    """
+    if db is None:
+        db = SessionLocal()
+    convert = convert or keep_records
+
+    file_import = db.get(FileImports, import_id)
+    if file_import is None:
+        raise fastapi.HTTPException(status_code=404, detail="Import does not exist")
+
+    with open(path, "rb") as file:
+        header, data_offset, data_line = read_csv_header(file)
+        file_import.in_progress = True
+        file_import.total_bytes = os.fstat(file.fileno()).st_size
+        db.commit()
+
+        if file_import.current_offset:
+            # current_line is the last line of the last committed chunk
+            records = CsvRecords(file, offset=file_import.current_offset, line=int(file_import.current_line) + 1)
+        else:
+            records = CsvRecords(file, offset=data_offset, line=data_line)
+        while True:
+            chunk = list(islice(records, chunk_size))
+            if not chunk:
+                break
+            try:
+                import_chunk(file_import, model, header, chunk, records, convert, db)
+            except Exception:
+                # the chunk is redone when the import is resumed
+                db.rollback()
+                raise
+
+    file_import.in_progress = False
+    file_import.total_line = str(records.line - 1)
+    file_import.last_updated = datetime.now()
+    db.commit()
+    return file_import
+
+
+def import_chunk(file_import: FileImports, model, header: List[str], chunk: list,
+                 records: CsvRecords, convert: Converter, db: orm.Session):
+    """Write one chunk and the progress it makes in one transaction"""
+    db.query(FileImports).filter(FileImports.id == file_import.id).update({
+        "current_line": str(records.line - 1), "current_offset": records.offset, "last_updated": datetime.now(),
+    }, synchronize_session=False)
+    # the progress update has started the transaction, savepoints taken from here are really nested
+    import_records(file_import.id, model, header, chunk, convert, db)
+    db.commit()
+
+
+def import_records(import_id: str, model, header: List[str], chunk: list, convert: Converter,
+                   db: orm.Session, unique: Sequence[str] = None) -> Tuple[int, int]:
+    """
+    Convert and insert the (line, values) records of a chunk and log its failures, the
+    caller commits. With `unique`, only the first line of the import holding a key is
+    inserted, see claim_keys. Returns the number of rows inserted and of failed lines.
+    """
+    records, lines, failures = [], [], []
+    for line, values in chunk:
+        if not any(value.strip() for value in values):
+            continue
+        if len(values) != len(header):
+            failures.append((line, f"expected {len(header)} columns, found {len(values)}"))
+            continue
+        records.append(dict(zip(header, values)))
+        lines.append(line)
+
+    rows, invalid = convert(records, lines) if records else ([], [])
+    failures.extend(invalid)
+
+    if unique and rows:
+        owners = key_owners(import_id, [row_key(row, unique) for _, row in rows], db)
+        owned = []
+        for line, row in rows:
+            owner = owners.get(row_key(row, unique), line)
+            if owner == line:
+                owned.append((line, row))
+            else:
+                failures.append((line, f"duplicate of line {owner}"))
+        rows = owned
+
+    try:
+        with db.begin_nested():
+            db.bulk_insert_mappings(model, [row for _, row in rows])
+    except IntegrityError:
+        conflicts = insert_rows_one_by_one(model, rows, db)
+        failures.extend(conflicts)
+        rows = rows[:len(rows) - len(conflicts)]
+
+    log_import_errors(import_id, failures, db)
+    return len(rows), len(failures)
+
+
+def insert_rows_one_by_one(model, rows: List[Tuple[int, dict]], db: orm.Session) -> List[Tuple[int, str]]:
+    """Insert the rows of a chunk that conflicted as a whole, returns the rows that conflict"""
+    conflicts = []
+    for line, row in rows:
+        try:
+            with db.begin_nested():
+                db.bulk_insert_mappings(model, [row])
+        except IntegrityError as error:
+            conflicts.append((line, str(error.orig)))
+    return conflicts
+
+
+def log_import_errors(import_id: str, failures: List[Tuple[int, str]], db: orm.Session):
+    """Add the failed lines of an import in one insert, the caller commits"""
+    if not failures:
+        return
+    now = datetime.now()
+    db.bulk_insert_mappings(FailedFileImports, [
+        dict(id=uuid4().hex, import_id=import_id, line=str(line), error=str(error)[:255],
+             is_deleted=False, date_created=now, last_updated=now)
+        for line, error in failures
+    ])
+
+
+# =================================== PARALLEL IMPORTS =================================#
+# import_csv_parallel splits a file into byte ranges of about IMPORT_CHUNK_BYTES that end
+# on record boundaries and imports them in a pool of IMPORT_WORKERS processes. Each range
+# is converted, inserted and marked done in one transaction of its own, and adds its bytes
+# to the import's current_offset. A resumed import only redoes the ranges not marked done.
+#
+# Ranges finish in any order, so when `unique` names the columns that identify a row, the
+# winner of a duplicate key must not depend on timing: every range first records the line
+# of each of its keys in import_keys, then every range inserts only the rows whose line is
+# the first one holding their key. Later duplicates fail with the line they duplicate,
+# exactly as a sequential import would report them.
+
+BLOCK_SIZE = 1024 * 1024
+
+_engines = {}
+
+
+def split_csv(path: str, offset: int, line: int, chunk_bytes: int) -> Tuple[List[Tuple[int, int, int]], int]:
+    """
+    Split a CSV file from `offset` into (start, end, first line) byte ranges of about
+    `chunk_bytes` that end on a record boundary, returns the ranges and the last line of
+    the file. Quotes are escaped by doubling them, so a newline ends a record exactly
+    when an even number of quotes comes before it.
+    """
+    ranges = []
+    start, start_line = offset, line
+    position, quoted, newline_ended = offset, False, True
+    target = start + chunk_bytes
+
+    with open(path, "rb") as file:
+        file.seek(offset)
+        while True:
+            block = file.read(BLOCK_SIZE)
+            if not block:
+                break
+            index = 0
+            while index < len(block):
+                if position < target:
+                    # nothing to look for before the target, count whole stretches at once
+                    part = block[index:index + target - position]
+                else:
+                    newline = block.find(b"\n", index)
+                    part = block[index:] if newline == -1 else block[index:newline + 1]
+                quoted ^= part.count(b'"') % 2 == 1
+                line += part.count(b"\n")
+                position += len(part)
+                index += len(part)
+                newline_ended = part.endswith(b"\n")
+                if position >= target and newline_ended and not quoted:
+                    ranges.append((start, position, start_line))
+                    start, start_line = position, line
+                    target = position + chunk_bytes
+
+    if position > start:
+        ranges.append((start, position, start_line))
+    # when the file ends with a newline there is no record on the line after it
+    return ranges, line - 1 if newline_ended else line
+
+
+def row_key(row: dict, unique: Sequence[str]) -> str:
+    return hashlib.sha256("\x1f".join(str(row.get(column)) for column in unique).encode()).hexdigest()
+
+
+def key_owners(import_id: str, keys: List[str], db: orm.Session) -> Dict[str, int]:
+    """The first line of the import each key was seen on"""
+    return dict(db.query(ImportKeys.key, func.min(ImportKeys.line))
+        .filter(ImportKeys.import_id == import_id)
+        .filter(ImportKeys.key.in_(set(keys)))
+        .group_by(ImportKeys.key))
+
+
+def import_csv_parallel(import_id: str, path: str, model, convert: Converter = None,
+                        unique: Sequence[str] = None, db: orm.Session = None,
+                        workers: int = None, chunk_bytes: int = None) -> FileImports:
+    """
+    Import the CSV file at `path` into `model` with a pool of worker processes, see
+    above. The model and converter are pickled to the workers. Returns the finished import.
+    """
+    workers = workers or settings.IMPORT_WORKERS
+    chunk_bytes = chunk_bytes or settings.IMPORT_CHUNK_BYTES
+    if db is None:
+        db = SessionLocal()
+    convert = convert or keep_records
+
+    file_import = db.get(FileImports, import_id)
+    if file_import is None:
+        raise fastapi.HTTPException(status_code=404, detail="Import does not exist")
+
+    with open(path, "rb") as file:
+        header, data_offset, data_line = read_csv_header(file)
+        total_bytes = os.fstat(file.fileno()).st_size
+
+    if not db.query(FileImportChunks.id).filter(FileImportChunks.import_id == import_id).first():
+        ranges, last_line = split_csv(path, data_offset, data_line, chunk_bytes)
+        now = datetime.now()
+        db.bulk_insert_mappings(FileImportChunks, [
+            dict(id=uuid4().hex, import_id=import_id, start=start, end=end, first_line=first_line,
+                 status="pending", rows=0, failed=0, last_updated=now)
+            for start, end, first_line in ranges
+        ])
+        file_import.current_offset = data_offset
+        file_import.total_line = str(last_line)
+    file_import.in_progress = True
+    file_import.total_bytes = total_bytes
+    db.commit()
+
+    task = (db.get_bind().url.render_as_string(hide_password=False), import_id, path, model, header, convert, unique)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        if unique:
+            pool_map(pool, claim_chunk_keys, task, chunk_statuses(import_id, ["pending"], db))
+            # a key of a range that could not be claimed may own rows of any other range
+            if chunk_statuses(import_id, ["pending"], db):
+                return file_import
+        pool_map(pool, import_csv_chunk, task, chunk_statuses(
+            import_id, ["claimed", "failed"] if unique else ["pending", "failed"], db))
+
+    if not chunk_statuses(import_id, ["pending", "claimed", "failed"], db):
+        db.query(ImportKeys).filter(ImportKeys.import_id == import_id).delete(synchronize_session=False)
+        file_import.in_progress = False
+    file_import.last_updated = datetime.now()
+    db.commit()
+    db.refresh(file_import)
+    return file_import
+
+
+def chunk_statuses(import_id: str, statuses: List[str], db: orm.Session) -> List[str]:
+    """The ids of the ranges of an import in one of `statuses`, in file order"""
+    chunk_ids = [chunk_id for (chunk_id,) in db.query(FileImportChunks.id)
+        .filter(FileImportChunks.import_id == import_id)
+        .filter(FileImportChunks.status.in_(statuses))
+        .order_by(FileImportChunks.start)]
+    db.commit()
+    return chunk_ids
+
+
+def pool_map(pool: ProcessPoolExecutor, work: Callable, task: tuple, chunk_ids: List[str]):
+    # a range that fails is recorded on its chunk and the others carry on
+    list(pool.map(work, [(*task, chunk_id) for chunk_id in chunk_ids]))
+
+
+def worker_session(url: str) -> orm.Session:
+    """A session on the import's database, one engine per worker process"""
+    if url not in _engines:
+        _engines[url] = create_engine(url, pool_pre_ping=True)
+    return orm.Session(bind=_engines[url])
+
+
+def read_chunk(path: str, chunk: FileImportChunks, size: int = MAX_ROWS):
+    """The (line, values) records of a range, `size` at a time"""
+    with open(path, "rb") as file:
+        records = CsvRecords(file, offset=chunk.start, end=chunk.end, line=chunk.first_line)
+        while True:
+            batch = list(islice(records, size))
+            if not batch:
+                return
+            yield batch
+
+
+def claim_chunk_keys(task):
+    """Record the line of every unique key of a range, in the range's own transaction"""
+    url, import_id, path, model, header, convert, unique, chunk_id = task
+    with worker_session(url) as db:
+        chunk = db.get(FileImportChunks, chunk_id)
+        try:
+            for batch in read_chunk(path, chunk):
+                records = [(line, dict(zip(header, values))) for line, values in batch
+                           if len(values) == len(header) and any(value.strip() for value in values)]
+                rows, _ = convert([record for _, record in records], [line for line, _ in records])
+                db.bulk_insert_mappings(ImportKeys, [
+                    dict(import_id=import_id, line=line, key=row_key(row, unique)) for line, row in rows])
+            chunk.status = "claimed"
+            chunk.last_updated = datetime.now()
+            db.commit()
+        except Exception as error:
+            db.rollback()
+            fail_chunk(chunk_id, error, "pending", db)
+
+
+def import_csv_chunk(task):
+    """Import a range in one transaction, adding its bytes to the import's progress"""
+    url, import_id, path, model, header, convert, unique, chunk_id = task
+    with worker_session(url) as db:
+        chunk = db.get(FileImportChunks, chunk_id)
+        try:
+            rows = failed = 0
+            chunk.status = "done"
+            chunk.error = None
+            chunk.last_updated = datetime.now()
+            db.flush()
+            for batch in read_chunk(path, chunk):
+                inserted, invalid = import_records(import_id, model, header, batch, convert, db, unique=unique)
+                rows, failed = rows + inserted, failed + invalid
+            chunk.rows, chunk.failed = rows, failed
+            db.query(FileImports).filter(FileImports.id == import_id).update({
+                "current_offset": FileImports.current_offset + (chunk.end - chunk.start),
+                "last_updated": datetime.now(),
+            }, synchronize_session=False)
+            db.commit()
+        except Exception as error:
+            db.rollback()
+            fail_chunk(chunk_id, error, "failed", db)
+
+
+def fail_chunk(chunk_id: str, error: Exception, status: str, db: orm.Session):
+    db.query(FileImportChunks).filter(FileImportChunks.id == chunk_id).update({
+        "status": status, "error": str(error)[:255], "last_updated": datetime.now(),
+    }, synchronize_session=False)
+    db.commit()
+
+
+def get_import_progress(import_id: str, db: orm.Session) -> ImportProgress:
+    """An import with the status of each of its ranges, only parallel imports have ranges"""
+    file_import = db.get(FileImports, import_id)
+    if file_import is None:
+        raise fastapi.HTTPException(status_code=404, detail="Import does not exist")
+
+    progress = ImportProgress.from_orm(file_import)
+    progress.chunks = [ImportChunkProgress.from_orm(chunk) for chunk in db.query(FileImportChunks)
+        .filter(FileImportChunks.import_id == import_id)
+        .order_by(FileImportChunks.start)]
+    return progress
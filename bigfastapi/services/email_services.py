@@ -86,3 +86,15 @@ async def send_email(
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(ex)
         ) from ex
+
+
+async def send_html_email(title: str, recipients: list, html: str, attachments: list = None):
+    """Send html that is already rendered, returns once the mail server has it"""
+    message = MessageSchema(
+        subject=title,
+        recipients=recipients,
+        body=html,
+        subtype="html",
+        attachments=attachments or [],
+    )
+    await FastMail(conf).send_message(message)
@@ -0,0 +1,205 @@
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime
+from typing import Dict, Optional
+from uuid import uuid4
+
+import httpx
+import sqlalchemy.orm as orm
+
+from bigfastapi.db.database import SessionLocal
+from bigfastapi.models.credit_wallet_models import CreditWalletConversion
+from bigfastapi.utils import settings
+
+logger = logging.getLogger(__name__)
+
+# ================================== EXCHANGE RATES =================================#
+# Credit rates of currencies other than USD follow the market: the rate of a currency is
+# the USD credit rate times the number of units of the currency a dollar buys. The market
+# rates of every currency are fetched in one call, kept in memory for EXCHANGE_RATE_TTL
+# seconds and written to credit_wallet_conversions, one row per currency. Reading a rate
+# never waits on the provider: a stale cache is refreshed in the background, and however
+# many requests find it stale, only one refresh runs at a time. Rates set by a super user
+# are left as they are.
+
+
+class CurrencyApiProvider:
+    """Market rates per USD from currencyapi.com"""
+
+    def __init__(self, api_key: str, url: str = None, timeout: float = 10):
+        self.api_key = api_key
+        self.url = url or settings.EXCHANGE_RATE_API_URL
+        self.timeout = timeout
+
+    async def fetch(self) -> Dict[str, float]:
+        async with httpx.AsyncClient(timeout=self.timeout) as client:
+            response = await client.get(self.url, params={"apikey": self.api_key})
+            response.raise_for_status()
+        rates = response.json()["data"]
+        # v2 maps codes to rates, v3 to objects with the rate as their value
+        return {code.upper(): float(rate["value"] if isinstance(rate, dict) else rate) for code, rate in rates.items()}
+
+
+class FixtureRateProvider:
+    """Fixed market rates per USD, given or read from a JSON file, for tests and development"""
+
+    def __init__(self, rates: Dict[str, float] = None, path: str = None):
+        if path:
+            with open(path) as file:
+                rates = json.load(file)
+        self.rates = {code.upper(): float(rate) for code, rate in (rates or {}).items()}
+        self.calls = 0
+
+    async def fetch(self) -> Dict[str, float]:
+        self.calls += 1
+        return dict(self.rates)
+
+
+def default_provider():
+    if settings.EXCHANGE_RATE_FIXTURE:
+        return FixtureRateProvider(path=settings.EXCHANGE_RATE_FIXTURE)
+    if settings.FREECURRENCY_API_KEY.strip():
+        return CurrencyApiProvider(settings.FREECURRENCY_API_KEY)
+    return None
+
+
+class ExchangeRates:
+    """Market rates per USD held in memory, refreshed from a provider once they are older than `ttl` seconds"""
+
+    def __init__(self, provider=None, ttl: float = None):
+        self.provider = provider
+        self.ttl = settings.EXCHANGE_RATE_TTL if ttl is None else ttl
+        self._rates: Dict[str, float] = {}
+        self._fetched_at: Optional[float] = None
+        self._refreshing: Optional[asyncio.Task] = None
+        self._retry_at = 0.0
+
+    def use(self, provider):
+        """Switch provider, forgetting the rates of the previous one"""
+        self.provider = provider
+        self._rates = {}
+        self._fetched_at = None
+        self._refreshing = None
+        self._retry_at = 0.0
+
+    def get(self, currency: str) -> Optional[float]:
+        """The cached rate of a currency, starting a background refresh when the cache is stale"""
+        if self.stale:
+            self.refresh_soon()
+        return self._rates.get(currency.upper())
+
+    @property
+    def stale(self) -> bool:
+        return self._fetched_at is None or time.monotonic() - self._fetched_at > self.ttl
+
+    async def refresh(self, db: orm.Session = None) -> Dict[str, float]:
+        """Fetch the rates of every currency and store them, joining the refresh that is running if any"""
+        if self.provider is None:
+            return dict(self._rates)
+        refreshing = self._refreshing
+        if refreshing is None or refreshing.done() or refreshing.get_loop() is not asyncio.get_running_loop():
+            refreshing = self._refreshing = asyncio.ensure_future(self._refresh(db))
+        return await asyncio.shield(refreshing)
+
+    def refresh_soon(self):
+        """Refresh in the background when called from the event loop, returns at once"""
+        # after a failure the provider is left alone for a while
+        if self.provider is None or time.monotonic() < self._retry_at:
+            return
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        task = asyncio.ensure_future(self.refresh())
+        task.add_done_callback(log_refresh_failure)
+
+    async def _refresh(self, db: orm.Session = None) -> Dict[str, float]:
+        try:
+            rates = await self.provider.fetch()
+        except Exception:
+            self._retry_at = time.monotonic() + min(60, self.ttl)
+            raise
+        rates["USD"] = 1.0
+        self._rates = rates
+        self._fetched_at = time.monotonic()
+
+        close = db is None
+        db = db or SessionLocal()
+        try:
+            store_market_rates(rates, db)
+        finally:
+            if close:
+                db.close()
+        return dict(rates)
+
+
+def log_refresh_failure(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("could not refresh exchange rates", exc_info=task.exception())
+
+
+exchange_rates = ExchangeRates(default_provider())
+
+
+def store_market_rates(rates: Dict[str, float], db: orm.Session) -> int:
+    """Upsert the credit rate of every currency that is not set by hand, returns the number of rates written"""
+    usd = find_conversion("USD", db)
+    if usd is None:
+        return 0
+
+    conversions: Dict[str, list] = {}
+    for conversion in db.query(CreditWalletConversion).filter(CreditWalletConversion.currency_code != "USD"):
+        conversions.setdefault(conversion.currency_code.upper(), []).append(conversion)
+
+    written = 0
+    for currency, market_rate in rates.items():
+        if currency == "USD" or len(currency) > 4:
+            continue
+        rows = conversions.get(currency, [])
+        if any(row.source == "manual" for row in rows):
+            continue
+        # rates fetched before this service each got a row of their own, one is kept
+        rows.sort(key=lambda row: row.source != "market")
+        for duplicate in rows[1:]:
+            db.delete(duplicate)
+        conversion = rows[0] if rows else CreditWalletConversion(id=uuid4().hex, currency_code=currency)
+        if not rows:
+            db.add(conversion)
+        conversion.currency_code = currency
+        conversion.rate = usd.rate * market_rate
+        conversion.source = "market"
+        conversion.last_updated = datetime.utcnow()
+        written += 1
+    db.commit()
+    return written
+
+
+def find_conversion(currency: str, db: orm.Session) -> Optional[CreditWalletConversion]:
+    return db.query(CreditWalletConversion).filter(CreditWalletConversion.currency_code == currency.upper()).first()
+
+
+def credit_rate(currency: str, db: orm.Session) -> Optional[CreditWalletConversion]:
+    """The credit rate of a currency, from the database or the cached market rates, without waiting on the provider"""
+    currency = currency.upper()
+    conversion = find_conversion(currency, db)
+    market_rate = exchange_rates.get(currency)
+    if conversion is None and market_rate is not None and currency != "USD":
+        store_market_rates({currency: market_rate}, db)
+        conversion = find_conversion(currency, db)
+    return conversion
+
+
+async def exchange_rate_scheduler(interval: int = None):
+    """
+    Refresh exchange rates every `interval` seconds (EXCHANGE_RATE_TTL by default).
+    The credit router starts it on startup.
+    """
+    interval = interval or settings.EXCHANGE_RATE_TTL
+    while True:
+        try:
+            await exchange_rates.refresh()
+        except Exception:
+            logger.exception("could not refresh exchange rates")
+        await asyncio.sleep(interval)
@@ -0,0 +1,286 @@
+import csv
+import io
+import json
+import os
+import re
+import zipfile
+from datetime import datetime, timedelta
+from typing import Callable, Iterable, List, NamedTuple
+from uuid import uuid4
+from xml.sax.saxutils import escape
+
+import fastapi
+import sqlalchemy.orm as orm
+from sqlalchemy import func, or_, select, update
+
+from bigfastapi.db.database import SessionLocal
+from bigfastapi.models.data_import_models import FileExports
+from bigfastapi.models.file_models import File, find_file
+from bigfastapi.models.receipt_models import Receipt
+from bigfastapi.models.wallet_models import Wallet, WalletTransaction
+from bigfastapi.schemas.imports_progress_schemas import ExportProgress
+from bigfastapi.utils import settings
+
+# =================================== EXPORT ENGINE =================================#
+# run_export walks the rows of a report in primary key order, EXPORT_CHUNK_SIZE at a time,
+# and appends each chunk to the export's file in the file store. last_id, the number of
+# rows and the size of the file are committed after every chunk, so an interrupted export
+# truncates the file back to the last commit and carries on after last_id. CSV and NDJSON
+# are written straight to the file, XLSX rows are spooled as NDJSON and zipped once the
+# last chunk is in; the spool is only removed once the workbook is registered, so a rerun
+# can always rebuild it. The file is registered as a File once the export is complete.
+# A worker claims an export before writing it, and holds it for EXPORT_LEASE seconds
+# after its last commit, so one export is never written by two workers at once.
+
+FORMATS = ["csv", "ndjson", "xlsx"]
+# rows per worksheet, one is left for the header
+XLSX_MAX_ROWS = 1048576 - 1
+XLSX_ILLEGAL_CHARS = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+
+class ExportReport(NamedTuple):
+    # the columns of the report, the first one is the key the export walks in order
+    columns: List
+    # the filters that scope the report to an organization
+    scope: Callable[[str], list]
+    joins: list = []
+
+
+REPORTS = {
+    "receipts": ExportReport(
+        columns=[Receipt.id, Receipt.sender_email, Receipt.recipient, Receipt.subject,
+                 Receipt.message, Receipt.date_created],
+        scope=lambda organization_id: [Receipt.organization_id == organization_id, Receipt.is_deleted == False],
+    ),
+    "transactions": ExportReport(
+        columns=[WalletTransaction.id, WalletTransaction.wallet_id, WalletTransaction.amount,
+                 WalletTransaction.currency_code, WalletTransaction.status, WalletTransaction.transaction_ref,
+                 WalletTransaction.transaction_date],
+        scope=lambda organization_id: [Wallet.organization_id == organization_id],
+        joins=[(Wallet, Wallet.id == WalletTransaction.wallet_id)],
+    ),
+}
+
+
+def create_export(organization_id: str, user_id: str, report_type: str, format: str = "csv",
+                  db: orm.Session = None) -> FileExports:
+    if report_type not in REPORTS:
+        raise fastapi.HTTPException(status_code=400, detail=f"Reports that can be exported are {', '.join(REPORTS)}")
+    if format not in FORMATS:
+        raise fastapi.HTTPException(status_code=400, detail=f"Exports can be written as {', '.join(FORMATS)}")
+    if db is None:
+        db = SessionLocal()
+
+    export_id = uuid4().hex
+    export = FileExports(
+        id=export_id, organization_id=organization_id, user_id=user_id, report_type=report_type,
+        file_name=f"{report_type}-{export_id}.{format}", settings={"format": format},
+        current_line="0", current_offset=0, in_progress=False,
+        date_created=datetime.now(), last_updated=datetime.now(),
+    )
+    db.add(export)
+    db.commit()
+    db.refresh(export)
+    return export
+
+
+def run_export(export_id: str, db: orm.Session = None, chunk_size: int = None) -> FileExports:
+    """Write an export, or finish it when it was interrupted. Returns the finished export."""
+    chunk_size = chunk_size or settings.EXPORT_CHUNK_SIZE
+    if db is None:
+        db = SessionLocal()
+
+    export = db.get(FileExports, export_id)
+    if export is None:
+        raise fastapi.HTTPException(status_code=404, detail="Export does not exist")
+    report = REPORTS[export.report_type]
+    format = export.settings["format"]
+
+    path = export_file_path(export.file_name)
+    data_path = path if format != "xlsx" else f"{path}.ndjson"
+    header = [column.key for column in report.columns]
+
+    if export.file_id:
+        remove_spool(path, data_path)
+        return export
+    if not claim_export(export_id, db):
+        raise fastapi.HTTPException(status_code=409, detail="Export is already being written")
+
+    if (os.path.getsize(data_path) if os.path.exists(data_path) else 0) < (export.current_offset or 0):
+        # rows that were committed are missing from the file, write it again from the start
+        export.last_id, export.current_line, export.current_offset = None, "0", 0
+    if export.totat_count is None:
+        export.totat_count = str(db.execute(report_query(report, export.organization_id, func.count())).scalar())
+    db.commit()
+
+    with open(data_path, "ab") as file:
+        # whatever was written after the last commit is written again
+        file.truncate(export.current_offset or 0)
+        file.seek(export.current_offset or 0)
+        if not export.current_offset and format == "csv":
+            file.write(csv_lines([header]))
+
+        while True:
+            query = report_query(report, export.organization_id, *report.columns)
+            if export.last_id:
+                query = query.where(report.columns[0] > export.last_id)
+            rows = db.execute(query.order_by(report.columns[0]).limit(chunk_size)).all()
+            if not rows:
+                break
+
+            file.write(csv_lines(rows) if format == "csv" else ndjson_lines(header, rows))
+            file.flush()
+            os.fsync(file.fileno())
+
+            export.last_id = rows[-1][0]
+            export.current_line = str(int(export.current_line or 0) + len(rows))
+            export.current_offset = file.tell()
+            export.last_updated = datetime.now()
+            db.commit()
+
+    if format == "xlsx":
+        # built aside and moved in place, a workbook at `path` is always a complete one
+        write_xlsx(f"{path}.part", header, read_ndjson(data_path))
+        os.replace(f"{path}.part", path)
+
+    export.file_id = register_file(export.file_name, path, db).id
+    export.in_progress = False
+    export.last_updated = datetime.now()
+    db.commit()
+    remove_spool(path, data_path)
+    return export
+
+
+def claim_export(export_id: str, db: orm.Session) -> bool:
+    """Take an unfinished export that no worker is writing, or whose worker went quiet for EXPORT_LEASE seconds"""
+    now = datetime.now()
+    claimed = db.execute(
+        update(FileExports)
+        .where(FileExports.id == export_id, FileExports.file_id.is_(None),
+               or_(FileExports.in_progress.isnot(True),
+                   FileExports.last_updated < now - timedelta(seconds=settings.EXPORT_LEASE)))
+        .values(in_progress=True, last_updated=now)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.commit()
+    return claimed > 0
+
+
+def remove_spool(path: str, data_path: str):
+    if data_path != path and os.path.exists(data_path):
+        os.remove(data_path)
+
+
+def report_query(report: ExportReport, organization_id: str, *columns):
+    query = select(*columns).select_from(report.columns[0].class_)
+    for target, on in report.joins:
+        query = query.join(target, on)
+    return query.where(*report.scope(organization_id))
+
+
+def export_file_path(file_name: str) -> str:
+    folder = os.path.join(os.path.realpath(settings.FILES_BASE_FOLDER), settings.EXPORT_BUCKET)
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, file_name)
+
+
+def register_file(file_name: str, path: str, db: orm.Session) -> File:
+    file = find_file(settings.EXPORT_BUCKET, file_name, db)
+    if file is None:
+        file = File(id=uuid4().hex, filename=file_name, bucketname=settings.EXPORT_BUCKET)
+        db.add(file)
+    file.filesize = os.path.getsize(path)
+    file.last_updated = datetime.utcnow()
+    db.flush()
+    return file
+
+
+def csv_lines(rows: Iterable) -> bytes:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue().encode()
+
+
+def ndjson_lines(header: List[str], rows: Iterable) -> bytes:
+    return "".join(json.dumps(dict(zip(header, row)), default=str) + "\n" for row in rows).encode()
+
+
+def read_ndjson(path: str):
+    with open(path, "rb") as file:
+        for line in file:
+            yield json.loads(line)
+
+
+def write_xlsx(path: str, header: List[str], rows: Iterable[dict]):
+    """Write rows to an XLSX workbook one at a time, starting a new sheet every XLSX_MAX_ROWS rows"""
+    sheets = 0
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as workbook:
+        rows = iter(rows)
+        row = next(rows, None)
+        while sheets == 0 or row is not None:
+            sheets += 1
+            with workbook.open(f"xl/worksheets/sheet{sheets}.xml", "w", force_zip64=True) as sheet:
+                sheet.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                            b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                            b'<sheetData>')
+                sheet.write(xlsx_row(header))
+                written = 0
+                while row is not None and written < XLSX_MAX_ROWS:
+                    sheet.write(xlsx_row([row.get(column) for column in header]))
+                    written += 1
+                    row = next(rows, None)
+                sheet.write(b"</sheetData></worksheet>")
+
+        workbook.writestr("[Content_Types].xml", (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            + "".join(f'<Override PartName="/xl/worksheets/sheet{i}.xml" '
+                      'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+                      for i in range(1, sheets + 1))
+            + '</Types>'))
+        workbook.writestr("_rels/.rels", (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Target="xl/workbook.xml" '
+            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+            '</Relationships>'))
+        workbook.writestr("xl/workbook.xml", (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"><sheets>'
+            + "".join(f'<sheet name="Sheet{i}" sheetId="{i}" r:id="rId{i}"/>' for i in range(1, sheets + 1))
+            + '</sheets></workbook>'))
+        workbook.writestr("xl/_rels/workbook.xml.rels", (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            + "".join(f'<Relationship Id="rId{i}" Target="worksheets/sheet{i}.xml" '
+                      'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"/>'
+                      for i in range(1, sheets + 1))
+            + '</Relationships>'))
+
+
+def xlsx_row(values: list) -> bytes:
+    cells = []
+    for value in values:
+        if value is None:
+            cells.append("<c/>")
+        elif isinstance(value, bool):
+            cells.append(f'<c t="b"><v>{int(value)}</v></c>')
+        elif isinstance(value, (int, float)):
+            cells.append(f"<c><v>{value}</v></c>")
+        else:
+            text = escape(XLSX_ILLEGAL_CHARS.sub("", str(value)))
+            cells.append(f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>')
+    return f"<row>{''.join(cells)}</row>".encode()
+
+
+def get_export_progress(export_id: str, db: orm.Session) -> ExportProgress:
+    """How many rows of an export are written, the file is set once it is complete"""
+    export = db.get(FileExports, export_id)
+    if export is None:
+        raise fastapi.HTTPException(status_code=404, detail="Export does not exist")
+    return ExportProgress.from_orm(export)
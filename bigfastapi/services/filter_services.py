@@ -0,0 +1,346 @@
+import re
+import threading
+import time
+from datetime import datetime
+from functools import lru_cache
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+from uuid import uuid4
+
+import fastapi
+import sqlalchemy.orm as orm
+from sqlalchemy import Boolean, DateTime, Integer, and_, event, func, not_, or_, select
+from sqlalchemy.engine import Engine
+
+from bigfastapi.models.bank_models import BankModels
+from bigfastapi.models.filter_models import SavedFilter
+from bigfastapi.models.notification_models import Notification
+from bigfastapi.models.receipt_models import Receipt
+from bigfastapi.schemas import filter_schemas
+from bigfastapi.utils import settings
+
+# =================================== SAVED FILTERS =================================#
+# A saved filter is a query over one table of an organization, written in a small DSL:
+#
+#     subject contains "invoice" and (recipient = "ada@example.com" or not is_preferred = true)
+#
+# Conditions compare a field with =, !=, <, <=, >, >=, contains or startswith, test it with
+# `in (...)` or `is [not] null`, and combine with and, or, not and parentheses. A filter is
+# parsed and compiled to a select over its table once, when it is first run after being
+# saved or changed, and the statement is kept in an LRU cache of FILTER_CACHE_SIZE filters.
+# The number of rows a filter matches is cached until something writes to its table, or
+# for FILTER_COUNT_TTL seconds as writes made by other processes are not seen.
+
+
+class FilterTable(NamedTuple):
+    model: object
+    # the fields a filter can use, by name
+    fields: Dict[str, object]
+    # the conditions that scope the table to an organization
+    scope: Callable[[str], list]
+
+
+def model_fields(model, *names) -> Dict[str, object]:
+    return {name: getattr(model, name) for name in names}
+
+
+FILTER_TABLES = {
+    "receipts": FilterTable(
+        model=Receipt,
+        fields=model_fields(Receipt, "id", "sender_email", "recipient", "subject", "message", "date_created"),
+        scope=lambda organization_id: [Receipt.organization_id == organization_id, Receipt.is_deleted == False],
+    ),
+    "banks": FilterTable(
+        model=BankModels,
+        fields=model_fields(BankModels, "id", "account_number", "bank_name", "recipient_name", "country", "currency",
+                            "bank_type", "account_type", "is_preferred", "date_created"),
+        scope=lambda organization_id: [BankModels.organization_id == organization_id, BankModels.is_deleted == False],
+    ),
+    "notifications": FilterTable(
+        model=Notification,
+        fields=model_fields(Notification, "id", "creator_id", "message", "access_level", "module", "target",
+                            "occurrences", "date_created"),
+        scope=lambda organization_id: [Notification.organization_id == organization_id],
+    ),
+}
+
+MAX_CONDITIONS = 50
+
+TOKEN = re.compile(r"""\s*(?:
+    (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+    |(?P<number>-?\d+(?:\.\d+)?(?![\w.]))
+    |(?P<symbol>!=|<=|>=|=|<|>|\(|\)|,)
+    |(?P<word>[A-Za-z_][A-Za-z0-9_]*)
+)""", re.VERBOSE)
+COMPARISONS = {
+    "=": lambda column, value: column == value,
+    "!=": lambda column, value: column != value,
+    "<": lambda column, value: column < value,
+    "<=": lambda column, value: column <= value,
+    ">": lambda column, value: column > value,
+    ">=": lambda column, value: column >= value,
+    "contains": lambda column, value: column.contains(value, autoescape=True),
+    "startswith": lambda column, value: column.startswith(value, autoescape=True),
+}
+KEYWORDS = {"and", "or", "not", "in", "is", "null", "true", "false", "contains", "startswith"}
+
+
+class FilterSyntaxError(ValueError):
+    pass
+
+
+def tokenize(query: str) -> List[Tuple[str, object]]:
+    tokens, position = [], 0
+    query = query.rstrip()
+    while position < len(query):
+        match = TOKEN.match(query, position)
+        if match is None or match.end() == position:
+            raise FilterSyntaxError(f"Unexpected character at {position + 1}: {query[position:position + 10]!r}")
+        position = match.end()
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind == "string":
+            tokens.append(("value", re.sub(r"\\(.)", r"\1", text[1:-1])))
+        elif kind == "number":
+            tokens.append(("value", float(text) if "." in text else int(text)))
+        elif kind == "word" and text.lower() in ("true", "false"):
+            tokens.append(("value", text.lower() == "true"))
+        elif kind == "word" and text.lower() in KEYWORDS:
+            tokens.append(("keyword", text.lower()))
+        elif kind == "word":
+            tokens.append(("field", text))
+        else:
+            tokens.append(("symbol", text))
+    return tokens
+
+
+class Parser:
+    """Recursive descent parser of the filter DSL, builds a tree of tuples"""
+
+    def __init__(self, query: str):
+        self.tokens = tokenize(query)
+        self.position = 0
+        self.conditions = 0
+
+    def parse(self):
+        if not self.tokens:
+            raise FilterSyntaxError("The filter is empty")
+        tree = self.disjunction()
+        if self.position < len(self.tokens):
+            raise FilterSyntaxError(f"Unexpected {self.tokens[self.position][1]!r}")
+        return tree
+
+    def peek(self, kind: str = None, value=None) -> bool:
+        if self.position >= len(self.tokens):
+            return False
+        token_kind, token_value = self.tokens[self.position]
+        return (kind is None or token_kind == kind) and (value is None or token_value == value)
+
+    def take(self, kind: str, value=None, expected: str = None):
+        if not self.peek(kind, value):
+            found = repr(self.tokens[self.position][1]) if self.position < len(self.tokens) else "the end"
+            raise FilterSyntaxError(f"Expected {expected or value or kind}, found {found}")
+        self.position += 1
+        return self.tokens[self.position - 1][1]
+
+    def disjunction(self):
+        terms = [self.conjunction()]
+        while self.peek("keyword", "or"):
+            self.position += 1
+            terms.append(self.conjunction())
+        return terms[0] if len(terms) == 1 else ("or", terms)
+
+    def conjunction(self):
+        terms = [self.negation()]
+        while self.peek("keyword", "and"):
+            self.position += 1
+            terms.append(self.negation())
+        return terms[0] if len(terms) == 1 else ("and", terms)
+
+    def negation(self):
+        if self.peek("keyword", "not"):
+            self.position += 1
+            return ("not", self.negation())
+        if self.peek("symbol", "("):
+            self.position += 1
+            tree = self.disjunction()
+            self.take("symbol", ")")
+            return tree
+        return self.condition()
+
+    def condition(self):
+        self.conditions += 1
+        if self.conditions > MAX_CONDITIONS:
+            raise FilterSyntaxError(f"A filter has at most {MAX_CONDITIONS} conditions")
+        field = self.take("field", expected="a field name")
+
+        if self.peek("keyword", "is"):
+            self.position += 1
+            negated = self.peek("keyword", "not")
+            if negated:
+                self.position += 1
+            self.take("keyword", "null")
+            return ("null", field, negated)
+
+        if self.peek("keyword", "in"):
+            self.position += 1
+            self.take("symbol", "(")
+            values = [self.take("value", expected="a value")]
+            while self.peek("symbol", ","):
+                self.position += 1
+                values.append(self.take("value", expected="a value"))
+            self.take("symbol", ")")
+            return ("in", field, values)
+
+        if self.peek("symbol") and self.tokens[self.position][1] in COMPARISONS:
+            operator = self.take("symbol")
+        elif self.peek("keyword") and self.tokens[self.position][1] in COMPARISONS:
+            operator = self.take("keyword")
+        else:
+            raise FilterSyntaxError(f"Expected a comparison after {field}")
+        return ("compare", field, operator, self.take("value", expected="a value"))
+
+
+def parse_filter(query: str):
+    return Parser(query).parse()
+
+
+def field_value(column, value):
+    """A DSL value converted to the type of the column it is compared with"""
+    column_type = column.type
+    if isinstance(column_type, Boolean):
+        if not isinstance(value, bool):
+            raise FilterSyntaxError(f"{column.key} is true or false")
+        return value
+    if isinstance(column_type, Integer):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise FilterSyntaxError(f"{column.key} is compared with numbers")
+        return value
+    if isinstance(column_type, DateTime):
+        try:
+            return datetime.fromisoformat(str(value))
+        except ValueError:
+            raise FilterSyntaxError(f"{column.key} is compared with dates like \"2022-01-31\"")
+    if isinstance(value, bool):
+        raise FilterSyntaxError(f"{column.key} is compared with text")
+    return str(value)
+
+
+def compile_tree(tree, table: FilterTable):
+    kind = tree[0]
+    if kind in ("and", "or"):
+        return (and_ if kind == "and" else or_)(*[compile_tree(term, table) for term in tree[1]])
+    if kind == "not":
+        return not_(compile_tree(tree[1], table))
+
+    field = tree[1]
+    column = table.fields.get(field)
+    if column is None:
+        raise FilterSyntaxError(f"Unknown field {field}, fields are {', '.join(table.fields)}")
+    if kind == "null":
+        return column.isnot(None) if tree[2] else column.is_(None)
+    if kind == "in":
+        return column.in_([field_value(column, value) for value in tree[2]])
+
+    operator, value = tree[2], field_value(column, tree[3])
+    if operator in ("contains", "startswith") and not isinstance(value, str):
+        raise FilterSyntaxError(f"{operator} only applies to text fields")
+    return COMPARISONS[operator](column, value)
+
+
+def compile_filter(table_name: str, organization_id: str, filter_query: str):
+    """The select of the rows of an organization a filter matches, FilterSyntaxError when it is invalid"""
+    table = FILTER_TABLES.get(table_name)
+    if table is None:
+        raise FilterSyntaxError(f"Filters apply to {', '.join(FILTER_TABLES)}")
+    criteria = compile_tree(parse_filter(filter_query), table)
+    return select(*table.fields.values()).where(*table.scope(organization_id), criteria)
+
+
+@lru_cache(maxsize=settings.FILTER_CACHE_SIZE)
+def compiled_filter(filter_id: str, table_name: str, organization_id: str, filter_query: str):
+    """compile_filter cached by filter, a changed query is a new entry"""
+    return compile_filter(table_name, organization_id, filter_query)
+
+
+class ResultCountCache:
+    """Counts of the rows filters match, dropped when their table is written to"""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def get(self, filter_id: str, filter_query: str) -> Optional[int]:
+        with self._lock:
+            cached = self._counts.get(filter_id)
+        if cached is None or cached[1] != filter_query or cached[3] < time.monotonic():
+            return None
+        return cached[2]
+
+    def set(self, filter_id: str, table_name: str, filter_query: str, count: int):
+        with self._lock:
+            self._counts[filter_id] = (table_name, filter_query, count, time.monotonic() + self.ttl)
+
+    def invalidate(self, table_name: str):
+        with self._lock:
+            for filter_id in [key for key, cached in self._counts.items() if cached[0] == table_name]:
+                del self._counts[filter_id]
+
+
+result_counts = ResultCountCache(settings.FILTER_COUNT_TTL)
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def invalidate_result_counts(connection, cursor, statement, parameters, context, executemany):
+    # inserts, updates and deletes of every kind, ORM flushes, bulk and Core statements alike
+    if context is None or context.compiled is None or not (context.isinsert or context.isupdate or context.isdelete):
+        return
+    table = getattr(context.compiled.statement, "table", None)
+    if table is not None and table.name in FILTER_TABLES:
+        result_counts.invalidate(table.name)
+
+
+def create_filter(body: filter_schemas.FilterCreate, creator_id: str, db: orm.Session) -> SavedFilter:
+    try:
+        compile_filter(body.table_name, body.organization_id, body.filter_query)
+    except FilterSyntaxError as error:
+        raise fastapi.HTTPException(status_code=400, detail=str(error))
+
+    saved_filter = SavedFilter(
+        id=uuid4().hex, organization_id=body.organization_id, table_name=body.table_name, name=body.name,
+        filter_query=body.filter_query, creator_id=creator_id,
+        date_created=datetime.utcnow(), last_updated=datetime.utcnow())
+    db.add(saved_filter)
+    db.commit()
+    db.refresh(saved_filter)
+    return saved_filter
+
+
+def get_filter(filter_id: str, organization_id: str, db: orm.Session) -> SavedFilter:
+    saved_filter = (db.query(SavedFilter)
+        .filter(SavedFilter.id == filter_id)
+        .filter(SavedFilter.organization_id == organization_id)
+        .first())
+    if saved_filter is None:
+        raise fastapi.HTTPException(status_code=404, detail="Filter does not exist")
+    return saved_filter
+
+
+def run_filter(saved_filter: SavedFilter, db: orm.Session, cursor: str = None, size: int = 50) -> dict:
+    """A page of the rows a filter matches in id order, with the number of rows it matches"""
+    statement = compiled_filter(saved_filter.id, saved_filter.table_name, saved_filter.organization_id,
+                                saved_filter.filter_query)
+    id_column = FILTER_TABLES[saved_filter.table_name].fields["id"]
+
+    page = statement
+    if cursor:
+        page = page.where(id_column > cursor)
+    rows = db.execute(page.order_by(id_column).limit(size + 1)).mappings().all()
+    next_cursor = rows[size - 1]["id"] if len(rows) > size else None
+
+    total = result_counts.get(saved_filter.id, saved_filter.filter_query)
+    if total is None:
+        total = db.execute(select(func.count()).select_from(statement.subquery())).scalar()
+        result_counts.set(saved_filter.id, saved_filter.table_name, saved_filter.filter_query, total)
+
+    return {"total": total, "items": [dict(row) for row in rows[:size]], "next_cursor": next_cursor}
@@ -0,0 +1,182 @@
+import asyncio
+import json
+import logging
+import threading
+from collections import defaultdict
+from typing import Optional
+
+from bigfastapi.utils import settings
+
+logger = logging.getLogger(__name__)
+
+
+# =================================== NOTIFICATION BROKER =================================#
+# New notifications are published on a per organization channel once their recipients
+# have been written. Push endpoints subscribe to the channel of the organization a user
+# is viewing and forward the notifications that user received, so clients no longer poll
+# GET /notifications.
+#
+# The in-memory backend only reaches subscribers in the same process. Deployments with
+# several workers should set NOTIFICATION_PUBSUB_URL to a redis url.
+
+
+class Subscription:
+    """A subscriber's inbox on one channel"""
+
+    def __init__(self, channel: str, maxsize: int = 1000):
+        self.channel = channel
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self._on_close = []
+
+    def deliver(self, message: dict):
+        """Thread safe, may be called from the publishing thread"""
+        self.loop.call_soon_threadsafe(self._put, message)
+
+    def _put(self, message: dict):
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            # a client that stopped reading must not grow memory without bound,
+            # it can catch up with GET /notifications
+            logger.warning("dropping notification event for slow subscriber on %s", self.channel)
+
+    async def get(self, timeout: Optional[float] = None) -> Optional[dict]:
+        """Wait for the next message, returns None when the timeout elapses first"""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        for callback in self._on_close:
+            callback()
+        self._on_close = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+
+class PubSubBackend:
+    def publish(self, channel: str, message: dict) -> None:
+        raise NotImplementedError
+
+    def subscribe(self, channel: str) -> Subscription:
+        raise NotImplementedError
+
+
+class InMemoryPubSub(PubSubBackend):
+    """Process local pub/sub, the default and the stand-in used by tests"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = defaultdict(set)
+
+    def publish(self, channel: str, message: dict) -> None:
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.deliver(message)
+
+    def subscribe(self, channel: str) -> Subscription:
+        subscription = Subscription(channel)
+        with self._lock:
+            self._subscriptions[channel].add(subscription)
+
+        def unsubscribe():
+            with self._lock:
+                self._subscriptions[channel].discard(subscription)
+                if not self._subscriptions[channel]:
+                    del self._subscriptions[channel]
+
+        subscription._on_close.append(unsubscribe)
+        return subscription
+
+    def subscriber_count(self, channel: str) -> int:
+        with self._lock:
+            return len(self._subscriptions.get(channel, ()))
+
+
+class RedisPubSub(PubSubBackend):
+    """Cross process pub/sub on top of redis channels, requires `redis>=4.2` for redis.asyncio"""
+
+    def __init__(self, url: str):
+        try:
+            import redis
+            import redis.asyncio as aioredis
+        except ImportError as ex:
+            raise ImportError(
+                "NOTIFICATION_PUBSUB_URL points to redis but the redis package is not installed, "
+                "install it with `pip install 'redis>=4.2'`"
+            ) from ex
+
+        self.url = url
+        self._client = redis.Redis.from_url(url)
+        self._aioredis = aioredis
+
+    def publish(self, channel: str, message: dict) -> None:
+        self._client.publish(channel, json.dumps(message))
+
+    def subscribe(self, channel: str) -> Subscription:
+        subscription = Subscription(channel)
+        client = self._aioredis.Redis.from_url(self.url)
+        pubsub = client.pubsub()
+
+        async def pump():
+            await pubsub.subscribe(channel)
+            async for message in pubsub.listen():
+                if message.get("type") == "message":
+                    subscription._put(json.loads(message["data"]))
+
+        task = subscription.loop.create_task(pump())
+
+        def unsubscribe():
+            task.cancel()
+            subscription.loop.create_task(pubsub.close())
+            subscription.loop.create_task(client.close())
+
+        subscription._on_close.append(unsubscribe)
+        return subscription
+
+
+def backend_from_url(url: str) -> PubSubBackend:
+    if url.startswith("redis://") or url.startswith("rediss://"):
+        return RedisPubSub(url)
+    return InMemoryPubSub()
+
+
+class NotificationBroker:
+    def __init__(self, backend: PubSubBackend):
+        self.backend = backend
+
+    @staticmethod
+    def channel(organization_id: str) -> str:
+        return f"notifications:{organization_id}"
+
+    def publish_notification(self, notification) -> None:
+        """
+        Announce a notification whose recipients have been committed. Failures are
+        logged and swallowed, clients still see the notification on their next fetch.
+        """
+        message = {
+            "notification_id": notification.id,
+            "organization_id": notification.organization_id,
+        }
+        try:
+            self.backend.publish(self.channel(notification.organization_id), message)
+        except Exception:
+            logger.exception("could not publish notification %s", notification.id)
+
+    def subscribe(self, organization_id: str) -> Subscription:
+        return self.backend.subscribe(self.channel(organization_id))
+
+
+broker = NotificationBroker(backend_from_url(settings.NOTIFICATION_PUBSUB_URL))
+
+
+def set_backend(backend: PubSubBackend):
+    """Swap the pub/sub backend, e.g. to share a redis connection or in tests"""
+    broker.backend = backend
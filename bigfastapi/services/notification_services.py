@@ -1,10 +1,11 @@
-from bigfastapi.db.database import get_db
-from fastapi import Depends, status, HTTPException
+from bigfastapi.db.database import get_db, SessionLocal
+from fastapi import BackgroundTasks, Depends, status, HTTPException
 import sqlalchemy.orm as orm
 from bigfastapi.services.auth_service import is_authenticated
 from bigfastapi.models.notification_models import (
     Notification,
     NotificationRecipient,
+    NotificationUnreadCount,
     NotificationGroupMember,
     NotificationGroupModule,
     NotificationSetting as Setting,
@@ -23,7 +24,16 @@ from bigfastapi.schemas.notification_schemas import (
     NotificationSettingUpdate
 )
 from bigfastapi.schemas import users_schemas as user_schema
+from bigfastapi.db.functions import random_hex_id
+from bigfastapi.services import email_services, notification_broker
+from bigfastapi.utils import settings
+from sqlalchemy import exists, false, func, insert, literal, or_, select, union, update
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime, timedelta
+from itertools import groupby
 from uuid import uuid4
+import asyncio
+import logging
 import re
 
 
@@ -39,68 +49,526 @@ def create_notification(
         Setting.organization_id == notification["organization_id"]
     ).first()
 
-    # if existing_setting.status == True: #creates notification when status is set to True
-    new_notification = Notification(
-        id=uuid4().hex,
-        creator_id=notification["creator_id"],
-        message=notification["message"],
-        organization_id=notification["organization_id"],
-        access_level=notification["access_level"]
-    )
-    db.add(new_notification)
-
-    recipient_ids = get_notification_recipients(
-        organization_id=notification["organization_id"],
-        module=notification["module"],
-        access_level=notification["access_level"],
-        db=db,
-        mentions=notification["mentions"] if notification["mentions"] else None
-    )
+    mentions = notification.get("mentions")
+    if mentions and notification["module"] == "comments":
+        recipients = mentioned_recipients_query(notification["organization_id"], mentions)
+    else:
+        recipients = organization_recipients_query(notification["organization_id"])
 
-    print(recipient_ids)
-    for recipient in recipient_ids:
-        new_notification_recipient = NotificationRecipient(
-            id=uuid4().hex, notification_id=new_notification.id, recipient_id=recipient,
-            is_read=False, is_cleared=False
+    digest = find_digest(notification["organization_id"], notification["module"],
+                         notification.get("target"), db)
+    if digest:
+        coalesce_notification(digest, notification["message"], recipients, db)
+        new_notification = digest
+    else:
+        # if existing_setting.status == True: #creates notification when status is set to True
+        new_notification = Notification(
+            id=uuid4().hex,
+            creator_id=notification["creator_id"],
+            message=notification["message"],
+            organization_id=notification["organization_id"],
+            access_level=notification["access_level"],
+            module=notification["module"],
+            target=notification.get("target"),
+            occurrences=1
+        )
+        db.add(new_notification)
+        db.flush()
+
+        fan_out_notification(notification_id=new_notification.id, recipients=recipients, db=db)
+        increment_unread_counts(
+            organization_id=new_notification.organization_id,
+            recipients=select(NotificationRecipient.recipient_id).where(
+                NotificationRecipient.notification_id == new_notification.id),
+            db=db
         )
-        db.add(new_notification_recipient)
 
     db.commit()
     db.refresh(new_notification)
 
+    notification_broker.broker.publish_notification(new_notification)
+
     return new_notification
 
 
-def get_notification_recipients(organization_id, module, access_level, db, mentions):
-    if mentions and module == "comments":
-        user_ids = []
-        for name in mentions:
-            first_name = f"{name}%"
+# =================================== COALESCING =================================#
+# Bursts of alike notifications (a comment storm on one object, a bulk import) are
+# merged into the first notification of the burst instead of each being fanned out.
+# Notifications are alike when they share organization, module and target and the
+# first one was created less than NOTIFICATION_COALESCE_WINDOW seconds ago. Untargeted
+# notifications are about nothing in particular and are never merged. The merged
+# row keeps the latest message and counts its occurrences, and is unread again for
+# everyone it reaches.
+
+
+def find_digest(organization_id: str, module: str, target: str, db: orm.Session):
+    """The notification a new one with this organization, module and target merges into, if any"""
+    window = settings.NOTIFICATION_COALESCE_WINDOW
+    if window <= 0 or target is None:
+        return None
+
+    return db.query(Notification).filter(
+        Notification.organization_id == organization_id,
+        Notification.module == module,
+        Notification.target == target,
+        Notification.date_created >= datetime.utcnow() - timedelta(seconds=window)
+    ).order_by(Notification.date_created.desc()).with_for_update().first()
+
+
+def coalesce_notification(digest: Notification, message: str, recipients, db: orm.Session):
+    """
+    Merge an occurrence into `digest`: recipients that already have it get it back as
+    unread and new recipients are fanned out to. Counters are adjusted first, while
+    the recipient rows still show who is gaining an unread notification.
+    """
+    now = datetime.utcnow()
+    recipients = recipients.subquery()
+    recipient_ids = select(recipients.c.recipient_id)
+    existing = select(NotificationRecipient.recipient_id).where(
+        NotificationRecipient.notification_id == digest.id
+    )
+    newcomers = recipient_ids.where(recipients.c.recipient_id.not_in(existing))
+
+    increment_unread_counts(
+        organization_id=digest.organization_id,
+        recipients=union(
+            newcomers,
+            existing.where(
+                NotificationRecipient.is_read == True,
+                NotificationRecipient.recipient_id.in_(recipient_ids)
+            )
+        ),
+        db=db
+    )
+
+    db.query(NotificationRecipient).filter(
+        NotificationRecipient.notification_id == digest.id,
+        NotificationRecipient.recipient_id.in_(recipient_ids),
+        or_(
+            NotificationRecipient.is_read == True,
+            NotificationRecipient.is_cleared == True,
+            NotificationRecipient.digested_at != None
+        )
+    ).update({
+        "is_read": False,
+        "is_cleared": False,
+        "digested_at": None,
+        "last_updated": now
+    }, synchronize_session=False)
+
+    fan_out_notification(notification_id=digest.id, recipients=newcomers, db=db)
+
+    digest.message = message
+    digest.occurrences = Notification.occurrences + 1
+    digest.last_updated = now
+    db.flush()
+
+
+# =================================== DIGESTS =================================#
+# Notifications are not emailed one by one. A scheduled job collects, per user and
+# organization, the unread notifications that have not been part of a digest yet and
+# sends them in a single email, for organizations whose NotificationSetting.send_via
+# is "email" or "both".
+
+DIGEST_SEND_VIA = ["email", "both"]
+
+# most notifications listed in one digest email, the rest are summarised by count
+DIGEST_MAX_ITEMS = 20
+
+logger = logging.getLogger(__name__)
+
+
+async def send_notification_digests(db: orm.Session = None):
+    """
+    Claim every pending digest, then email it; see claim_digest_rows.
+    Returns the number of digest emails sent.
+    """
+    if db is None:
+        db = SessionLocal()
+        try:
+            return await send_notification_digests(db)
+        finally:
+            db.close()
+
+    wants_email = exists().where(
+        Setting.organization_id == Notification.organization_id,
+        Setting.status == True,
+        Setting.send_via.in_(DIGEST_SEND_VIA)
+    )
+    pending = (db.query(NotificationRecipient.id, NotificationRecipient.recipient_id, Notification.organization_id,
+                        Notification.message, Notification.occurrences, User.email, User.first_name)
+               .join(Notification, Notification.id == NotificationRecipient.notification_id)
+               .join(User, User.id == NotificationRecipient.recipient_id)
+               .filter(NotificationRecipient.digested_at == None,
+                       NotificationRecipient.is_read == False,
+                       NotificationRecipient.is_cleared == False,
+                       wants_email)
+               .order_by(NotificationRecipient.recipient_id, Notification.organization_id,
+                         Notification.last_updated.desc())
+               .all())
+
+    sent = 0
+    for _, rows in groupby(pending, key=lambda row: (row.recipient_id, row.organization_id)):
+        rows = claim_digest_rows(list(rows), db)
+        if not rows:
+            continue
+        try:
+            await send_digest_email(rows)
+        except Exception:
+            logger.exception("could not send notification digest to %s", rows[0].email)
+            release_digest_rows(rows, db)
+            continue
+        sent += 1
+
+    return sent
+
+
+def claim_digest_rows(rows: list, db: orm.Session):
+    """
+    Stamp digested_at on the rows no other worker has claimed yet and return only those,
+    so a notification is emailed once however many schedulers are running. The claim
+    time doubles as the claim token.
+    """
+    claimed_at = datetime.utcnow()
+    db.query(NotificationRecipient).filter(
+        NotificationRecipient.id.in_([row.id for row in rows]),
+        NotificationRecipient.digested_at == None
+    ).update({"digested_at": claimed_at}, synchronize_session=False)
+    db.commit()
 
-            creator = db.query(Organization).join(User).filter(
-                Organization.id == organization_id
-            ).filter(User.first_name.ilike(first_name)).first()
+    claimed = {row_id for row_id, in db.query(NotificationRecipient.id).filter(
+        NotificationRecipient.id.in_([row.id for row in rows]),
+        NotificationRecipient.digested_at == claimed_at
+    )}
+    return [row for row in rows if row.id in claimed]
 
-            users = db.query(OrganizationUser).join(User).filter(
-                OrganizationUser.organization_id == organization_id
-            ).filter(User.first_name.ilike(first_name)).all()
 
-            if creator:
-                user_ids.append(creator.user_id)
+def release_digest_rows(rows: list, db: orm.Session):
+    """Hand rows claimed for a digest that could not be sent back to the next run."""
+    db.query(NotificationRecipient).filter(
+        NotificationRecipient.id.in_([row.id for row in rows])
+    ).update({"digested_at": None}, synchronize_session=False)
+    db.commit()
 
-            if users:
-                for user in users: user_ids.append(user.user_id)
-        return user_ids
 
-    creator = db.query(Organization).filter(Organization.id == organization_id).first()
+async def send_digest_email(rows: list):
+    items = [
+        f"{row.message} ({row.occurrences} times)" if row.occurrences > 1 else row.message
+        for row in rows[:DIGEST_MAX_ITEMS]
+    ]
+    if len(rows) > DIGEST_MAX_ITEMS:
+        items.append(f"and {len(rows) - DIGEST_MAX_ITEMS} more")
+
+    tasks = BackgroundTasks()
+    await email_services.send_email(
+        background_tasks=tasks,
+        template="notification_email.html",
+        title=f"You have {len(rows)} unread notifications",
+        recipients=[rows[0].email],
+        template_body={
+            "title": f"Hello {rows[0].first_name or ''}, you have {len(rows)} unread notifications",
+            "body": " | ".join(items),
+            "sender": settings.MAIL_FROM_NAME
+        }
+    )
+    await tasks()
+
+
+async def notification_digest_scheduler(interval: int = None):
+    """
+    Send digests every `interval` seconds (NOTIFICATION_DIGEST_INTERVAL by default).
+    The notification router starts it on startup.
+    """
+    interval = interval or settings.NOTIFICATION_DIGEST_INTERVAL
+    while True:
+        db = SessionLocal()
+        try:
+            await send_notification_digests(db)
+        except Exception:
+            logger.exception("notification digest run failed")
+        finally:
+            db.close()
+        await asyncio.sleep(interval)
+
+
+def organization_recipients_query(organization_id: str):
+    """
+    Selectable of the distinct ids of everyone who should receive an organization
+    wide notification: its active members plus the organization's creator.
+    UNION drops the creator when they are also listed as a member.
+    """
+    members = select(OrganizationUser.user_id.label("recipient_id")).where(
+        OrganizationUser.organization_id == organization_id,
+        OrganizationUser.is_deleted == False,
+        OrganizationUser.user_id != None
+    )
+    creator = select(Organization.user_id.label("recipient_id")).where(
+        Organization.id == organization_id,
+        Organization.user_id != None
+    )
+    return union(members, creator)
+
+
+def fan_out_notification(notification_id: str, recipients, db: orm.Session):
+    """
+    Create a NotificationRecipient row for every id produced by the `recipients`
+    selectable in a single INSERT ... SELECT, so no member row is ever loaded
+    into python. Returns the number of recipients.
+    """
+    recipients = recipients.subquery()
+    now = datetime.utcnow()
+
+    fan_out = insert(NotificationRecipient.__table__).from_select(
+        ["id", "notification_id", "recipient_id", "is_read", "is_cleared", "date_created", "last_updated"],
+        select(
+            random_hex_id(),
+            literal(notification_id),
+            recipients.c.recipient_id,
+            literal(False),
+            literal(False),
+            literal(now),
+            literal(now)
+        )
+    )
+    result = db.execute(fan_out)
+
+    return result.rowcount
+
+
+# =================================== UNREAD COUNTERS =================================#
+# NotificationUnreadCount keeps one row per (user, organization) holding the number of
+# NotificationRecipient rows that are still unread, so the badge count is a primary key
+# lookup instead of a count over every notification a user ever received. The counters
+# are adjusted in the same transaction as the recipient rows they describe, and
+# unread_count_scheduler rebuilds them with reconcile_unread_counts should they drift.
+
+
+def increment_unread_counts(organization_id: str, recipients, db: orm.Session):
+    """
+    Add one to the counter of every user id produced by the `recipients` selectable,
+    creating the counters that do not exist yet. Both steps are set based.
+    """
+    now = datetime.utcnow()
+    recipients = recipients.subquery()
+    missing = select(
+        recipients.c.recipient_id,
+        literal(organization_id),
+        literal(0),
+        literal(now)
+    ).where(
+        ~exists().where(
+            NotificationUnreadCount.recipient_id == recipients.c.recipient_id,
+            NotificationUnreadCount.organization_id == organization_id
+        )
+    )
+    create_missing = insert(NotificationUnreadCount.__table__).from_select(
+        ["recipient_id", "organization_id", "unread", "last_updated"], missing
+    )
 
-    users = db.query(OrganizationUser).filter(
-        OrganizationUser.organization_id == organization_id).all()
+    # a concurrent fan-out may create the same counter first, the retry then finds it
+    for attempt in range(2):
+        try:
+            with db.begin_nested():
+                db.execute(create_missing)
+            break
+        except IntegrityError:
+            if attempt:
+                raise
+
+    db.execute(
+        update(NotificationUnreadCount)
+        .where(
+            NotificationUnreadCount.organization_id == organization_id,
+            NotificationUnreadCount.recipient_id.in_(select(recipients.c.recipient_id))
+        )
+        .values(unread=NotificationUnreadCount.unread + 1, last_updated=now)
+        .execution_options(synchronize_session=False)
+    )
 
-    user_ids = [user.user_id for user in users]
-    user_ids.append(creator.user_id)
 
-    return user_ids
+def decrement_unread_counts(db: orm.Session, *criteria):
+    """
+    Subtract from the counters the unread NotificationRecipient rows matching
+    `criteria`, grouped by recipient and organization in one correlated UPDATE.
+    Call it before the matching rows are marked read or deleted.
+    """
+    def unread_matches(*columns):
+        return select(*columns).select_from(NotificationRecipient).join(
+            Notification, Notification.id == NotificationRecipient.notification_id
+        ).where(
+            NotificationRecipient.recipient_id == NotificationUnreadCount.recipient_id,
+            Notification.organization_id == NotificationUnreadCount.organization_id,
+            NotificationRecipient.is_read == False,
+            *criteria
+        ).correlate(NotificationUnreadCount)
+
+    result = db.execute(
+        update(NotificationUnreadCount)
+        .where(unread_matches(literal(1)).exists())
+        .values(
+            unread=NotificationUnreadCount.unread - unread_matches(func.count()).scalar_subquery(),
+            last_updated=datetime.utcnow()
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+    return result.rowcount
+
+
+def reconcile_unread_counts(db: orm.Session, organization_id: str = None, recipient_id: str = None):
+    """
+    Rebuild the unread counters from NotificationRecipient, for everyone or only
+    for an organization and/or a user. Meant to run periodically as a safety net,
+    returns the number of counters written.
+    """
+    scope = []
+    counter_scope = []
+    if organization_id:
+        scope.append(Notification.organization_id == organization_id)
+        counter_scope.append(NotificationUnreadCount.organization_id == organization_id)
+    if recipient_id:
+        scope.append(NotificationRecipient.recipient_id == recipient_id)
+        counter_scope.append(NotificationUnreadCount.recipient_id == recipient_id)
+
+    db.query(NotificationUnreadCount).filter(*counter_scope).delete(synchronize_session=False)
+
+    counts = select(
+        NotificationRecipient.recipient_id,
+        Notification.organization_id,
+        func.count(),
+        literal(datetime.utcnow())
+    ).select_from(NotificationRecipient).join(
+        Notification, Notification.id == NotificationRecipient.notification_id
+    ).where(
+        NotificationRecipient.is_read == False,
+        NotificationRecipient.recipient_id != None,
+        Notification.organization_id != None,
+        *scope
+    ).group_by(NotificationRecipient.recipient_id, Notification.organization_id)
+
+    result = db.execute(insert(NotificationUnreadCount.__table__).from_select(
+        ["recipient_id", "organization_id", "unread", "last_updated"], counts
+    ))
+    db.commit()
+
+    return result.rowcount
+
+
+async def unread_count_scheduler(interval: int = None):
+    """
+    Rebuild every unread counter every `interval` seconds (NOTIFICATION_RECONCILE_INTERVAL
+    by default). The notification router starts it on startup.
+    """
+    interval = interval or settings.NOTIFICATION_RECONCILE_INTERVAL
+    while True:
+        await asyncio.sleep(interval)
+        db = SessionLocal()
+        try:
+            reconcile_unread_counts(db)
+        except Exception:
+            logger.exception("unread notification count reconciliation failed")
+        finally:
+            db.close()
+
+
+def recipient_scope(user_id: str, organization_id: str = None, notification_ids: list = None, before: datetime = None):
+    """Criteria selecting a user's NotificationRecipient rows, optionally narrowed down"""
+    criteria = [NotificationRecipient.recipient_id == user_id]
+    if organization_id:
+        criteria.append(NotificationRecipient.notification_id.in_(
+            select(Notification.id).where(Notification.organization_id == organization_id)
+        ))
+    if notification_ids is not None:
+        criteria.append(NotificationRecipient.notification_id.in_(notification_ids))
+    if before:
+        criteria.append(NotificationRecipient.date_created < before)
+    return criteria
+
+
+def bulk_mark_notifications(user_id: str, db: orm.Session, is_read: bool = False, is_cleared: bool = False,
+                            organization_id: str = None, notification_ids: list = None, before: datetime = None):
+    """
+    Mark a user's notifications read and/or cleared with a single UPDATE ... WHERE,
+    only touching rows that change. Returns the number of rows updated.
+    """
+    criteria = recipient_scope(user_id, organization_id, notification_ids, before)
+    values = {}
+    pending = []
+    if is_read:
+        values["is_read"] = True
+        pending.append(NotificationRecipient.is_read == False)
+    if is_cleared:
+        values["is_cleared"] = True
+        pending.append(NotificationRecipient.is_cleared == False)
+    if not values:
+        return 0
+
+    if is_read:
+        decrement_unread_counts(db, *criteria)
+
+    values["last_updated"] = datetime.utcnow()
+    updated = db.query(NotificationRecipient).filter(*criteria, or_(*pending)).update(
+        values, synchronize_session=False)
+    db.commit()
+
+    return updated
+
+
+def bulk_delete_notifications(user_id: str, db: orm.Session, organization_id: str = None,
+                              notification_ids: list = None, before: datetime = None):
+    """
+    Remove notifications from a user's inbox with a single DELETE ... WHERE. The
+    notification itself stays for its other recipients. Returns the number of rows deleted.
+    """
+    criteria = recipient_scope(user_id, organization_id, notification_ids, before)
+
+    decrement_unread_counts(db, *criteria)
+    deleted = db.query(NotificationRecipient).filter(*criteria).delete(synchronize_session=False)
+    db.commit()
+
+    return deleted
+
+
+def get_unread_count(user_id: str, organization_id: str, db: orm.Session):
+    counter = db.get(NotificationUnreadCount, (user_id, organization_id))
+
+    return max(counter.unread, 0) if counter else 0
+
+
+def mentioned_recipients_query(organization_id: str, mentions: list):
+    """
+    Selectable of the distinct ids of organization members and the organization
+    creator whose first name starts with any of the mentioned names. All mentions
+    are matched in one statement with an OR of prefix patterns, so the cost of a
+    comment does not grow with its number of mentions.
+    """
+    prefixes = [f"{name}%" for name in dict.fromkeys(name.lower() for name in mentions if name)]
+    name_matches = or_(*[User.first_name.ilike(prefix) for prefix in prefixes]) if prefixes else false()
+
+    members = select(OrganizationUser.user_id.label("recipient_id")).join(
+        User, User.id == OrganizationUser.user_id
+    ).where(
+        OrganizationUser.organization_id == organization_id,
+        OrganizationUser.is_deleted == False,
+        name_matches
+    )
+    creator = select(Organization.user_id.label("recipient_id")).join(
+        User, User.id == Organization.user_id
+    ).where(
+        Organization.id == organization_id,
+        name_matches
+    )
+    return union(members, creator)
+
+
+def get_notification_recipients(organization_id, module, access_level, db, mentions):
+    if mentions and module == "comments":
+        recipients = db.execute(mentioned_recipients_query(organization_id, mentions))
+        return [recipient.recipient_id for recipient in recipients]
+
+    recipients = db.execute(organization_recipients_query(organization_id))
+
+    return [recipient.recipient_id for recipient in recipients]
     # # Find module in notification_module table that matches module and get its id
     # notification_module = db.query(NotificationModule).filter(
     #     NotificationModule.module_name == module).first()
@@ -251,6 +719,19 @@ async def get_notifications(user_id: str, organization_id: str, db: orm.Session,
     return notifications, total_items
 
 
+async def get_notifications_since(user_id: str, organization_id: str, since: datetime, db: orm.Session, limit: int = 100):
+    """Notifications a user received after `since`, oldest first, used to replay what a push client missed"""
+    notifications = (db.query(Notification, NotificationRecipient.is_read, NotificationRecipient.is_cleared)
+                     .join(NotificationRecipient)
+                     .filter(NotificationRecipient.recipient_id == user_id, Notification.organization_id == organization_id)
+                     .filter(Notification.date_created > since)
+                     .order_by(Notification.date_created.asc())
+                     .limit(limit)
+                     .all())
+
+    return notifications
+
+
 async def check_group_member_exists(group_id: str, member_id: str, db: orm.Session):
     member = db.query(NotificationGroupMember).filter(NotificationGroupMember.group_id == group_id
                                                       ).filter(NotificationGroupMember.member_id == member_id).first()
@@ -287,6 +768,7 @@ async def create_comment_notification_format(
     module: str,    
     mentions: list,
     action: str = "mentioned", 
+    target: str = None,
     db: orm.Session = Depends(get_db),
     user: user_schema.User = Depends(is_authenticated)    
 ):
@@ -301,6 +783,7 @@ async def create_comment_notification_format(
         "message": message,
         "organization_id": organization_id,
         "access_level": access_level,
+        "target": target,
         "mentions": mentions
     }
     
@@ -0,0 +1,289 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import NamedTuple, Optional
+from uuid import uuid4
+
+import fastapi
+import httpx
+import sqlalchemy.orm as orm
+from sqlalchemy import and_, or_, update
+from sqlalchemy.exc import IntegrityError
+
+from bigfastapi.db.database import SessionLocal
+from bigfastapi.models.credit_wallet_models import CreditPayment
+from bigfastapi.models.wallet_models import Wallet, WalletTransaction
+from bigfastapi.services import exchange_rate_services, wallet_services
+from bigfastapi.utils import settings
+
+logger = logging.getLogger(__name__)
+
+# ================================ PAYMENT CALLBACKS ================================#
+# A credit top up is a pending wallet transaction and a credit_payments row, both made
+# when the payment link is. The provider's callback only records that the payment came
+# back and queues it, by tx_ref, so a callback that is retried or replayed changes nothing,
+# and redirects to the frontend at once with the tx_ref to poll. process_payment then
+# verifies the payment with the provider and settles the top up: the pending transaction
+# is credited, the wallet debited and the credits added in one database transaction,
+# which the settlement of the pending transaction makes happen once. A payment whose
+# verification or settlement fails is retried PAYMENT_MAX_ATTEMPTS times, the callback
+# queues it through a background task, payment_callback_scheduler picks up retries and
+# the payments of workers that died on them.
+
+CREATED = "created"
+QUEUED = "queued"
+PROCESSING = "processing"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class Verification(NamedTuple):
+    successful: bool
+    amount: float = 0
+    currency: str = ""
+    error: str = ""
+
+
+class FlutterwaveVerifier:
+    url = "https://api.flutterwave.com/v3/transactions/{transaction_id}/verify"
+
+    async def verify(self, payment: CreditPayment) -> Verification:
+        async with httpx.AsyncClient(timeout=30) as client:
+            response = await client.get(
+                self.url.format(transaction_id=payment.transaction_id),
+                headers={"Authorization": "Bearer " + settings.FLUTTERWAVE_SEC_KEY})
+        if response.status_code >= 500:
+            response.raise_for_status()
+        body = response.json()
+        data = body.get("data") or {}
+        if body.get("status") != "success" or data.get("status") != "successful":
+            return Verification(False, error="Payment was not successful")
+        if data.get("tx_ref") != payment.tx_ref:
+            return Verification(False, error="Payment does not match the transaction")
+        return Verification(True, amount=float(data["amount"]), currency=data["currency"].upper())
+
+
+class StripeVerifier:
+    url = "https://api.stripe.com/v1/checkout/sessions/{transaction_id}"
+
+    async def verify(self, payment: CreditPayment) -> Verification:
+        async with httpx.AsyncClient(timeout=30) as client:
+            response = await client.get(
+                self.url.format(transaction_id=payment.transaction_id),
+                headers={"Authorization": "Bearer " + settings.STRIPE_SEC_KEY})
+        if response.status_code >= 500:
+            response.raise_for_status()
+        session = response.json()
+        if response.status_code != 200 or session.get("payment_status") != "paid":
+            return Verification(False, error="Payment was not successful")
+        if session.get("client_reference_id") != payment.tx_ref:
+            return Verification(False, error="Payment does not match the transaction")
+        currency = session["currency"].upper()
+        amount = float(session["amount_total"])
+        # payment links charge NGN in kobo
+        if currency == "NGN":
+            amount /= 100
+        return Verification(True, amount=amount, currency=currency)
+
+
+VERIFIERS = {
+    "flutterwave": FlutterwaveVerifier(),
+    "stripe": StripeVerifier(),
+}
+
+
+def create_payment(tx_ref: str, provider: str, organization_id: str, redirect_url: str,
+                   db: orm.Session) -> CreditPayment:
+    """Record a payment link's top up, the caller commits"""
+    payment = CreditPayment(id=uuid4().hex, tx_ref=tx_ref, provider=provider, organization_id=organization_id,
+                            redirect_url=redirect_url, status=CREATED, attempts=0,
+                            date_created=datetime.utcnow(), last_updated=datetime.utcnow())
+    db.add(payment)
+    return payment
+
+
+def record_callback(tx_ref: str, provider: str, successful: bool, transaction_id: str,
+                    db: orm.Session) -> Optional[CreditPayment]:
+    """Queue a payment the provider called back about. Returns None when there is no such top up."""
+    for attempt in range(2):
+        if claim_callback(tx_ref, successful, transaction_id, db):
+            db.commit()
+            return get_payment(tx_ref, db)
+        payment = get_payment(tx_ref, db)
+        if payment is not None:
+            # queued, processed or cancelled before, the callback is a retry
+            return payment
+
+        # top ups created before payments were recorded
+        wallet = (db.query(Wallet)
+                  .join(WalletTransaction, WalletTransaction.wallet_id == Wallet.id)
+                  .filter(WalletTransaction.id == tx_ref)
+                  .first())
+        if wallet is None:
+            return None
+        try:
+            create_payment(tx_ref, provider, wallet.organization_id, settings.FRONTEND_URL, db)
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+    return get_payment(tx_ref, db)
+
+
+def claim_callback(tx_ref: str, successful: bool, transaction_id: str, db: orm.Session) -> bool:
+    if successful:
+        # a payment that failed verification may be called back with the right transaction
+        statuses, values = [CREATED, CANCELLED, FAILED], dict(
+            status=QUEUED, transaction_id=transaction_id, attempts=0, error=None, next_attempt_at=None)
+    else:
+        statuses, values = [CREATED], dict(status=CANCELLED)
+    return db.execute(
+        update(CreditPayment)
+        .where(CreditPayment.tx_ref == tx_ref, CreditPayment.status.in_(statuses))
+        .values(last_updated=datetime.utcnow(), **values)
+        .execution_options(synchronize_session=False)
+    ).rowcount > 0
+
+
+def get_payment(tx_ref: str, db: orm.Session) -> Optional[CreditPayment]:
+    payment = db.query(CreditPayment).filter(CreditPayment.tx_ref == tx_ref).first()
+    if payment is not None:
+        db.refresh(payment)
+    return payment
+
+
+def claim_payment(tx_ref: str, db: orm.Session) -> bool:
+    """Take a queued payment, or one whose worker has held it longer than PAYMENT_PROCESSING_LEASE"""
+    now = datetime.utcnow()
+    claimed = db.execute(
+        update(CreditPayment)
+        .where(CreditPayment.tx_ref == tx_ref, or_(
+            and_(CreditPayment.status == QUEUED,
+                 or_(CreditPayment.next_attempt_at.is_(None), CreditPayment.next_attempt_at <= now)),
+            and_(CreditPayment.status == PROCESSING,
+                 CreditPayment.last_updated < now - timedelta(seconds=settings.PAYMENT_PROCESSING_LEASE))))
+        .values(status=PROCESSING, attempts=CreditPayment.attempts + 1, last_updated=now)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.commit()
+    return claimed > 0
+
+
+async def process_payment(tx_ref: str, db: orm.Session = None) -> Optional[CreditPayment]:
+    """Verify a queued payment and settle its top up. Does nothing when the payment is not due or taken."""
+    close = db is None
+    db = db or SessionLocal()
+    try:
+        if not claim_payment(tx_ref, db):
+            return get_payment(tx_ref, db)
+        payment = get_payment(tx_ref, db)
+
+        try:
+            verification = await VERIFIERS[payment.provider].verify(payment)
+        except Exception as error:
+            logger.warning("could not verify payment %s: %s", tx_ref, error)
+            return retry_payment(payment, f"Could not verify the payment: {error}", db)
+        if not verification.successful:
+            return finish_payment(payment, FAILED, db, error=verification.error)
+
+        try:
+            credits = settle_payment(payment, verification, db)
+        except Exception as error:
+            db.rollback()
+            detail = error.detail if isinstance(error, fastapi.HTTPException) else str(error)
+            logger.warning("could not settle payment %s: %s", tx_ref, detail)
+            return retry_payment(payment, detail, db)
+        return finish_payment(payment, SUCCEEDED, db, credits=credits)
+    finally:
+        if close:
+            db.close()
+
+
+def settle_payment(payment: CreditPayment, verification: Verification, db: orm.Session) -> Optional[int]:
+    """Credit the top up, buy credits with it and add them, once. Returns the credits bought."""
+    transaction = db.get(WalletTransaction, payment.tx_ref)
+    if transaction is None:
+        raise fastapi.HTTPException(status_code=404, detail="Transaction not found")
+    if transaction.status:
+        # settled by an earlier attempt
+        return payment.credits
+    if verification.currency != transaction.currency_code.upper():
+        raise fastapi.HTTPException(status_code=400, detail="Payment currency does not match the transaction")
+
+    conversion = exchange_rate_services.credit_rate(verification.currency, db)
+    if conversion is None:
+        raise fastapi.HTTPException(status_code=404, detail="Currency " + verification.currency +
+                                                            " does not have a conversion rate")
+    credits = round(verification.amount / conversion.rate)
+    amount, currency = verification.amount, verification.currency
+
+    reason = payment.provider.capitalize() + ": " + currency + " " + str(amount) + " Top Up"
+    if wallet_services.settle_wallet_transaction(transaction.id, db, amount=amount, reason=reason,
+                                                 commit=False) is None:
+        db.rollback()
+        return payment.credits
+
+    reference = str(credits) + ' credits Top Up'
+    wallet_services.post_wallet_transaction(transaction.wallet_id, -amount, currency, db,
+                                            reason=payment.organization_id + ": " + reference,
+                                            idempotency_key=transaction.id + ":credits", commit=False)
+    wallet_services.add_credits(payment.organization_id, credits, reference, db, commit=False)
+    payment.credits = credits
+    db.commit()
+    return credits
+
+
+def retry_payment(payment: CreditPayment, error: str, db: orm.Session) -> CreditPayment:
+    if payment.attempts >= settings.PAYMENT_MAX_ATTEMPTS:
+        return finish_payment(payment, FAILED, db, error=error)
+    payment.status = QUEUED
+    payment.error = error
+    payment.next_attempt_at = datetime.utcnow() + timedelta(seconds=settings.PAYMENT_RETRY_INTERVAL * payment.attempts)
+    payment.last_updated = datetime.utcnow()
+    db.commit()
+    return payment
+
+
+def finish_payment(payment: CreditPayment, status: str, db: orm.Session, error: str = None,
+                   credits: int = None) -> CreditPayment:
+    payment.status = status
+    payment.error = error
+    if credits is not None:
+        payment.credits = credits
+    payment.last_updated = datetime.utcnow()
+    db.commit()
+    return payment
+
+
+async def process_due_payments(db: orm.Session = None, limit: int = 100) -> int:
+    """Process the queued payments that are due and those left by workers that stopped, returns how many"""
+    close = db is None
+    db = db or SessionLocal()
+    try:
+        now = datetime.utcnow()
+        due = [tx_ref for tx_ref, in db.query(CreditPayment.tx_ref).filter(or_(
+            and_(CreditPayment.status == QUEUED,
+                 or_(CreditPayment.next_attempt_at.is_(None), CreditPayment.next_attempt_at <= now)),
+            and_(CreditPayment.status == PROCESSING,
+                 CreditPayment.last_updated < now - timedelta(seconds=settings.PAYMENT_PROCESSING_LEASE)),
+        )).limit(limit)]
+        for tx_ref in due:
+            await process_payment(tx_ref, db)
+        return len(due)
+    finally:
+        if close:
+            db.close()
+
+
+async def payment_callback_scheduler(interval: int = None):
+    """
+    Process due payments every `interval` seconds (PAYMENT_RETRY_INTERVAL by default).
+    The credit router starts it on startup.
+    """
+    interval = interval or settings.PAYMENT_RETRY_INTERVAL
+    while True:
+        try:
+            await process_due_payments()
+        except Exception:
+            logger.exception("could not process payments")
+        await asyncio.sleep(interval)
@@ -1,20 +1,31 @@
 from base64 import encode
-from datetime import datetime
+from datetime import datetime, timedelta
+import asyncio
+import logging
 import os
+import re
+from typing import List, Optional
+from uuid import uuid4
 from fastapi import Depends, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import FileResponse
 
 import sqlalchemy.orm as orm
-from sqlalchemy import and_, desc
+from sqlalchemy import and_, column, desc, func, inspect, literal_column, or_, select, table, text, update
+from sqlalchemy.dialects import mysql
 
 from bigfastapi.utils import settings
 
 
-from ..models.receipt_models import Receipt
+from ..models.receipt_models import Receipt, SEARCH_COLUMNS, SEARCH_DOCUMENT, SEARCH_INDEX, SEARCH_INDEX_DDL
 from ..models.file_models import File
 from ..schemas import receipt_schemas
 from bigfastapi import pdfs
-from ..db.database import get_db
+from bigfastapi.services import email_services
+from bigfastapi.utils.utils import convert_template_to_html
+from ..db.database import get_db, SessionLocal
+
+logger = logging.getLogger(__name__)
 
 
 async def get_receipts(
@@ -66,26 +77,101 @@ async def get_receipts(
     return (receipts, total_items)
 
 
+# ================================ SEARCH ================================#
+# search_receipts matches the words searched for against the full-text index of
+# receipt_models (recipient, subject, sender and message), best matches first. Pages
+# are keyset paginated on relevance and id: the cursor is the id of the last receipt of
+# a page and the next page holds the matches that rank after it.
+
+
+def search_terms(dialect: str, search_value: str) -> str:
+    """The full-text query for what was typed into the search box, empty when there is nothing to search"""
+    if dialect == "sqlite":
+        # every word is required, as a prefix, and quoted so FTS5 syntax is taken literally
+        return " ".join('"' + word.replace('"', '""') + '"*' for word in search_value.split())
+    if dialect == "mysql":
+        return " ".join("+" + word + "*" for word in re.findall(r"\w+", search_value))
+    # postgres parses it with websearch_to_tsquery
+    return search_value.strip()
+
+
+def search_scores(dialect: str, terms: str):
+    """The ids of the receipts matching `terms` with their relevance, higher is better"""
+    if dialect == "sqlite":
+        fts = table("receipts_fts", column("rowid"))
+        return (select(Receipt.id, (-func.bm25(literal_column("receipts_fts"))).label("score"))
+                .select_from(fts.join(Receipt.__table__, literal_column("receipts.rowid") == fts.c.rowid))
+                .where(literal_column("receipts_fts").op("MATCH")(terms)))
+    if dialect == "mysql":
+        relevance = mysql.match(*[getattr(Receipt, name) for name in SEARCH_COLUMNS],
+                                against=terms).in_boolean_mode()
+        return select(Receipt.id, relevance.label("score")).where(relevance)
+    document, query = literal_column(SEARCH_DOCUMENT), func.websearch_to_tsquery("simple", terms)
+    return select(Receipt.id, func.ts_rank(document, query).label("score")).where(document.op("@@")(query))
+
+
 async def search_receipts(
-    organization_id:str,
+    organization_id: str,
     search_value: str,
-    offset: int, size:int=50,
+    cursor: str = None,
+    size: int = 50,
     db: orm.Session = Depends(get_db)
-    ):  
-    search_text = f"%{search_value}%"
-    search_result_count =db.query(Receipt).filter(and_(
-        Receipt.organization_id == organization_id,
-        Receipt.recipient.like(search_text))).count()
+    ):
+    """
+    Search an organization's receipts, returns a page of the matches after the receipt
+    `cursor` points at, the number of matches and the cursor of the next page, None on
+    the last page
+    """
+    dialect = db.get_bind().dialect.name
+    terms = search_terms(dialect, search_value)
+    if not terms:
+        return ([], 0, None)
+
+    matches = (search_scores(dialect, terms)
+               .where(Receipt.organization_id == organization_id, Receipt.is_deleted == False)
+               .subquery())
+    total_items = db.execute(select(func.count()).select_from(matches)).scalar()
+
+    page = db.query(Receipt).join(matches, matches.c.id == Receipt.id)
+    if cursor:
+        after = db.execute(select(matches.c.score).where(matches.c.id == cursor)).first()
+        if after is None:
+            raise HTTPException(status_code=400, detail="Invalid search cursor")
+        page = page.filter(or_(matches.c.score < after.score,
+                               and_(matches.c.score == after.score, Receipt.id > cursor)))
+    receipts = page.order_by(matches.c.score.desc(), Receipt.id).limit(size + 1).all()
+
+    next_cursor = receipts[size - 1].id if len(receipts) > size else None
+    return (receipts[:size], total_items, next_cursor)
 
-    receipts_by_recipient = db.query(Receipt).filter(and_(
-        Receipt.organization_id == organization_id,
-        Receipt.recipient.like(search_text))
-        ).offset(
-        offset=offset).limit(limit=size).all()
 
+def ensure_receipt_search_index(db: orm.Session = None) -> bool:
+    """Add the full-text index to a receipts table created without it, returns whether it was added"""
+    if db is None:
+        db = SessionLocal()
+
+    bind = db.get_bind()
+    dialect = bind.dialect.name
+    if dialect not in SEARCH_INDEX_DDL or not inspect(bind).has_table(Receipt.__tablename__):
+        return False
+    if dialect == "sqlite":
+        query = "SELECT 1 FROM sqlite_master WHERE name = 'receipts_fts'"
+    elif dialect == "postgresql":
+        query = "SELECT 1 FROM pg_indexes WHERE tablename = 'receipts' AND indexname = :index"
+    else:
+        query = ("SELECT 1 FROM information_schema.statistics WHERE table_schema = DATABASE() "
+                 "AND table_name = 'receipts' AND index_name = :index LIMIT 1")
+    if db.execute(text(query), {"index": SEARCH_INDEX}).first():
+        return False
+
+    for statement in SEARCH_INDEX_DDL[dialect]:
+        db.execute(text(statement))
+    if dialect == "sqlite":
+        # index the receipts that are already there
+        db.execute(text("INSERT INTO receipts_fts(receipts_fts) VALUES ('rebuild')"))
+    db.commit()
+    return True
 
-    recipient_list = [*receipts_by_recipient]
-    return (recipient_list, search_result_count)
 
 async def get_receipt_by_id(receipt_id:str, org_id: str, db: orm.Session = Depends(get_db)):
     receipt = db.query(Receipt).filter(Receipt.id == receipt_id, Receipt.organization_id == org_id).first()
@@ -120,3 +206,222 @@ def get_file(bucket_name: str, file_id: str, db: orm.Session = Depends(get_db)):
         return FileResponse(local_file_path, media_type='application/octet-stream',filename=existing_file.filename)
     else:
         raise HTTPException(status_code=404, detail="File not found")
+
+
+# ================================ PIPELINE ================================#
+# A receipt is stored as soon as it is sent, with the template, data and recipients it
+# is made from, and a worker takes it through the stages: render the template into the
+# receipt's message, convert that to a PDF file when create_file is set, and email it.
+# Each stage is committed when it completes, so a receipt whose stage fails is retried
+# from that stage, up to RECEIPT_MAX_ATTEMPTS times with a growing delay. A receipt that
+# cannot be rendered never will be and fails at once. The endpoints queue the receipts
+# they create through a background task, receipt_pipeline_scheduler, started with the
+# receipts router, picks up retries and the receipts of workers that died on them.
+
+QUEUED = "queued"
+PROCESSING = "processing"
+SENT = "sent"
+FAILED = "failed"
+
+RENDER = "render"
+PDF = "pdf"
+EMAIL = "email"
+
+
+def receipt_template(payload: receipt_schemas.attributes):
+    """The directory and file name of the template a receipt is rendered from"""
+    template = payload.template.split("/")[-1]
+    template_dir = payload.custom_template_dir
+    if not template_dir:
+        template_dir_path = os.path.abspath(os.environ.get("TEMPLATES_DIR", payload.template))
+        template_dir = os.path.dirname(template_dir_path)
+    if not os.path.exists(os.path.join(template_dir, template)):
+        raise HTTPException(status_code=404, detail=f"Template: {payload.template} does not exist")
+    return template_dir, template
+
+
+def create_receipt(payload: receipt_schemas.attributes, create_file: bool, db: orm.Session) -> Receipt:
+    """Store a receipt to be sent, the caller commits"""
+    template_dir, template = receipt_template(payload)
+    now = datetime.now()
+    receipt = Receipt(
+        id=uuid4().hex,
+        organization_id=payload.organization_id,
+        sender_email=payload.sender_email,
+        recipient=payload.recipients[0],
+        recipients=list(payload.recipients),
+        subject=payload.subject,
+        template=template,
+        template_dir=template_dir,
+        data=payload.data or {},
+        create_file=create_file,
+        status=QUEUED,
+        stage=RENDER,
+        attempts=0,
+        is_deleted=False,
+        date_created=now,
+        last_updated=now,
+    )
+    db.add(receipt)
+    return receipt
+
+
+def due_receipts(now: datetime):
+    """Queued receipts that are due and those a worker has held longer than RECEIPT_PROCESSING_LEASE"""
+    return or_(
+        and_(Receipt.status == QUEUED,
+             or_(Receipt.next_attempt_at.is_(None), Receipt.next_attempt_at <= now)),
+        and_(Receipt.status == PROCESSING,
+             Receipt.last_updated < now - timedelta(seconds=settings.RECEIPT_PROCESSING_LEASE)))
+
+
+def claim_receipt(receipt_id: str, db: orm.Session) -> bool:
+    now = datetime.now()
+    claimed = db.execute(
+        update(Receipt)
+        .where(Receipt.id == receipt_id, due_receipts(now))
+        .values(status=PROCESSING, attempts=Receipt.attempts + 1, last_updated=now)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.commit()
+    return claimed > 0
+
+
+def get_pipeline_receipt(receipt_id: str, db: orm.Session) -> Optional[Receipt]:
+    receipt = db.get(Receipt, receipt_id)
+    if receipt is not None:
+        db.refresh(receipt)
+    return receipt
+
+
+async def render_receipt(receipt: Receipt, db: orm.Session) -> str:
+    receipt.message = convert_template_to_html(
+        template_dir=receipt.template_dir,
+        template_file=receipt.template,
+        template_data=receipt.data or {},
+    )
+    return PDF if receipt.create_file else EMAIL
+
+
+async def file_receipt(receipt: Receipt, db: orm.Session) -> str:
+    # wkhtmltopdf runs in a thread, the other receipts go on meanwhile
+    file_name = f"{receipt.id}-{uuid4().hex}.pdf"
+    await run_in_threadpool(pdfs.pdfkit.from_string, receipt.message, file_name)
+    file = pdfs.store_pdf(file_name=file_name, db=db)
+    receipt.file_id = file.id
+    return EMAIL
+
+
+async def email_receipt(receipt: Receipt, db: orm.Session) -> None:
+    attachments = []
+    if receipt.file_id:
+        file = db.get(File, receipt.file_id)
+        attachments.append(os.path.join(
+            os.path.realpath(settings.FILES_BASE_FOLDER), file.bucketname, file.filename))
+    await email_services.send_html_email(
+        title=receipt.subject,
+        recipients=receipt.recipients or [receipt.recipient],
+        html=receipt.message,
+        attachments=attachments,
+    )
+    return None
+
+
+# each stage returns the stage that comes after it, None after the last one
+STAGES = {
+    RENDER: render_receipt,
+    PDF: file_receipt,
+    EMAIL: email_receipt,
+}
+
+
+async def process_receipt(receipt_id: str, db: orm.Session = None) -> Optional[Receipt]:
+    """Take a queued receipt through the stages it has left. Does nothing when the receipt is not due or taken."""
+    close = db is None
+    db = db or SessionLocal()
+    try:
+        if not claim_receipt(receipt_id, db):
+            return get_pipeline_receipt(receipt_id, db)
+        receipt = get_pipeline_receipt(receipt_id, db)
+
+        while receipt.stage is not None:
+            stage = receipt.stage
+            try:
+                receipt.stage = await STAGES[stage](receipt, db)
+            except Exception as error:
+                db.rollback()
+                logger.warning("could not %s receipt %s: %s", stage, receipt_id, error)
+                error = f"Could not {stage} the receipt: {error}"
+                if stage == RENDER:
+                    return finish_receipt(receipt, FAILED, db, error=error)
+                return retry_receipt(receipt, error, db)
+
+            # also renews the worker's hold on the receipt
+            receipt.last_updated = datetime.now()
+            db.commit()
+        return finish_receipt(receipt, SENT, db)
+    finally:
+        if close:
+            db.close()
+
+
+def retry_receipt(receipt: Receipt, error: str, db: orm.Session) -> Receipt:
+    if receipt.attempts >= settings.RECEIPT_MAX_ATTEMPTS:
+        return finish_receipt(receipt, FAILED, db, error=error)
+    receipt.status = QUEUED
+    receipt.error = error
+    receipt.next_attempt_at = datetime.now() + timedelta(seconds=settings.RECEIPT_RETRY_INTERVAL * receipt.attempts)
+    receipt.last_updated = datetime.now()
+    db.commit()
+    return receipt
+
+
+def finish_receipt(receipt: Receipt, status: str, db: orm.Session, error: str = None) -> Receipt:
+    receipt.status = status
+    receipt.error = error
+    receipt.last_updated = datetime.now()
+    db.commit()
+    return receipt
+
+
+async def process_receipts(receipt_ids: List[str], db: orm.Session = None) -> List[Optional[Receipt]]:
+    """Process receipts RECEIPT_WORKERS at a time, each in a session of its own, or one after the other in `db`"""
+    if db is not None:
+        return [await process_receipt(receipt_id, db) for receipt_id in receipt_ids]
+
+    workers = asyncio.Semaphore(settings.RECEIPT_WORKERS)
+
+    async def process(receipt_id):
+        async with workers:
+            return await process_receipt(receipt_id)
+
+    return await asyncio.gather(*[process(receipt_id) for receipt_id in receipt_ids])
+
+
+async def process_due_receipts(db: orm.Session = None, limit: int = 100) -> int:
+    """Process the queued receipts that are due and those left by workers that stopped, returns how many"""
+    session = db or SessionLocal()
+    try:
+        due = [receipt_id for receipt_id, in session.query(Receipt.id)
+               .filter(due_receipts(datetime.now()))
+               .order_by(Receipt.date_created)
+               .limit(limit)]
+    finally:
+        if db is None:
+            session.close()
+    await process_receipts(due, db)
+    return len(due)
+
+
+async def receipt_pipeline_scheduler(interval: int = None):
+    """
+    Process due receipts every `interval` seconds (RECEIPT_RETRY_INTERVAL by default).
+    The receipts router starts it on startup.
+    """
+    interval = interval or settings.RECEIPT_RETRY_INTERVAL
+    while True:
+        try:
+            await process_due_receipts()
+        except Exception:
+            logger.exception("could not process receipts")
+        await asyncio.sleep(interval)
@@ -0,0 +1,180 @@
+import atexit
+import logging
+import math
+import threading
+from collections import defaultdict, deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+import requests
+
+from bigfastapi.utils import settings
+from bigfastapi.utils.rate_limiter import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+
+# =================================== SLACK NOTIFIER =================================#
+# Slack messages are queued per webhook and a worker thread posts them every
+# SLACK_FLUSH_INTERVAL seconds, joining up to SLACK_BATCH_SIZE queued messages into a
+# single post. Posts to a webhook are spaced by SLACK_RATE_LIMIT per second and a 429
+# pushes the next post back by the Retry-After it carries. A webhook keeps at most
+# SLACK_MAX_PENDING messages; the excess is dropped and reported as a count once the
+# queue drains, so a login spike cannot queue up unbounded traffic.
+
+# statuses worth posting again later, anything else means the message will never go through
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+
+def retry_after(value: Optional[str], default: float) -> float:
+    """Seconds to wait from a Retry-After header, given in seconds or as an HTTP date"""
+    if not value:
+        return default
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            moment = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return default
+        if moment is None:
+            return default
+        if moment.tzinfo is None:
+            moment = moment.replace(tzinfo=timezone.utc)
+        seconds = (moment - datetime.now(timezone.utc)).total_seconds()
+    return max(seconds, 0) if math.isfinite(seconds) else default
+
+
+class SlackNotifier:
+    def __init__(self, flush_interval: float, batch_size: int, max_pending: int, rate: float):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.rate = rate
+        self._queues = defaultdict(deque)
+        self._dropped = defaultdict(int)
+        self._verify = {}
+        self._limiters = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._worker: Optional[threading.Thread] = None
+        self._closed = False
+
+    def notify(self, url: str, text: str, verify: bool = True) -> bool:
+        """Queue a message for a webhook, returns False when it was dropped"""
+        if not url:
+            return False
+
+        with self._lock:
+            self._verify[url] = verify
+            queue = self._queues[url]
+            if len(queue) >= self.max_pending:
+                self._dropped[url] += 1
+                return False
+            queue.append(text)
+            self._start_worker()
+        return True
+
+    def pending(self, url: str) -> int:
+        with self._lock:
+            return len(self._queues.get(url, ()))
+
+    def flush(self) -> int:
+        """Post what every webhook has queued, returns the number of posts made"""
+        posts = 0
+        with self._flush_lock:
+            with self._lock:
+                urls = list(self._queues)
+            for url in urls:
+                posts += self._flush_webhook(url)
+        return posts
+
+    def close(self):
+        """Stop the worker and make a last attempt at posting what is queued"""
+        self._closed = True
+        self._wakeup.set()
+        if self._worker is not None and self._worker is not threading.current_thread():
+            self._worker.join(timeout=self.flush_interval + 5)
+        self.flush()
+
+    def _flush_webhook(self, url: str) -> int:
+        posts = 0
+        while True:
+            with self._lock:
+                queue = self._queues[url]
+                messages = [queue.popleft() for _ in range(min(self.batch_size, len(queue)))]
+                # the dropped messages came after the queued ones, report them with the last batch
+                dropped = self._dropped.pop(url, 0) if not queue else 0
+                verify = self._verify.get(url, True)
+            if not messages and not dropped:
+                return posts
+
+            text = "\n".join(messages)
+            if dropped:
+                text += f"\n... and {dropped} more messages were dropped"
+
+            limiter = self._limiter(url)
+            limiter.acquire()
+            try:
+                response = self._post(url, text, verify)
+            except requests.RequestException:
+                logger.exception("could not post to slack")
+                self._requeue(url, messages, dropped)
+                limiter.penalize(self.flush_interval)
+                return posts
+
+            if response.status_code in RETRY_STATUS_CODES:
+                self._requeue(url, messages, dropped)
+                limiter.penalize(retry_after(response.headers.get("Retry-After"), self.flush_interval))
+                return posts
+
+            if response.status_code >= 400:
+                logger.error("slack rejected %s messages: %s %s", len(messages),
+                             response.status_code, response.text)
+            posts += 1
+
+    def _post(self, url: str, text: str, verify: bool):
+        return requests.post(
+            url=url,
+            json={"text": text},
+            headers={"Content-Type": "application/json"},
+            verify=verify,
+            timeout=10,
+        )
+
+    def _requeue(self, url: str, messages: list, dropped: int):
+        with self._lock:
+            queue = self._queues[url]
+            room = max(self.max_pending - len(queue), 0)
+            self._dropped[url] += dropped + max(len(messages) - room, 0)
+            queue.extendleft(reversed(messages[:room]))
+
+    def _limiter(self, url: str) -> RateLimiter:
+        with self._lock:
+            if url not in self._limiters:
+                self._limiters[url] = RateLimiter(self.rate)
+            return self._limiters[url]
+
+    def _start_worker(self):
+        if self._closed or (self._worker is not None and self._worker.is_alive()):
+            return
+        self._worker = threading.Thread(target=self._run, name="slack-notifier", daemon=True)
+        self._worker.start()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+notifier = SlackNotifier(
+    flush_interval=settings.SLACK_FLUSH_INTERVAL,
+    batch_size=settings.SLACK_BATCH_SIZE,
+    max_pending=settings.SLACK_MAX_PENDING,
+    rate=settings.SLACK_RATE_LIMIT,
+)
+
+atexit.register(notifier.close)
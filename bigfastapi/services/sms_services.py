@@ -0,0 +1,242 @@
+import asyncio
+import datetime as dt
+import logging
+from itertools import groupby
+from typing import List, Optional
+from uuid import uuid4
+
+import requests
+import sqlalchemy.orm as orm
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import and_, or_
+
+from bigfastapi.db.database import SessionLocal
+from bigfastapi.models.sms_models import SMS, SMSStatus
+from bigfastapi.utils import settings
+from bigfastapi.utils.rate_limiter import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+
+# =================================== SMS OUTBOX =================================#
+# Messages are written to the `sms` table with status "queued" and a dispatcher
+# drains the table in batches. Rows that share a sender, message type and body are
+# coalesced into a single provider request using its multi-recipient `customers`
+# payload, so a bulk notification costs a handful of HTTP calls instead of one per
+# recipient.
+
+PENDING_STATUSES = [SMSStatus.queued.value, SMSStatus.retrying.value]
+
+# how long a batch may stay in "sending" before another dispatcher reclaims it
+STALE_SENDING_AFTER = dt.timedelta(minutes=10)
+
+# HTTP status codes worth retrying, anything else in the 4xx range is final
+TRANSIENT_STATUS_CODES = [408, 425, 429, 500, 502, 503, 504]
+
+rate_limiter = RateLimiter(settings.SMS_RATE_LIMIT)
+
+
+class TransientSMSError(Exception):
+    "Raised when the provider failed in a way that may succeed on retry"
+
+
+class PermanentSMSError(Exception):
+    "Raised when the provider rejected the request outright"
+
+
+def enqueue_sms(
+    sender: str,
+    recipients: List[str],
+    content: str,
+    db: orm.Session,
+    message_type: str = "sms",
+) -> List[SMS]:
+    """Store one outbox row per recipient and return without contacting the provider"""
+    now = dt.datetime.utcnow()
+    messages = [
+        SMS(
+            id=uuid4().hex,
+            sender=sender,
+            recipient=recipient,
+            body=content,
+            message_type=message_type,
+            status=SMSStatus.queued.value,
+            attempts=0,
+            next_attempt_at=now,
+            date_created=now,
+            last_updated=now,
+        )
+        for recipient in dict.fromkeys(recipients)
+    ]
+    db.add_all(messages)
+    db.commit()
+
+    return messages
+
+
+def post_to_provider(sender: str, recipients: List[str], content: str, message_type: str = "sms"):
+    """Send a single multi-recipient request to the sms provider"""
+    data = {
+        "sender": sender,
+        "message_type": message_type,
+        "customers": recipients,
+        "content": content,
+    }
+
+    headers = {
+        "Content-Type": "application/json",
+        "ORGANIZATION-KEY": settings.TELEX_ORGANIZATION_KEY,
+        "ORGANIZATION-ID": settings.TELEX_ORGANIZATION_ID,
+    }
+
+    try:
+        response = requests.post(url=settings.SMS_API, json=data, headers=headers, timeout=30)
+    except requests.RequestException as ex:
+        raise TransientSMSError(str(ex)) from ex
+
+    if response.status_code == 429:
+        retry_after = response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            rate_limiter.penalize(int(retry_after))
+    if response.status_code in TRANSIENT_STATUS_CODES:
+        raise TransientSMSError(f"provider responded with {response.status_code}")
+    if response.status_code >= 400:
+        raise PermanentSMSError(f"provider responded with {response.status_code}: {response.text}")
+
+    try:
+        body = response.json()
+    except ValueError as ex:
+        raise TransientSMSError("provider returned an invalid response") from ex
+
+    if not body.get("status"):
+        raise TransientSMSError(str(body.get("message", "provider did not accept the message")))
+
+    return body
+
+
+def _claim_batch(db: orm.Session, limit: int) -> List[SMS]:
+    now = dt.datetime.utcnow()
+
+    # release batches a crashed dispatcher never finished
+    db.query(SMS).filter(
+        SMS.status == SMSStatus.sending.value,
+        SMS.last_updated < now - STALE_SENDING_AFTER,
+    ).update({"status": SMSStatus.retrying.value, "batch_id": None}, synchronize_session=False)
+
+    candidate_ids = [
+        row.id
+        for row in db.query(SMS.id)
+        .filter(SMS.status.in_(PENDING_STATUSES))
+        .filter(or_(SMS.next_attempt_at == None, SMS.next_attempt_at <= now))
+        .order_by(SMS.date_created)
+        .limit(limit)
+    ]
+    if not candidate_ids:
+        db.commit()
+        return []
+
+    batch_id = uuid4().hex
+    db.query(SMS).filter(
+        and_(SMS.id.in_(candidate_ids), SMS.status.in_(PENDING_STATUSES))
+    ).update(
+        {"status": SMSStatus.sending.value, "batch_id": batch_id, "last_updated": now},
+        synchronize_session=False,
+    )
+    db.commit()
+
+    return db.query(SMS).filter(SMS.batch_id == batch_id).order_by(
+        SMS.sender, SMS.message_type, SMS.body).all()
+
+
+def _mark_sent(messages: List[SMS]):
+    now = dt.datetime.utcnow()
+    for message in messages:
+        message.status = SMSStatus.sent.value
+        message.attempts += 1
+        message.last_error = None
+        message.date_sent = now
+        message.last_updated = now
+
+
+def _mark_failed(messages: List[SMS], error: Exception, transient: bool):
+    now = dt.datetime.utcnow()
+    for message in messages:
+        message.attempts += 1
+        message.last_error = str(error)[:1000]
+        message.last_updated = now
+        if transient and message.attempts < settings.SMS_MAX_RETRIES:
+            backoff = settings.SMS_RETRY_BACKOFF * 2 ** (message.attempts - 1)
+            message.status = SMSStatus.retrying.value
+            message.next_attempt_at = now + dt.timedelta(seconds=backoff)
+        else:
+            message.status = SMSStatus.failed.value
+
+
+def dispatch_pending_sms(db: Optional[orm.Session] = None, max_batches: int = None) -> dict:
+    """
+    Drain the sms outbox. Pending rows are claimed a batch at a time, grouped by
+    (sender, message_type, body) and posted with up to SMS_BATCH_SIZE recipients
+    per request while respecting SMS_RATE_LIMIT requests per second.
+
+    Safe to call from several workers at once, each batch is claimed atomically.
+    Returns a count of sent and failed messages.
+    """
+    owns_session = db is None
+    if owns_session:
+        db = SessionLocal()
+
+    summary = {"sent": 0, "retrying": 0, "failed": 0}
+    batches = 0
+    try:
+        while max_batches is None or batches < max_batches:
+            claimed = _claim_batch(db, limit=settings.SMS_BATCH_SIZE * 10)
+            if not claimed:
+                break
+            batches += 1
+
+            key = lambda message: (message.sender, message.message_type, message.body)
+            for (sender, message_type, body), group in groupby(claimed, key=key):
+                group = list(group)
+                for start in range(0, len(group), settings.SMS_BATCH_SIZE):
+                    chunk = group[start:start + settings.SMS_BATCH_SIZE]
+                    rate_limiter.acquire()
+                    try:
+                        post_to_provider(
+                            sender=sender,
+                            recipients=[message.recipient for message in chunk],
+                            content=body,
+                            message_type=message_type,
+                        )
+                        _mark_sent(chunk)
+                        summary["sent"] += len(chunk)
+                    except TransientSMSError as ex:
+                        _mark_failed(chunk, ex, transient=True)
+                    except PermanentSMSError as ex:
+                        _mark_failed(chunk, ex, transient=False)
+                    db.commit()
+
+            for message in claimed:
+                if message.status == SMSStatus.retrying.value:
+                    summary["retrying"] += 1
+                elif message.status == SMSStatus.failed.value:
+                    summary["failed"] += 1
+    finally:
+        if owns_session:
+            db.close()
+
+    return summary
+
+
+async def sms_dispatch_scheduler(interval: int = None):
+    """
+    Drain the sms outbox every `interval` seconds (SMS_RETRY_BACKOFF by default), so
+    retries go out without waiting for the next send. The sms router starts it on startup.
+    """
+    interval = interval or settings.SMS_RETRY_BACKOFF
+    while True:
+        try:
+            # posting blocks on the provider and the rate limiter
+            await run_in_threadpool(dispatch_pending_sms)
+        except Exception:
+            logger.exception("could not dispatch sms")
+        await asyncio.sleep(interval)
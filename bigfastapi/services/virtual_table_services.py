@@ -0,0 +1,298 @@
+import logging
+from datetime import datetime
+from typing import Dict, List, Optional
+from uuid import uuid4
+
+import fastapi
+import sqlalchemy.orm as orm
+from sqlalchemy import Index, and_, inspect, or_
+
+from bigfastapi.db.database import SessionLocal
+from bigfastapi.models.virtual_table_models import VirtualTable, VirtualTableColumn, VirtualTableData
+from bigfastapi.schemas import virtual_table_schemas as schemas
+from bigfastapi.utils import settings
+
+logger = logging.getLogger(__name__)
+
+# =================================== VIRTUAL TABLES =================================#
+# A virtual table maps the columns a user names onto the fixed physical columns of
+# virtual_table_data, three text and three integer ones. Queries on virtual column names
+# are compiled to filters and sorts over the physical columns. Rows are paged by keyset on
+# the sort columns and the row id. Every query counts the columns it filters on, and a
+# column filtered VIRTUAL_TABLE_INDEX_THRESHOLD times gets an index on its physical column.
+
+PHYSICAL_COLUMNS = {
+    "str": ["str_column_1", "str_column_2", "str_column_3"],
+    "int": ["int_column_1", "int_column_2", "int_column_3"],
+}
+MAX_BULK_ROWS = 1000
+MAX_PAGE_SIZE = 200
+
+OPERATORS = {
+    "eq": lambda column, value: column == value,
+    "ne": lambda column, value: column != value,
+    "lt": lambda column, value: column < value,
+    "lte": lambda column, value: column <= value,
+    "gt": lambda column, value: column > value,
+    "gte": lambda column, value: column >= value,
+    "in": lambda column, value: column.in_(value),
+    "startswith": lambda column, value: column.startswith(value, autoescape=True),
+    "contains": lambda column, value: column.contains(value, autoescape=True),
+    "is_null": lambda column, value: column.is_(None) if value else column.isnot(None),
+}
+TEXT_OPERATORS = ["startswith", "contains"]
+
+
+def create_virtual_table(table: schemas.VirtualTableCreate, db: orm.Session) -> VirtualTable:
+    """Create a table and assign each of its columns a physical column of its type"""
+    names = [column.name for column in table.columns]
+    if len(set(names)) != len(names):
+        raise fastapi.HTTPException(status_code=400, detail="Column names must be unique")
+
+    free = {kind: list(columns) for kind, columns in PHYSICAL_COLUMNS.items()}
+    virtual_table = VirtualTable(
+        id=uuid4().hex, name=table.name, parent_object_name=table.parent_object_name,
+        organization_id=table.organization_id, date_created=datetime.utcnow(), last_updated=datetime.utcnow())
+    db.add(virtual_table)
+
+    for column in table.columns:
+        if column.type not in free:
+            raise fastapi.HTTPException(status_code=400, detail=f"Column types are {', '.join(PHYSICAL_COLUMNS)}")
+        if not free[column.type]:
+            raise fastapi.HTTPException(
+                status_code=400, detail=f"A table has at most {len(PHYSICAL_COLUMNS[column.type])} {column.type} columns")
+        db.add(VirtualTableColumn(
+            id=uuid4().hex, virtual_table_id=virtual_table.id, virtual_column_name=column.name,
+            db_table_name=VirtualTableData.__tablename__, db_table_column_name=free[column.type].pop(0),
+            type=column.type, filter_count=0, organization_id=table.organization_id,
+            date_created=datetime.now(), last_updated=datetime.now()))
+
+    db.commit()
+    db.refresh(virtual_table)
+    return virtual_table
+
+
+def get_virtual_table(table_id: str, organization_id: str, db: orm.Session) -> VirtualTable:
+    virtual_table = (db.query(VirtualTable)
+        .filter(VirtualTable.id == table_id)
+        .filter(VirtualTable.organization_id == organization_id)
+        .first())
+    if virtual_table is None:
+        raise fastapi.HTTPException(status_code=404, detail="Virtual table does not exist")
+    return virtual_table
+
+
+def table_columns(table_id: str, db: orm.Session) -> Dict[str, VirtualTableColumn]:
+    """The columns of a table by virtual name"""
+    columns = db.query(VirtualTableColumn).filter(VirtualTableColumn.virtual_table_id == table_id)
+    return {column.virtual_column_name: column for column in columns}
+
+
+def list_virtual_tables(organization_id: str, db: orm.Session) -> List[schemas.VirtualTable]:
+    tables = (db.query(VirtualTable)
+        .filter(VirtualTable.organization_id == organization_id)
+        .order_by(VirtualTable.date_created)
+        .all())
+    columns = {}
+    for column in (db.query(VirtualTableColumn)
+            .filter(VirtualTableColumn.virtual_table_id.in_([table.id for table in tables]))
+            .order_by(VirtualTableColumn.date_created)):
+        columns.setdefault(column.virtual_table_id, []).append(
+            schemas.VirtualColumn(name=column.virtual_column_name, type=column.type))
+    return [schemas.VirtualTable(id=table.id, name=table.name, parent_object_name=table.parent_object_name,
+                                 organization_id=table.organization_id, date_created=table.date_created,
+                                 columns=columns.get(table.id, []))
+            for table in tables]
+
+
+def typed_value(column: VirtualTableColumn, value):
+    """A value converted to the type of its column, 400 when it cannot be"""
+    if value is None:
+        return None
+    if column.type == "int":
+        try:
+            if isinstance(value, bool) or (isinstance(value, str) and not value.strip().lstrip("-").isdigit()):
+                raise ValueError
+            return int(value)
+        except (TypeError, ValueError):
+            raise fastapi.HTTPException(
+                status_code=400, detail=f"{column.virtual_column_name} takes integer values, not {value!r}")
+    value = str(value)
+    if len(value) > 191:
+        raise fastapi.HTTPException(
+            status_code=400, detail=f"{column.virtual_column_name} takes at most 191 characters")
+    return value
+
+
+def physical_row(table: VirtualTable, columns: Dict[str, VirtualTableColumn], row: dict) -> dict:
+    unknown = set(row) - set(columns)
+    if unknown:
+        raise fastapi.HTTPException(status_code=400, detail=f"Unknown columns: {', '.join(sorted(unknown))}")
+    now = datetime.now()
+    values = dict(id=uuid4().hex, virtual_table_id=table.id, organization_id=table.organization_id,
+                  date_created=now, last_updated=now)
+    for name, value in row.items():
+        values[columns[name].db_table_column_name] = typed_value(columns[name], value)
+    return values
+
+
+def insert_rows(table: VirtualTable, rows: List[dict], db: orm.Session) -> List[str]:
+    """Insert rows given by virtual column names in one statement, returns their ids"""
+    if len(rows) > MAX_BULK_ROWS:
+        raise fastapi.HTTPException(status_code=400, detail=f"At most {MAX_BULK_ROWS} rows can be inserted at once")
+    columns = table_columns(table.id, db)
+    mappings = [physical_row(table, columns, row) for row in rows]
+    db.bulk_insert_mappings(VirtualTableData, mappings)
+    db.commit()
+    return [mapping["id"] for mapping in mappings]
+
+
+def virtual_row(row: VirtualTableData, columns: Dict[str, VirtualTableColumn]) -> schemas.VirtualRow:
+    return schemas.VirtualRow(
+        id=row.id, date_created=row.date_created,
+        values={name: getattr(row, column.db_table_column_name) for name, column in columns.items()})
+
+
+def compile_filters(columns: Dict[str, VirtualTableColumn], filters: List[schemas.VirtualFilter]) -> list:
+    """Filters on virtual column names compiled to criteria on the physical columns"""
+    criteria = []
+    for condition in filters:
+        column = columns.get(condition.column)
+        if column is None:
+            raise fastapi.HTTPException(status_code=400, detail=f"Unknown column: {condition.column}")
+        if condition.op not in OPERATORS:
+            raise fastapi.HTTPException(status_code=400, detail=f"Operators are {', '.join(OPERATORS)}")
+        if condition.op in TEXT_OPERATORS and column.type != "str":
+            raise fastapi.HTTPException(status_code=400, detail=f"{condition.op} only applies to str columns")
+
+        if condition.op == "is_null":
+            value = bool(condition.value)
+        elif condition.op == "in":
+            if not isinstance(condition.value, list):
+                raise fastapi.HTTPException(status_code=400, detail="in takes a list of values")
+            value = [typed_value(column, item) for item in condition.value]
+        else:
+            value = typed_value(column, condition.value)
+            if value is None:
+                raise fastapi.HTTPException(status_code=400, detail="Use is_null to filter on missing values")
+        criteria.append(OPERATORS[condition.op](getattr(VirtualTableData, column.db_table_column_name), value))
+    return criteria
+
+
+def compile_sort(columns: Dict[str, VirtualTableColumn], sort: List[schemas.VirtualSort]) -> list:
+    """(physical column, descending) pairs, the row id always comes last to make the order total"""
+    keys = []
+    for key in sort:
+        column = columns.get(key.column)
+        if column is None:
+            raise fastapi.HTTPException(status_code=400, detail=f"Unknown column: {key.column}")
+        if key.direction not in ("asc", "desc"):
+            raise fastapi.HTTPException(status_code=400, detail="Sort direction is asc or desc")
+        keys.append((getattr(VirtualTableData, column.db_table_column_name), key.direction == "desc"))
+    return keys + [(VirtualTableData.id, False)]
+
+
+def order_by(keys: list) -> list:
+    # missing values come first ascending and last descending on every database
+    clauses = []
+    for column, descending in keys[:-1]:
+        clauses.extend([column.is_(None).asc(), column.desc()] if descending else [column.is_(None).desc(), column.asc()])
+    return clauses + [VirtualTableData.id.asc()]
+
+
+def after(keys: list, cursor_row: VirtualTableData):
+    """Rows that come after `cursor_row` in the order of `keys`"""
+    alternatives = []
+    equal = []
+    for column, descending in keys:
+        value = getattr(cursor_row, column.key)
+        if value is None:
+            # missing values sort first ascending, every value is later, and last descending
+            later = None if descending else column.isnot(None)
+            same = column.is_(None)
+        else:
+            later = column < value if descending else column > value
+            if descending:
+                later = or_(later, column.is_(None))
+            same = column == value
+        if later is not None:
+            alternatives.append(and_(*equal, later))
+        equal.append(same)
+    return or_(*alternatives)
+
+
+def query_rows(table: VirtualTable, query: schemas.VirtualTableQuery, db: orm.Session,
+               background_tasks: fastapi.BackgroundTasks = None) -> schemas.VirtualRowsPage:
+    """A page of the rows of a table matching the query's filters, in the query's order"""
+    columns = table_columns(table.id, db)
+    criteria = compile_filters(columns, query.filters)
+    keys = compile_sort(columns, query.sort)
+    size = query.size if 0 < query.size <= MAX_PAGE_SIZE else 50
+
+    rows = db.query(VirtualTableData).filter(VirtualTableData.virtual_table_id == table.id, *criteria)
+    if query.cursor:
+        cursor_row = (db.query(VirtualTableData)
+            .filter(VirtualTableData.id == query.cursor)
+            .filter(VirtualTableData.virtual_table_id == table.id)
+            .first())
+        if cursor_row is None:
+            raise fastapi.HTTPException(status_code=400, detail="Invalid rows cursor")
+        rows = rows.filter(after(keys, cursor_row))
+    rows = rows.order_by(*order_by(keys)).limit(size + 1).all()
+
+    filtered = {condition.column for condition in query.filters}
+    if filtered:
+        record_filter_use(table.id, [columns[name] for name in filtered], db, background_tasks)
+
+    next_cursor = rows[size - 1].id if len(rows) > size else None
+    return schemas.VirtualRowsPage(items=[virtual_row(row, columns) for row in rows[:size]], next_cursor=next_cursor)
+
+
+def record_filter_use(table_id: str, columns: List[VirtualTableColumn], db: orm.Session,
+                      background_tasks: Optional[fastapi.BackgroundTasks] = None):
+    """Count a query filtering on `columns`, and index the columns that are filtered often"""
+    db.query(VirtualTableColumn).filter(VirtualTableColumn.id.in_([column.id for column in columns])).update(
+        {"filter_count": VirtualTableColumn.filter_count + 1}, synchronize_session=False)
+    db.commit()
+
+    threshold = settings.VIRTUAL_TABLE_INDEX_THRESHOLD
+    for column in columns:
+        db.refresh(column)
+        # retried every threshold queries in case creating the index failed
+        if column.filter_count % threshold == 0:
+            if background_tasks is not None:
+                background_tasks.add_task(ensure_column_index, column.db_table_column_name)
+            else:
+                ensure_column_index(column.db_table_column_name, db)
+
+
+def column_index(physical_column: str) -> Index:
+    """The index serving filters on a physical column, the table id narrows it to one table"""
+    table = VirtualTableData.__table__
+    index = Index(f"ix_virtual_table_data_table_id_{physical_column}",
+                  table.c.virtual_table_id, table.c[physical_column], table.c.id)
+    # the index is created on demand, not with the table
+    table.indexes.discard(index)
+    return index
+
+
+def ensure_column_index(physical_column: str, db: orm.Session = None) -> bool:
+    """Create the index of a physical column unless it exists, returns whether it was created"""
+    if db is None:
+        db = SessionLocal()
+        try:
+            return ensure_column_index(physical_column, db)
+        finally:
+            db.close()
+    index = column_index(physical_column)
+    bind = db.get_bind()
+    existing = {existing["name"] for existing in inspect(bind).get_indexes(VirtualTableData.__tablename__)}
+    if index.name in existing:
+        return False
+    try:
+        index.create(bind=bind)
+    except Exception:
+        # another worker created it first, or the database is busy, the next threshold retries
+        logger.exception("could not create index %s", index.name)
+        return False
+    return True
@@ -0,0 +1,325 @@
+import asyncio
+import logging
+from datetime import date, datetime, time, timedelta
+from typing import List, Optional
+from uuid import uuid4
+
+import fastapi
+import sqlalchemy.orm as orm
+from fastapi import status
+from sqlalchemy import Date, and_, case, func, select, update
+from sqlalchemy.exc import IntegrityError
+
+from bigfastapi.db.database import SessionLocal
+from bigfastapi.models.credit_wallet_models import CreditWallet, CreditWalletHistory
+from bigfastapi.models.wallet_models import Wallet, WalletBalanceSnapshot, WalletTransaction
+from bigfastapi.utils import settings
+
+logger = logging.getLogger(__name__)
+
+# =================================== WALLET LEDGER =================================#
+# wallet_transactions is the ledger of a wallet, its balance only ever changes along with
+# a transaction. Both are written in one database transaction: the transaction is added,
+# then the balance is moved with `UPDATE wallets SET balance = balance + :amount`, which
+# holds the row lock of the wallet until commit so concurrent payments queue up instead of
+# overwriting each other. The update bumps the version of the wallet, the transaction keeps
+# it as its sequence together with the balance it left, which orders the ledger of every
+# wallet. A debit that would overdraw the wallet leaves it untouched.
+#
+# Callers that may run twice, payment callbacks above all, pass an idempotency key, or
+# settle a pending transaction by id, either is applied once however often it is retried.
+
+
+def post_wallet_transaction(wallet_id: str, amount: float, currency: str, db: orm.Session, reason: str = "",
+                            idempotency_key: str = None, commit: bool = True) -> WalletTransaction:
+    """Add a transaction to a wallet and move its balance. A key that was posted before returns its transaction."""
+    if idempotency_key is not None:
+        existing = get_idempotent_transaction(idempotency_key, db)
+        if existing is not None:
+            return existing
+
+    transaction = WalletTransaction(
+        id=uuid4().hex, wallet_id=wallet_id, currency_code=currency, amount=amount,
+        transaction_date=datetime.utcnow(), transaction_ref=reason, status=True,
+        idempotency_key=idempotency_key)
+    db.add(transaction)
+    try:
+        db.flush()
+    except IntegrityError:
+        # the same key was posted concurrently and committed first
+        db.rollback()
+        existing = get_idempotent_transaction(idempotency_key, db) if idempotency_key else None
+        if existing is None:
+            raise
+        return existing
+
+    apply_to_balance(transaction, db)
+    if commit:
+        db.commit()
+    return transaction
+
+
+def settle_wallet_transaction(transaction_id: str, db: orm.Session, amount: float = None, reason: str = "",
+                              commit: bool = True) -> Optional[WalletTransaction]:
+    """Mark a pending transaction successful and move the balance of its wallet.
+
+    Returns None when the transaction does not exist or was settled already.
+    """
+    values = {"status": True}
+    if amount is not None:
+        values["amount"] = amount
+    if reason:
+        values["transaction_ref"] = reason
+    claimed = db.execute(
+        update(WalletTransaction)
+        .where(WalletTransaction.id == transaction_id, WalletTransaction.status == False)
+        .values(**values)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not claimed:
+        return None
+
+    transaction = db.get(WalletTransaction, transaction_id)
+    db.refresh(transaction)
+    apply_to_balance(transaction, db)
+    if commit:
+        db.commit()
+    return transaction
+
+
+def apply_to_balance(transaction: WalletTransaction, db: orm.Session):
+    """Move the balance of the wallet of a transaction within the caller's database transaction"""
+    criteria = [Wallet.id == transaction.wallet_id]
+    if transaction.amount < 0:
+        criteria.append(Wallet.balance + transaction.amount >= 0)
+    moved = db.execute(
+        update(Wallet)
+        .where(*criteria)
+        .values(balance=Wallet.balance + transaction.amount, version=func.coalesce(Wallet.version, 0) + 1,
+                last_updated=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not moved:
+        db.rollback()
+        if db.get(Wallet, transaction.wallet_id) is None:
+            raise fastapi.HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Wallet does not exist")
+        raise fastapi.HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Insufficient wallet balance")
+
+    # the row stays locked by the update, this reads the balance it left
+    balance, version = db.execute(
+        select(Wallet.balance, Wallet.version).where(Wallet.id == transaction.wallet_id)).one()
+    transaction.sequence = version
+    transaction.balance_after = balance
+    # the transaction is dated when it reaches the balance, which keeps dates in ledger order
+    transaction.transaction_date = datetime.utcnow()
+    db.flush()
+
+    wallet = db.identity_map.get(orm.util.identity_key(Wallet, transaction.wallet_id))
+    if wallet is not None:
+        db.expire(wallet, ["balance", "version", "last_updated"])
+
+
+def get_idempotent_transaction(idempotency_key: str, db: orm.Session) -> Optional[WalletTransaction]:
+    return db.query(WalletTransaction).filter(WalletTransaction.idempotency_key == idempotency_key).first()
+
+
+def add_credits(organization_id: str, credits: int, reference: str, db: orm.Session,
+                commit: bool = True) -> CreditWallet:
+    """Add credits to the credit wallet of an organization along with their history, in one database transaction"""
+    credit_wallet_id = db.execute(
+        select(CreditWallet.id).where(CreditWallet.organization_id == organization_id)).scalar()
+    if credit_wallet_id is None:
+        credit_wallet_id = uuid4().hex
+        db.add(CreditWallet(id=credit_wallet_id, organization_id=organization_id, amount=0,
+                            last_updated=datetime.utcnow()))
+        db.flush()
+
+    db.add(CreditWalletHistory(id=uuid4().hex, credit_wallet_id=credit_wallet_id, amount=credits,
+                               date=datetime.utcnow(), reference=reference))
+    db.execute(
+        update(CreditWallet)
+        .where(CreditWallet.id == credit_wallet_id)
+        .values(amount=CreditWallet.amount + credits, last_updated=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+    credit_wallet = db.get(CreditWallet, credit_wallet_id)
+    db.expire(credit_wallet, ["amount", "last_updated"])
+    if commit:
+        db.commit()
+    return credit_wallet
+
+
+# ================================= BALANCE SNAPSHOTS ===============================#
+# snapshot_wallet_balances checkpoints the ledger of every wallet once a day is over: one
+# row per wallet and day with transactions, holding the balance the day closed on, the
+# sequence of its last transaction and the day's credits, debits and count. It only reads
+# the transactions after the last checkpoint of each wallet, so running it every
+# WALLET_SNAPSHOT_INTERVAL seconds is cheap. The balance at any moment is the checkpoint
+# of the day before plus the transactions of that one day, daily balances are read from
+# checkpoints and the transactions of today.
+#
+# A transaction dated just before midnight can commit after its day was checkpointed. Its
+# sequence is still past every checkpoint of the wallet, the wallet row lock keeps later
+# transactions waiting on it, so the next run finds it and merges it into the checkpoint
+# of its day instead of adding a second one.
+
+MAX_STATEMENT_DAYS = 366
+
+
+def ledger_days(until: datetime, wallet_id: str = None, after_sequence: int = None):
+    """The totals of each wallet and day before `until`, after the last checkpoint of the wallet"""
+    day = func.date(WalletTransaction.transaction_date, type_=Date)
+    criteria = [WalletTransaction.status == True, WalletTransaction.sequence.isnot(None),
+                WalletTransaction.transaction_date < until]
+    query = select(
+        WalletTransaction.wallet_id, day.label("day"),
+        func.max(WalletTransaction.sequence).label("sequence"),
+        func.sum(case((WalletTransaction.amount > 0, WalletTransaction.amount), else_=0)).label("credits"),
+        func.sum(case((WalletTransaction.amount < 0, -WalletTransaction.amount), else_=0)).label("debits"),
+        func.count().label("transactions"),
+    ).select_from(WalletTransaction)
+
+    if wallet_id is not None:
+        criteria += [WalletTransaction.wallet_id == wallet_id, WalletTransaction.sequence > (after_sequence or 0)]
+    else:
+        last = (select(WalletBalanceSnapshot.wallet_id, func.max(WalletBalanceSnapshot.sequence).label("sequence"))
+                .group_by(WalletBalanceSnapshot.wallet_id)
+                .subquery())
+        query = query.outerjoin(last, last.c.wallet_id == WalletTransaction.wallet_id)
+        criteria.append(WalletTransaction.sequence > func.coalesce(last.c.sequence, 0))
+    days = query.where(*criteria).group_by(WalletTransaction.wallet_id, day).subquery()
+
+    # the balance a day closed on is the one its last transaction left
+    return select(days, WalletTransaction.balance_after.label("balance")).join(WalletTransaction, and_(
+        WalletTransaction.wallet_id == days.c.wallet_id, WalletTransaction.sequence == days.c.sequence))
+
+
+def snapshot_wallet_balances(db: orm.Session = None, until: date = None, retry: bool = True) -> int:
+    """Checkpoint the days before `until`, today by default, that are not yet. Returns the number of snapshots."""
+    if db is None:
+        db = SessionLocal()
+        try:
+            return snapshot_wallet_balances(db, until, retry)
+        finally:
+            db.close()
+    until = until or datetime.utcnow().date()
+
+    rows = db.execute(ledger_days(datetime.combine(until, time()))).all()
+    checkpointed = {(snapshot.wallet_id, snapshot.day) for snapshot in db.query(
+        WalletBalanceSnapshot.wallet_id, WalletBalanceSnapshot.day
+    ).filter(
+        WalletBalanceSnapshot.wallet_id.in_({row.wallet_id for row in rows}),
+        WalletBalanceSnapshot.day.in_({row.day for row in rows})
+    )} if rows else set()
+
+    merged = sum(merge_late_transactions(row, db) for row in rows if (row.wallet_id, row.day) in checkpointed)
+    db.commit()
+
+    snapshots = [
+        dict(id=uuid4().hex, wallet_id=row.wallet_id, day=row.day, sequence=row.sequence, balance=row.balance,
+             credits=row.credits, debits=row.debits, transactions=row.transactions, date_created=datetime.utcnow())
+        for row in rows if (row.wallet_id, row.day) not in checkpointed
+    ]
+    try:
+        db.bulk_insert_mappings(WalletBalanceSnapshot, snapshots)
+        db.commit()
+    except IntegrityError:
+        # another worker checkpointed some of these days first, merge into its checkpoints
+        db.rollback()
+        if not retry:
+            raise
+        return merged + snapshot_wallet_balances(db, until, retry=False)
+    return merged + len(snapshots)
+
+
+def merge_late_transactions(row, db: orm.Session) -> int:
+    """Add the transactions of a day that committed after its checkpoint to it. Returns 1 when merged."""
+    # the sequence check makes merging the same transactions twice a no-op
+    return db.execute(
+        update(WalletBalanceSnapshot)
+        .where(WalletBalanceSnapshot.wallet_id == row.wallet_id, WalletBalanceSnapshot.day == row.day,
+               WalletBalanceSnapshot.sequence < row.sequence)
+        .values(sequence=row.sequence, balance=row.balance,
+                credits=WalletBalanceSnapshot.credits + row.credits,
+                debits=WalletBalanceSnapshot.debits + row.debits,
+                transactions=WalletBalanceSnapshot.transactions + row.transactions)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+
+
+def last_snapshot(wallet_id: str, before: date, db: orm.Session) -> Optional[WalletBalanceSnapshot]:
+    return (db.query(WalletBalanceSnapshot)
+            .filter(WalletBalanceSnapshot.wallet_id == wallet_id, WalletBalanceSnapshot.day < before)
+            .order_by(WalletBalanceSnapshot.day.desc())
+            .first())
+
+
+def balance_at(wallet_id: str, at: datetime, db: orm.Session) -> float:
+    """The balance of a wallet at a moment, from the checkpoint of the day before and the transactions after it"""
+    snapshot = last_snapshot(wallet_id, at.date(), db)
+    balance = db.execute(
+        select(WalletTransaction.balance_after)
+        .where(WalletTransaction.wallet_id == wallet_id, WalletTransaction.status == True,
+               WalletTransaction.sequence > (snapshot.sequence if snapshot else 0),
+               WalletTransaction.transaction_date <= at)
+        .order_by(WalletTransaction.sequence.desc())
+        .limit(1)
+    ).scalar()
+    if balance is not None:
+        return balance
+    return snapshot.balance if snapshot else 0
+
+
+def daily_balances(wallet_id: str, start: date, end: date, db: orm.Session) -> dict:
+    """The closing balance and totals of every day from start to end, days without transactions included"""
+    if end < start or (end - start).days >= MAX_STATEMENT_DAYS:
+        raise fastapi.HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                    detail=f"Statements cover 1 to {MAX_STATEMENT_DAYS} days")
+
+    opening = last_snapshot(wallet_id, start, db)
+    days = {snapshot.day: snapshot for snapshot in (
+        db.query(WalletBalanceSnapshot)
+        .filter(WalletBalanceSnapshot.wallet_id == wallet_id,
+                WalletBalanceSnapshot.day >= start, WalletBalanceSnapshot.day <= end)
+        .all())}
+
+    # the days that are not checkpointed yet, today at least. Those before start
+    # are after the opening checkpoint and carry the opening balance forward.
+    opening_balance = opening.balance if opening else 0
+    latest = last_snapshot(wallet_id, end + timedelta(days=1), db)
+    rows = db.execute(ledger_days(datetime.combine(end + timedelta(days=1), time()), wallet_id,
+                                  latest.sequence if latest else 0)).all()
+    for row in sorted(rows, key=lambda row: row.day):
+        if row.day < start:
+            opening_balance = row.balance
+        else:
+            days[row.day] = row
+
+    balance = opening_balance
+    statement: List[dict] = []
+    for offset in range((end - start).days + 1):
+        day = start + timedelta(days=offset)
+        if day in days:
+            balance = days[day].balance
+            statement.append(dict(day=day, balance=balance, credits=days[day].credits, debits=days[day].debits,
+                                  transactions=days[day].transactions))
+        else:
+            statement.append(dict(day=day, balance=balance, credits=0, debits=0, transactions=0))
+    return {"wallet_id": wallet_id, "opening_balance": opening_balance, "days": statement}
+
+
+async def wallet_snapshot_scheduler(interval: int = None):
+    """
+    Checkpoint wallet balances every `interval` seconds (WALLET_SNAPSHOT_INTERVAL by default).
+    The wallet router starts it on startup.
+    """
+    interval = interval or settings.WALLET_SNAPSHOT_INTERVAL
+    while True:
+        db = SessionLocal()
+        try:
+            snapshot_wallet_balances(db)
+        except Exception:
+            logger.exception("wallet balance snapshots failed")
+        finally:
+            db.close()
+        await asyncio.sleep(interval)
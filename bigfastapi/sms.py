@@ -1,79 +1,83 @@
 from .schemas import sms_schema
 from .models import sms_models
 from typing import Optional, Dict
-from uuid import uuid4
 from datetime import datetime
-from fastapi import APIRouter
+import asyncio
+from fastapi import APIRouter, BackgroundTasks
 from bigfastapi.db.database import get_db
 from pydantic import BaseModel
 import fastapi
 import sqlalchemy.orm as orm
-from bigfastapi.utils import settings
-import json
-import requests
+from bigfastapi.services import sms_services
 
 app = APIRouter(tags=["SMS"])
+dispatch_scheduler = None
+
+
+@app.on_event("startup")
+async def start_sms_dispatch():
+    global dispatch_scheduler
+    dispatch_scheduler = asyncio.create_task(sms_services.sms_dispatch_scheduler())
+
+
+@app.on_event("shutdown")
+async def stop_sms_dispatch():
+    if dispatch_scheduler is not None:
+        dispatch_scheduler.cancel()
 
 
 class ResponseModel(BaseModel):
     message: str
 
 
-SMS_API = settings.SMS_API
-ORGANIZATION_ID = settings.TELEX_ORGANIZATION_ID
-ORGANIZATION_KEY = settings.TELEX_ORGANIZATION_KEY
-
-@app.post("/sms/send")
+@app.post("/sms/send", status_code=202, response_model=sms_schema.QueuedSMSResponse)
 async def SendSMS(
         sms_details: sms_schema.SMS,
+        background_tasks: BackgroundTasks,
         db: orm.Session = fastapi.Depends(get_db)
     ):
 
-    """intro-->This endpoint allows you to send an sms. To use this endpoint you need to make a post request to the /sms/send endpoint
+    """intro-->This endpoint allows you to send an sms. To use this endpoint you need to make a post request to the /sms/send endpoint.
+        The message is queued and delivered in the background, use the /sms/{sms_id} endpoint to follow its delivery status
 
         reqBody-->sender: This is the name of the sender
-        reqBody-->recipient: This is the recipient of the sms
-        reqBody-->body: This is the content of the sms
-        reqBody-->provider: This is the network provider
-        reqBody-->user: This the current user 
-        reqBody-->passkey: This is unique passkey
+        reqBody-->recipient: This is the list of recipients of the sms
+        reqBody-->content: This is the content of the sms
+        reqBody-->message_type: This is the type of message, this is sms by default
     
     returnDesc--> On sucessful request, it returns message,
-        returnBody--> "success"
+        returnBody--> "sms queued" and the queued messages
     """ 
- 
-    data={
-        "sender": sms_details.sender,
-        "message_type": sms_details.message_type,
-        "customers": sms_details.recipient,
-        "content": sms_details.content         
-    }
-
-    headers={
-        'Content-Type': 'application/json',
-        "ORGANIZATION-KEY":ORGANIZATION_KEY, 
-        "ORGANIZATION-ID": ORGANIZATION_ID
-    }
-
-    req = requests.post(
-        url=SMS_API, 
-        json=data,
-        headers=headers
+
+    messages = sms_services.enqueue_sms(
+        sender=sms_details.sender,
+        recipients=sms_details.recipient,
+        content=sms_details.content,
+        message_type=sms_details.message_type,
+        db=db
     )
 
-    if req.text["status"] == True:
-        sms = sms_models.SMS(
-                id=uuid4().hex,
-                sender=sms_details.sender,
-                recipient=sms_details.recipient,
-                body=sms_details.body
-            )
+    # the dispatcher opens its own session, the request session is closed by then
+    background_tasks.add_task(sms_services.dispatch_pending_sms)
+
+    return {"message": "sms queued", "data": messages}
+
+
+@app.get("/sms/{sms_id}", response_model=sms_schema.SMSOut)
+def get_sms_status(sms_id: str, db: orm.Session = fastapi.Depends(get_db)):
+    """intro-->This endpoint allows you to retrieve the delivery status of a queued sms. To use this endpoint you need to make a get request to the /sms/{sms_id} endpoint
 
-        db.add(sms)
-        db.commit()
-        db.refresh(sms)
+        paramDesc-->On get request, the url takes the parameter, sms_id
+            param-->sms_id: This is the unique id of the queued sms
 
-    return json.loads(req.text)
+    returnDesc--> On sucessful request, it returns
+        returnBody--> the sms with its status, attempts and last error
+    """
+    sms = db.query(sms_models.SMS).filter(sms_models.SMS.id == sms_id).first()
+    if sms is None:
+        raise fastapi.HTTPException(status_code=404, detail="SMS does not exist")
+
+    return sms
 
 
 async def send_sms(
@@ -83,24 +87,27 @@ async def send_sms(
         message_type: str = "sms"
     ):
 
- 
-    data={
-        "sender": sender,
-        "message_type": message_type,
-        "customers": recipient,
-        "content": content         
-    }
-
-    headers={
-        'Content-Type': 'application/json',
-        "ORGANIZATION-KEY":ORGANIZATION_KEY, 
-        "ORGANIZATION-ID": ORGANIZATION_ID
-    }
-
-    req = requests.post(
-        url=SMS_API, 
-        json=data,
-        headers=headers
+    return sms_services.post_to_provider(
+        sender=sender,
+        recipients=recipient,
+        content=content,
+        message_type=message_type
+    )
+
+
+def queue_sms(
+        sender: str,
+        recipient: list,
+        content: str,
+        db: orm.Session,
+        message_type: str = "sms",
+        background_tasks: Optional[BackgroundTasks] = None
+    ):
+
+    messages = sms_services.enqueue_sms(
+        sender=sender, recipients=recipient, content=content, message_type=message_type, db=db
     )
+    if background_tasks is not None:
+        background_tasks.add_task(sms_services.dispatch_pending_sms)
 
-    return json.loads(req.text)
\ No newline at end of file
+    return messages
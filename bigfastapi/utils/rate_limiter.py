@@ -0,0 +1,33 @@
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    Thread safe limiter that spaces calls out so that no more than
+    `rate` calls per second are made. Callers block in `acquire` until
+    their slot is due.
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate and rate > 0 else 0.0
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+
+    def reserve(self) -> float:
+        """Book the next slot and return how long the caller has to wait for it"""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+            return slot - now
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def penalize(self, seconds: float):
+        """Push the next slot back, e.g. when the remote asks us to retry later"""
+        with self._lock:
+            self._next_slot = max(self._next_slot, time.monotonic() + seconds)
@@ -33,6 +33,49 @@ ANCHOR_API_URL=config("ANCHOR_API_URL")
 TELEX_ORGANIZATION_ID=config("TELEX_ORGANIZATION_ID")
 TELEX_ORGANIZATION_KEY=config("TELEX_ORGANIZATION_KEY")
 SMS_API=config("SMS_API")
+SMS_BATCH_SIZE=config("SMS_BATCH_SIZE", default=100, cast=int)
+SMS_RATE_LIMIT=config("SMS_RATE_LIMIT", default=5, cast=float)
+SMS_MAX_RETRIES=config("SMS_MAX_RETRIES", default=5, cast=int)
+SMS_RETRY_BACKOFF=config("SMS_RETRY_BACKOFF", default=30, cast=int)
+NOTIFICATION_PUBSUB_URL=config("NOTIFICATION_PUBSUB_URL", default="")
+NOTIFICATION_COALESCE_WINDOW=config("NOTIFICATION_COALESCE_WINDOW", default=300, cast=int)
+NOTIFICATION_DIGEST_INTERVAL=config("NOTIFICATION_DIGEST_INTERVAL", default=3600, cast=int)
+NOTIFICATION_RECONCILE_INTERVAL=config("NOTIFICATION_RECONCILE_INTERVAL", default=86400, cast=int)
+ACTIVITY_LOG_BATCH_SIZE=config("ACTIVITY_LOG_BATCH_SIZE", default=500, cast=int)
+ACTIVITY_LOG_FLUSH_INTERVAL=config("ACTIVITY_LOG_FLUSH_INTERVAL", default=2, cast=float)
+ACTIVITY_LOG_MAX_BUFFER=config("ACTIVITY_LOG_MAX_BUFFER", default=50000, cast=int)
+ACTIVITY_LOG_RETENTION_DAYS=config("ACTIVITY_LOG_RETENTION_DAYS", default=0, cast=int)
+ACTIVITY_LOG_PARTITIONS_AHEAD=config("ACTIVITY_LOG_PARTITIONS_AHEAD", default=2, cast=int)
+ACTIVITY_LOG_MAINTENANCE_INTERVAL=config("ACTIVITY_LOG_MAINTENANCE_INTERVAL", default=86400, cast=int)
+IMPORT_WORKERS=config("IMPORT_WORKERS", default=4, cast=int)
+IMPORT_CHUNK_BYTES=config("IMPORT_CHUNK_BYTES", default=16 * 1024 * 1024, cast=int)
+EXPORT_CHUNK_SIZE=config("EXPORT_CHUNK_SIZE", default=1000, cast=int)
+EXPORT_BUCKET=config("EXPORT_BUCKET", default="exports")
+EXPORT_LEASE=config("EXPORT_LEASE", default=600, cast=int)
+VIRTUAL_TABLE_INDEX_THRESHOLD=config("VIRTUAL_TABLE_INDEX_THRESHOLD", default=100, cast=int)
+FILTER_CACHE_SIZE=config("FILTER_CACHE_SIZE", default=1024, cast=int)
+FILTER_COUNT_TTL=config("FILTER_COUNT_TTL", default=300, cast=int)
+WALLET_SNAPSHOT_INTERVAL=config("WALLET_SNAPSHOT_INTERVAL", default=3600, cast=int)
+FREECURRENCY_API_KEY=config("FREECURRENCY_API_KEY", default="")
+EXCHANGE_RATE_API_URL=config("EXCHANGE_RATE_API_URL", default="https://api.currencyapi.com/v2/latest")
+EXCHANGE_RATE_TTL=config("EXCHANGE_RATE_TTL", default=3600, cast=int)
+# a JSON file of rates per USD, used instead of the API when set, e.g in development
+EXCHANGE_RATE_FIXTURE=config("EXCHANGE_RATE_FIXTURE", default="")
+FRONTEND_URL=config("FRONTEND_URL", default="")
+STRIPE_SEC_KEY=config("STRIPE_SEC_KEY", default="")
+FLUTTERWAVE_SEC_KEY=config("FLUTTERWAVE_SEC_KEY", default="")
+PAYMENT_MAX_ATTEMPTS=config("PAYMENT_MAX_ATTEMPTS", default=5, cast=int)
+PAYMENT_RETRY_INTERVAL=config("PAYMENT_RETRY_INTERVAL", default=60, cast=int)
+PAYMENT_PROCESSING_LEASE=config("PAYMENT_PROCESSING_LEASE", default=300, cast=int)
+RECEIPT_WORKERS=config("RECEIPT_WORKERS", default=4, cast=int)
+RECEIPT_MAX_ATTEMPTS=config("RECEIPT_MAX_ATTEMPTS", default=5, cast=int)
+RECEIPT_RETRY_INTERVAL=config("RECEIPT_RETRY_INTERVAL", default=60, cast=int)
+RECEIPT_PROCESSING_LEASE=config("RECEIPT_PROCESSING_LEASE", default=600, cast=int)
+RECEIPT_BULK_LIMIT=config("RECEIPT_BULK_LIMIT", default=500, cast=int)
+SLACK_FLUSH_INTERVAL=config("SLACK_FLUSH_INTERVAL", default=5, cast=float)
+SLACK_BATCH_SIZE=config("SLACK_BATCH_SIZE", default=20, cast=int)
+SLACK_MAX_PENDING=config("SLACK_MAX_PENDING", default=500, cast=int)
+SLACK_RATE_LIMIT=config("SLACK_RATE_LIMIT", default=1, cast=float)
 
 # EMAIL_VERIFICATION_TEMPLATE="email/welcome_email.html"
 # PASSWORD_RESET_TEMPLATE="email/password_reset.html"
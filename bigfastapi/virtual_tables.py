@@ -1,13 +1,136 @@
-from fastapi import APIRouter
+from typing import List
+
+import sqlalchemy.orm as orm
+from fastapi import APIRouter, BackgroundTasks, Depends
+
+from bigfastapi.core.helpers import Helpers
+from bigfastapi.db.database import get_db
+from bigfastapi.schemas import users_schemas
+from bigfastapi.schemas import virtual_table_schemas as schemas
+from bigfastapi.services import virtual_table_services
+from bigfastapi.services.auth_service import is_authenticated
 
 app = APIRouter(tags=["Virtual Tables"])
 
 
-@app.post("/virtual-tables", status_code=201)
-def create_virtual_table():
-    pass
+@app.post("/virtual-tables", status_code=201, response_model=schemas.VirtualTable)
+async def create_virtual_table(
+    table: schemas.VirtualTableCreate,
+    user: users_schemas.User = Depends(is_authenticated),
+    db: orm.Session = Depends(get_db),
+):
+    """intro-->This endpoint allows you to create a table with columns of your own. To use this endpoint you need to make a post request to the /virtual-tables endpoint
+
+            reqBody-->organization_id: This is the organization the table belongs to
+            reqBody-->name: This is the name of the table
+            reqBody-->parent_object_name: Optional, the object the table extends
+            reqBody-->columns: The columns of the table, each with a name and a type, str or int. A table has at most 3 columns of each type
+
+    returnDesc--> On sucessful request, it returns
+        returnBody--> the table with its columns
+    """
+    await Helpers.check_user_org_validity(user.id, table.organization_id, db)
+    virtual_table = virtual_table_services.create_virtual_table(table, db)
+
+    return schemas.VirtualTable(
+        id=virtual_table.id, name=virtual_table.name, parent_object_name=virtual_table.parent_object_name,
+        organization_id=virtual_table.organization_id, date_created=virtual_table.date_created,
+        columns=[schemas.VirtualColumn(name=column.name, type=column.type) for column in table.columns])
+
+
+@app.get("/virtual-tables", status_code=200, response_model=List[schemas.VirtualTable])
+async def get_virtual_tables(
+    organization_id: str,
+    user: users_schemas.User = Depends(is_authenticated),
+    db: orm.Session = Depends(get_db),
+):
+    """intro-->This endpoint allows you to retrieve the tables of an organization. To use this endpoint you need to make a get request to the /virtual-tables endpoint
+
+            paramDesc-->On get request, the url takes the parameter, organization_id
+                param-->organization_id: This is the organization whose tables are retrieved
+
+    returnDesc--> On sucessful request, it returns
+        returnBody--> the tables with their columns
+    """
+    await Helpers.check_user_org_validity(user.id, organization_id, db)
+    return virtual_table_services.list_virtual_tables(organization_id, db)
+
+
+@app.post("/virtual-tables/{table_id}/rows", status_code=201)
+async def insert_virtual_table_row(
+    table_id: str,
+    organization_id: str,
+    body: schemas.VirtualRowCreate,
+    user: users_schemas.User = Depends(is_authenticated),
+    db: orm.Session = Depends(get_db),
+):
+    """intro-->This endpoint allows you to add a row to a table. To use this endpoint you need to make a post request to the /virtual-tables/{table_id}/rows endpoint
+
+            paramDesc-->On post request, the url takes the parameters, table_id and organization_id
+                param-->table_id: This is the id of the table
+                param-->organization_id: This is the organization the table belongs to
+
+            reqBody-->row: The values of the row by column name
+
+    returnDesc--> On sucessful request, it returns
+        returnBody--> the id of the row
+    """
+    await Helpers.check_user_org_validity(user.id, organization_id, db)
+    table = virtual_table_services.get_virtual_table(table_id, organization_id, db)
+
+    ids = virtual_table_services.insert_rows(table, [body.row], db)
+    return {"id": ids[0]}
+
+
+@app.post("/virtual-tables/{table_id}/rows/bulk", status_code=201)
+async def insert_virtual_table_rows(
+    table_id: str,
+    organization_id: str,
+    body: schemas.VirtualRowsCreate,
+    user: users_schemas.User = Depends(is_authenticated),
+    db: orm.Session = Depends(get_db),
+):
+    """intro-->This endpoint allows you to add up to 1000 rows to a table at once. To use this endpoint you need to make a post request to the /virtual-tables/{table_id}/rows/bulk endpoint
+
+            paramDesc-->On post request, the url takes the parameters, table_id and organization_id
+                param-->table_id: This is the id of the table
+                param-->organization_id: This is the organization the table belongs to
+
+            reqBody-->rows: The rows, each with its values by column name
+
+    returnDesc--> On sucessful request, it returns
+        returnBody--> the ids of the rows, in the order they were given
+    """
+    await Helpers.check_user_org_validity(user.id, organization_id, db)
+    table = virtual_table_services.get_virtual_table(table_id, organization_id, db)
+
+    return {"ids": virtual_table_services.insert_rows(table, body.rows, db)}
+
+
+@app.post("/virtual-tables/{table_id}/query", status_code=200, response_model=schemas.VirtualRowsPage)
+async def query_virtual_table(
+    table_id: str,
+    organization_id: str,
+    query: schemas.VirtualTableQuery,
+    background_tasks: BackgroundTasks,
+    user: users_schemas.User = Depends(is_authenticated),
+    db: orm.Session = Depends(get_db),
+):
+    """intro-->This endpoint allows you to query the rows of a table. To use this endpoint you need to make a post request to the /virtual-tables/{table_id}/query endpoint
+
+            paramDesc-->On post request, the url takes the parameters, table_id and organization_id
+                param-->table_id: This is the id of the table
+                param-->organization_id: This is the organization the table belongs to
+
+            reqBody-->filters: Optional, conditions rows must meet, each with a column, an op (eq, ne, lt, lte, gt, gte, in, startswith, contains or is_null) and a value
+            reqBody-->sort: Optional, the columns to order rows by, each with a direction, asc or desc
+            reqBody-->cursor: Optional, the next_cursor of a previous response, the rows after it are returned
+            reqBody-->size: The number of rows to return, this is 50 by default
 
+    returnDesc--> On sucessful request, it returns
+        returnBody--> a page of rows and the cursor of the next page, if any
+    """
+    await Helpers.check_user_org_validity(user.id, organization_id, db)
+    table = virtual_table_services.get_virtual_table(table_id, organization_id, db)
 
-@app.get("/virtual-tables", status_code=200)
-def get_virtual_tables():
-    pass
+    return virtual_table_services.query_rows(table, query, db, background_tasks=background_tasks)
@@ -1,3 +1,4 @@
+import asyncio
 import datetime 
 from uuid import uuid4
 from typing import List
@@ -11,10 +12,24 @@ from bigfastapi.core.helpers import Helpers
 from bigfastapi.core import messages
 from bigfastapi.models import organization_models, user_models, wallet_models as model
 from bigfastapi.schemas import users_schemas, wallet_schemas as schema
+from bigfastapi.services import wallet_services
 from bigfastapi.utils import paginator
 
 
 app = APIRouter(tags=["Wallet"])
+snapshot_scheduler = None
+
+
+@app.on_event("startup")
+async def start_wallet_snapshots():
+    global snapshot_scheduler
+    snapshot_scheduler = asyncio.create_task(wallet_services.wallet_snapshot_scheduler())
+
+
+@app.on_event("shutdown")
+async def stop_wallet_snapshots():
+    if snapshot_scheduler is not None:
+        snapshot_scheduler.cancel()
 
 
 @app.post("/wallets", response_model=schema.Wallet)
@@ -198,6 +213,53 @@ async def get_wallet_transactions(
     return await get_wallet_transactions(wallet_id=wallet.id, db=db)
 
 
+@app.get("/wallets/{wallet_id}/balance", response_model=schema.WalletBalance)
+async def get_wallet_balance_at(
+        wallet_id: str,
+        at: datetime.datetime = None,
+        user: users_schemas.User = fastapi.Depends(is_authenticated),
+        db: orm.Session = fastapi.Depends(get_db),
+):
+    """intro-->This endpoint allows you to retrieve the balance of a wallet at any moment. To use this endpoint you need to make a get request to the /wallets/{wallet_id}/balance endpoint
+
+            paramDesc-->On get request, the request url takes the parameter wallet id and one(1) optional query parameter
+                param-->wallet_id: This is the unique id of the wallet
+                param-->at: This is the moment of interest, this is now by default
+
+    returnDesc--> On sucessful request, it returns
+        returnBody--> the balance of the wallet at that moment
+    """
+    wallet = await get_wallet(wallet_id=wallet_id, user=user, db=db)
+    await Helpers.check_user_org_validity(user.id, wallet.organization_id, db)
+
+    at = at or datetime.datetime.utcnow()
+    return {"wallet_id": wallet.id, "at": at, "balance": wallet_services.balance_at(wallet.id, at, db)}
+
+
+@app.get("/wallets/{wallet_id}/daily-balances", response_model=schema.DailyBalances)
+async def get_wallet_daily_balances(
+        wallet_id: str,
+        start: datetime.date,
+        end: datetime.date = None,
+        user: users_schemas.User = fastapi.Depends(is_authenticated),
+        db: orm.Session = fastapi.Depends(get_db),
+):
+    """intro-->This endpoint allows you to retrieve a daily statement of a wallet, e.g to chart its balance. To use this endpoint you need to make a get request to the /wallets/{wallet_id}/daily-balances endpoint
+
+            paramDesc-->On get request, the request url takes the parameter wallet id and two(2) query parameters
+                param-->wallet_id: This is the unique id of the wallet
+                param-->start: This is the first day of the statement
+                param-->end: This is the last day of the statement, this is today by default. A statement covers at most 366 days
+
+    returnDesc--> On sucessful request, it returns
+        returnBody--> the balance before the first day and the closing balance, credits, debits and number of transactions of every day
+    """
+    wallet = await get_wallet(wallet_id=wallet_id, user=user, db=db)
+    await Helpers.check_user_org_validity(user.id, wallet.organization_id, db)
+
+    return wallet_services.daily_balances(wallet.id, start, end or datetime.datetime.utcnow().date(), db)
+
+
 ############
 # Services #
 ############
@@ -311,51 +373,24 @@ async def get_super_admin_wallet(db: orm.Session, currency: str):
     return wallet
 
 
-async def create_wallet_transaction(wallet, amount: float, db: orm.Session, currency: str, reason=''):
-    wallet_transaction = model.WalletTransaction(id=uuid4().hex, wallet_id=wallet.id,
-                                                            currency_code=currency, amount=amount,
-                                                            transaction_date=datetime.datetime.utcnow(),
-                                                            transaction_ref=reason, status=True  )
-
-    db.add(wallet_transaction)
-    db.commit()
-    db.refresh(wallet_transaction)
-
-    wallet.balance += amount
-    wallet.last_updated = datetime.datetime.utcnow()
-    db.commit()
+async def create_wallet_transaction(wallet, amount: float, db: orm.Session, currency: str, reason='',
+                                    idempotency_key: str = None):
+    wallet_transaction = wallet_services.post_wallet_transaction(
+        wallet_id=wallet.id, amount=amount, currency=currency, db=db, reason=reason,
+        idempotency_key=idempotency_key)
     db.refresh(wallet)
+    return wallet_transaction
 
 
-
-
-
-
-async def update_wallet(wallet, amount: float, db: orm.Session, currency: str, wallet_transaction_id='', reason=''):
-    # update the wallet
-    # wallet.balance += amount
-    # wallet.last_updated = datetime.datetime.utcnow()
-    # db.commit()
-    # db.refresh(wallet)
-
+async def update_wallet(wallet, amount: float, db: orm.Session, currency: str, wallet_transaction_id='', reason='',
+                        idempotency_key: str = None):
     if wallet_transaction_id == '':
-        wallet_transaction = model.WalletTransaction(id=uuid4().hex, wallet_id=wallet.id,
-                                                                         currency_code=currency, amount=amount,
-                                                                         transaction_date=datetime.datetime.utcnow(),
-                                                                         transaction_ref=reason, status=True)
-        db.add(wallet_transaction)
-        db.commit()
-        db.refresh(wallet_transaction)
-
+        wallet_services.post_wallet_transaction(wallet_id=wallet.id, amount=amount, currency=currency, db=db,
+                                                reason=reason, idempotency_key=idempotency_key)
     else:
-        # update a wallet transaction
-        wallet_transaction = db.query(model.WalletTransaction).filter_by(
-            id=wallet_transaction_id).first()
-        wallet_transaction.status = True
-        if reason != '':
-            wallet_transaction.transaction_ref = reason
-        db.commit()
-        db.refresh(wallet_transaction)
+        # settle a pending wallet transaction, once
+        wallet_services.settle_wallet_transaction(wallet_transaction_id, db, amount=amount, reason=reason)
+    db.refresh(wallet)
 
     # if amount < 0:
     #     amount = -amount
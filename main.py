@@ -31,6 +31,7 @@ from bigfastapi.email import app as email
 # Import all the functionality that BFA provides
 from bigfastapi.faq import app as faq
 from bigfastapi.files import app as files
+from bigfastapi.filters import app as filters
 from bigfastapi.google_auth import app as social_auth
 from bigfastapi.notification import app as notification
 from bigfastapi.organization import app as organization
@@ -44,6 +45,7 @@ from bigfastapi.sms import app as sms
 from bigfastapi.subscription import app as sub
 from bigfastapi.tutorial import app as tutorial
 from bigfastapi.users import app as accounts_router
+from bigfastapi.virtual_tables import app as virtual_tables
 from bigfastapi.utils import settings as env_var
 from bigfastapi.wallet import app as wallet
 
@@ -267,6 +269,8 @@ app.include_router(sms)
 app.include_router(activity_log)
 app.include_router(api_key)
 app.include_router(landing_page)
+app.include_router(virtual_tables)
+app.include_router(filters)
 
 
 @app.get("/", tags=["Home"])
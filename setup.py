@@ -66,6 +66,7 @@ setuptools.setup(
         "pycparser",
         "pydantic",
         "fastapi_pagination",
+        "httpx",
         "PyJWT",
         "pyparsing",
         "authlib",
@@ -77,6 +78,7 @@ setuptools.setup(
         "python-jose[cryptography]",
         "python-multipart",
         "PyYAML",
+        "redis>=4.2",
         "requests",
         "rfc3986",
         "six",
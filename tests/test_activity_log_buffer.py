@@ -0,0 +1,111 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from bigfastapi import activity_log
+from bigfastapi.db import database
+from bigfastapi.models.activity_log_models import Activitylog
+from bigfastapi.services import activity_log_services
+
+
+@pytest.fixture
+def make_session():
+    engine = create_engine(
+        "sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    database.Base.metadata.create_all(engine, tables=[Activitylog.__table__])
+    return sessionmaker(bind=engine)
+
+
+@pytest.fixture
+def announced(monkeypatch):
+    messages = []
+    monkeypatch.setattr(activity_log_services.Helpers, "slack_notification",
+                        lambda url, text, verify=True: messages.append(text))
+    return messages
+
+
+def make_buffer(make_session, **options):
+    options = {"batch_size": 100, "flush_interval": 60, "max_size": 1000, **options}
+    return activity_log_services.ActivityLogBuffer(session_factory=make_session, **options)
+
+
+def stored(make_session):
+    with make_session() as db:
+        return db.query(Activitylog).count()
+
+
+def log_for(buffer, monkeypatch, count):
+    monkeypatch.setattr(activity_log_services, "buffer", buffer)
+    user = SimpleNamespace(id="u1", first_name="Ada", last_name=None)
+    for i in range(count):
+        activity_log.createActivityLog(
+            "Comment", f"c{i}", user, {"organization_id": "org", "object_url": "comment", "action": "added a comment"})
+
+
+def test_logs_are_written_in_batches(make_session, announced, monkeypatch):
+    buffer = make_buffer(make_session, batch_size=3)
+    log_for(buffer, monkeypatch, 2)
+    # below the batch size nothing hits the database yet
+    assert stored(make_session) == 0
+
+    log_for(buffer, monkeypatch, 1)
+    deadline = time.monotonic() + 2
+    while stored(make_session) < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert stored(make_session) == 3
+    assert announced == ["Ada   added a comment"] * 3
+    buffer.close()
+
+
+def test_logs_are_flushed_on_interval_and_close(make_session, announced, monkeypatch):
+    buffer = make_buffer(make_session, flush_interval=0.05)
+    log_for(buffer, monkeypatch, 1)
+    time.sleep(0.3)
+    assert stored(make_session) == 1
+
+    buffer._closed = True
+    log_for(buffer, monkeypatch, 2)
+    buffer.close()
+    assert stored(make_session) == 3
+    assert buffer.pending() == 0
+
+
+def test_failed_batches_are_kept_for_the_next_flush(make_session, announced, monkeypatch):
+    buffer = make_buffer(make_session)
+    log_for(buffer, monkeypatch, 2)
+    write = buffer._write
+
+    def fail(entries):
+        raise OperationalError("INSERT", {}, ConnectionRefusedError("database is down"))
+
+    monkeypatch.setattr(buffer, "_write", fail)
+    assert buffer.flush() == 0
+    assert buffer.pending() == 2
+
+    monkeypatch.setattr(buffer, "_write", write)
+    assert buffer.flush() == 2
+    buffer.close()
+
+
+def test_rows_that_can_not_be_written_are_dropped(make_session, announced, monkeypatch):
+    buffer = make_buffer(make_session)
+    log_for(buffer, monkeypatch, 3)
+    write = buffer._write
+
+    def reject_c1(entries):
+        if any(entry["model_id"] == "c1" for entry in entries):
+            raise IntegrityError("INSERT", {}, ValueError("bad row"))
+        write(entries)
+
+    monkeypatch.setattr(buffer, "_write", reject_c1)
+    assert buffer.flush() == 2
+    assert buffer.pending() == 0
+    assert stored(make_session) == 2
+    assert len(announced) == 2
+    buffer.close()
@@ -0,0 +1,125 @@
+import asyncio
+import datetime as _dt
+from uuid import uuid4
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session, sessionmaker
+
+from bigfastapi import activity_log
+from bigfastapi.db import database
+from bigfastapi.models.activity_log_models import Activitylog
+from bigfastapi.services import activity_log_services
+
+
+@pytest.fixture(scope="function")
+def db_session():
+    engine = create_engine("sqlite:///:memory:")
+    database.Base.metadata.create_all(engine, tables=[Activitylog.__table__])
+    session = Session(bind=engine)
+    yield session
+    session.close()
+
+
+def add_logs(db, created_at, count=1, organization_id="org", is_deleted=False):
+    logs = [Activitylog(id=uuid4().hex, organization_id=organization_id, model_name="Invoice",
+                        action=f"action {i}", created_at=created_at, is_deleted=is_deleted)
+            for i in range(count)]
+    db.add_all(logs)
+    db.commit()
+    return logs
+
+
+def test_logs_are_paged_newest_first(db_session):
+    now = _dt.datetime.now()
+    add_logs(db_session, now - _dt.timedelta(days=2), count=2)
+    # logs written in the same batch share created_at, the id keeps the order stable
+    add_logs(db_session, now, count=3)
+    add_logs(db_session, now - _dt.timedelta(days=1), is_deleted=True)
+    add_logs(db_session, now, organization_id="other")
+
+    seen, cursor = [], None
+    while True:
+        page, cursor = activity_log.getOrganizationActivitiesLog("org", db_session, cursor=cursor, size=2)
+        seen.extend(page)
+        if cursor is None:
+            break
+
+    assert len(seen) == 5
+    assert len({log.id for log in seen}) == 5
+    assert [(log.created_at, log.id) for log in seen] == sorted(
+        [(log.created_at, log.id) for log in seen], reverse=True)
+
+
+def test_unknown_cursor_is_rejected(db_session):
+    other = add_logs(db_session, _dt.datetime.now(), organization_id="other")[0]
+
+    with pytest.raises(HTTPException):
+        activity_log.getOrganizationActivitiesLog("org", db_session, cursor=other.id)
+
+
+def test_retention_deletes_expired_rows_without_partitions(db_session):
+    now = _dt.datetime.now()
+    add_logs(db_session, now - _dt.timedelta(days=40), count=5)
+    kept = add_logs(db_session, now - _dt.timedelta(days=10), count=2)
+
+    assert activity_log_services.expire_activity_logs(db_session, retention_days=0) == {"partitions": [], "rows": 0}
+    assert db_session.query(Activitylog).count() == 7
+
+    expired = activity_log_services.expire_activity_logs(db_session, retention_days=30)
+
+    assert expired == {"partitions": [], "rows": 5}
+    assert {log.id for log in db_session.query(Activitylog)} == {log.id for log in kept}
+
+
+def test_expired_rows_are_deleted_in_chunks(db_session):
+    add_logs(db_session, _dt.datetime.now() - _dt.timedelta(days=40), count=7)
+    cutoff = _dt.datetime.now() - _dt.timedelta(days=30)
+
+    assert activity_log_services.delete_activity_logs_before(cutoff, db_session, chunk_size=3) == 7
+    assert db_session.query(Activitylog).count() == 0
+
+
+def test_router_runs_maintenance_on_startup(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path}/logs.db", connect_args={"check_same_thread": False})
+    database.Base.metadata.create_all(engine, tables=[Activitylog.__table__])
+    monkeypatch.setattr(activity_log_services, "SessionLocal", sessionmaker(bind=engine))
+    monkeypatch.setattr(activity_log_services.settings, "ACTIVITY_LOG_RETENTION_DAYS", 30)
+    db = Session(bind=engine)
+    add_logs(db, _dt.datetime.now() - _dt.timedelta(days=40), count=3)
+
+    async def run_maintenance():
+        await activity_log.start_activity_log_maintenance()
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if db.query(Activitylog).count() == 0:
+                break
+        await activity_log.stop_activity_log_maintenance()
+
+    asyncio.run(run_maintenance())
+
+    assert db.query(Activitylog).count() == 0
+    db.close()
+
+
+def test_sqlite_is_not_partitioned(db_session):
+    assert activity_log_services.partitioning(db_session) is None
+    assert activity_log_services.ensure_activity_log_partitions(db_session) == []
+
+
+def test_partition_ddl():
+    months = [_dt.datetime(2026, 11, 1), _dt.datetime(2026, 12, 1)]
+
+    assert activity_log_services.create_partitions_ddl("postgresql", months)[1] == (
+        "CREATE TABLE IF NOT EXISTS activity_logs_p202612 PARTITION OF activity_logs "
+        "FOR VALUES FROM ('2026-12-01') TO ('2027-01-01')")
+    assert activity_log_services.create_partitions_ddl("mysql", months) == [
+        "ALTER TABLE activity_logs REORGANIZE PARTITION p_future INTO ("
+        "PARTITION p202611 VALUES LESS THAN ('2026-12-01'), "
+        "PARTITION p202612 VALUES LESS THAN ('2027-01-01'), "
+        "PARTITION p_future VALUES LESS THAN (MAXVALUE))"]
+    assert activity_log_services.drop_partitions_ddl("mysql", ["p202601", "p202602"]) == [
+        "ALTER TABLE activity_logs DROP PARTITION p202601, p202602"]
+    assert activity_log_services.drop_partitions_ddl("postgresql", ["p202601"]) == [
+        "DROP TABLE IF EXISTS activity_logs_p202601"]
@@ -0,0 +1,68 @@
+from uuid import uuid4
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+
+from bigfastapi.db import database
+from bigfastapi.db.bulk import soft_delete
+from bigfastapi.models.activity_log_models import Activitylog
+from bigfastapi.models.file_models import File
+from bigfastapi.models.receipt_models import Receipt
+
+
+@pytest.fixture(scope="function")
+def db_session():
+    engine = create_engine("sqlite:///:memory:")
+    database.Base.metadata.create_all(
+        engine, tables=[File.__table__, Receipt.__table__, Activitylog.__table__])
+    session = Session(bind=engine)
+    yield session
+    session.close()
+
+
+def count_statements(db):
+    statements = []
+    event.listen(db.get_bind(), "before_cursor_execute",
+                 lambda conn, cursor, statement, *args: statements.append(statement))
+    return statements
+
+
+def live(db, model, organization_id):
+    return db.query(model).filter_by(organization_id=organization_id, is_deleted=False).count()
+
+
+def test_whole_organization_is_one_statement(db_session):
+    db_session.bulk_insert_mappings(Activitylog, [
+        {"id": uuid4().hex, "organization_id": organization_id, "is_deleted": False}
+        for organization_id in ["org"] * 5000 + ["other"] * 3
+    ])
+    db_session.commit()
+
+    statements = count_statements(db_session)
+    deleted = soft_delete(Activitylog, organization_id="org", db=db_session)
+
+    assert deleted == 5000
+    assert len([s for s in statements if s.startswith("UPDATE")]) == 1
+    assert live(db_session, Activitylog, "org") == 0
+    assert live(db_session, Activitylog, "other") == 3
+
+
+def test_id_lists_are_chunked_and_scoped(db_session):
+    ids = [uuid4().hex for _ in range(2500)]
+    foreign = uuid4().hex
+    db_session.bulk_insert_mappings(Receipt, [
+        {"id": id, "organization_id": "org", "is_deleted": False} for id in ids
+    ] + [{"id": foreign, "organization_id": "other", "is_deleted": False}])
+    db_session.commit()
+
+    statements = count_statements(db_session)
+    deleted = soft_delete(Receipt, organization_id="org", ids=ids[:2100] + [foreign, ids[0]], db=db_session)
+
+    assert deleted == 2100
+    assert len([s for s in statements if s.startswith("UPDATE")]) == 3
+    assert live(db_session, Receipt, "org") == 400
+    # the receipt of another organization is out of reach
+    assert live(db_session, Receipt, "other") == 1
+    # deleting again affects nothing
+    assert soft_delete(Receipt, organization_id="org", ids=ids[:10], db=db_session) == 0
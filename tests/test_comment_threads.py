@@ -0,0 +1,125 @@
+from uuid import uuid4
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+
+from bigfastapi import comments
+from bigfastapi.db import database
+from bigfastapi.models import comments_models
+from bigfastapi.schemas import comments_schemas
+
+
+@pytest.fixture(scope="function")
+def db_session():
+    engine = create_engine("sqlite:///:memory:")
+    database.Base.metadata.create_all(
+        engine, tables=[comments_models.Comment.__table__, comments_models.CommentVote.__table__,
+                       comments_models.CommentSummary.__table__])
+    session = Session(bind=engine)
+    yield session
+    session.close()
+
+
+def comment(db, object_id="invoice-1", text="hello"):
+    return comments.db_create_comment_for_object(
+        object_id=object_id, model_type="invoice", db=db,
+        comment=comments_schemas.CommentBase(id=uuid4().hex, text=text, commenter_id="u1"))
+
+
+def reply(db, parent, text="reply"):
+    return comments.db_reply_to_comment(
+        model_type="invoice", comment_id=parent.id, db=db,
+        comment=comments_schemas.CommentCreate(text=text, commenter_id="u1"))
+
+
+@pytest.fixture
+def thread(db_session):
+    root = comment(db_session)
+    first, second, third = [reply(db_session, root, text=f"reply {i}") for i in range(3)]
+    nested = reply(db_session, first, text="nested")
+    deepest = reply(db_session, nested, text="deepest")
+    return root, first, second, third, nested, deepest
+
+
+def test_thread_loads_in_one_query(db_session, thread):
+    root, first, second, third, nested, deepest = thread
+    other = comment(db_session, text="another thread")
+    db_session.expire_all()
+    roots = comments.db_retrieve_all_comments_for_object("invoice-1", "invoice", db_session).all()
+
+    statements = []
+    listen = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(db_session.get_bind(), "before_cursor_execute", listen)
+    threads = comments.db_load_comment_threads(roots, db=db_session)
+    event.remove(db_session.get_bind(), "before_cursor_execute", listen)
+
+    assert len(statements) == 1
+    by_id = {t.id: t for t in threads}
+    assert by_id[other.id].replies == []
+    loaded = by_id[root.id]
+    assert [r.text for r in loaded.replies] == ["reply 0", "reply 1", "reply 2"]
+    assert loaded.replies[0].replies[0].replies[0].id == deepest.id
+    assert deepest.path == f"{root.id}/{first.id}/{nested.id}/{deepest.id}/"
+
+
+def test_depth_and_replies_limits(db_session, thread):
+    root, first, second, third, nested, deepest = thread
+
+    loaded = comments.db_load_comment_threads([root], db=db_session, max_depth=1, replies_limit=2)[0]
+
+    assert [r.id for r in loaded.replies] == [first.id, second.id]
+    assert loaded.replies[0].replies == []
+    assert loaded.replies_cursor == second.id
+
+    more, next_cursor = comments.db_retrieve_replies_page(root, cursor=loaded.replies_cursor, size=2, db=db_session)
+    assert [r.id for r in more] == [third.id]
+    assert next_cursor is None
+
+
+def test_delete_removes_the_subtree(db_session, thread):
+    root, first, second, third, nested, deepest = thread
+    kept = {root.id, second.id, third.id}
+    nested_id = nested.id
+
+    deleted = comments.db_delete_comment(object_id=first.id, model_type="invoice", db=db_session)
+
+    assert deleted.replies[0].id == nested_id
+    assert {c.id for c in db_session.query(comments_models.Comment)} == kept
+
+
+def test_rebuild_paths_for_existing_comments(db_session, thread):
+    root, first, second, third, nested, deepest = thread
+    db_session.query(comments_models.Comment).update({"path": None, "depth": 0})
+    db_session.commit()
+
+    assert comments.db_rebuild_comment_paths(db_session) == 6
+
+    db_session.refresh(deepest)
+    assert deepest.path == f"{root.id}/{first.id}/{nested.id}/{deepest.id}/"
+    assert deepest.depth == 3
+
+
+def test_summaries_are_maintained(db_session, thread):
+    root, first, second, third, nested, deepest = thread
+    other = comment(db_session, object_id="invoice-2", text="latest")
+    objects = [comments_schemas.CommentedObject(model_type="invoice", rel_id=rel_id)
+               for rel_id in ["invoice-2", "invoice-1", "invoice-3"]]
+
+    statements = []
+    listen = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(db_session.get_bind(), "before_cursor_execute", listen)
+    summaries = comments.db_retrieve_comment_summaries(objects, db=db_session)
+    event.remove(db_session.get_bind(), "before_cursor_execute", listen)
+
+    assert len(statements) == 1
+    assert [(s.rel_id, s.comments, s.threads) for s in summaries] == [
+        ("invoice-2", 1, 1), ("invoice-1", 6, 1), ("invoice-3", 0, 0)]
+    assert summaries[0].latest_comment.id == other.id
+    assert summaries[1].latest_comment.id == deepest.id
+    assert summaries[2].latest_comment is None
+
+    comments.db_delete_comment(object_id=nested.id, model_type="invoice", db=db_session)
+    summary = comments.db_retrieve_comment_summaries(objects[1:2], db=db_session)[0]
+    assert summary.comments == 4
+    assert summary.latest_comment.text == "reply 2"
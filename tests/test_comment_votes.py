@@ -0,0 +1,72 @@
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session, sessionmaker
+
+from bigfastapi import comments
+from bigfastapi.db import database
+from bigfastapi.models import comments_models
+
+TABLES = [comments_models.Comment.__table__, comments_models.CommentVote.__table__]
+
+
+@pytest.fixture(scope="function")
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/votes.db", connect_args={"timeout": 30})
+    database.Base.metadata.create_all(engine, tables=TABLES)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def comment_id(engine):
+    with Session(bind=engine) as db:
+        comment = comments_models.Comment(id=uuid4().hex, model_type="invoice", rel_id="1", text="hello",
+                                           path="root/", depth=0)
+        db.add(comment)
+        db.commit()
+        return comment.id
+
+
+def vote(db, comment_id, action, user_id):
+    return comments.db_vote_for_comments(
+        comment_id=comment_id, model_type="invoice", action=action, user_id=user_id, db=db)
+
+
+def test_a_user_votes_once_and_can_switch(engine, comment_id):
+    with Session(bind=engine) as db:
+        vote(db, comment_id, "upvote", "u1")
+        again = vote(db, comment_id, "upvote", "u1")
+        assert (again.upvotes, again.downvotes) == (1, 0)
+
+        switched = vote(db, comment_id, "downvote", "u1")
+        assert (switched.upvotes, switched.downvotes) == (0, 1)
+        assert db.query(comments_models.CommentVote).count() == 1
+
+
+def test_unknown_comment_is_not_found(engine):
+    with Session(bind=engine) as db:
+        with pytest.raises(comments._fastapi.HTTPException):
+            vote(db, "missing", "upvote", "u1")
+        assert db.query(comments_models.CommentVote).count() == 0
+
+
+def test_concurrent_votes_are_not_lost(engine, comment_id):
+    voters, threads = 200, 8
+    make_session = sessionmaker(bind=engine)
+
+    def cast(user_id):
+        with make_session() as db:
+            vote(db, comment_id, "upvote", user_id)
+            # a retried request from the same user must not count twice
+            vote(db, comment_id, "upvote", user_id)
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(cast, [f"user{i}" for i in range(voters)]))
+
+    with Session(bind=engine) as db:
+        comment = db.get(comments_models.Comment, comment_id)
+        assert comment.upvotes == voters
+        assert db.query(comments_models.CommentVote).count() == voters
@@ -0,0 +1,169 @@
+import pydantic
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from bigfastapi.db import database
+from bigfastapi.models import data_import_models, faq_models
+from bigfastapi.services import data_import_services
+
+TABLES = [faq_models.Faq.__table__, data_import_models.FileImports.__table__,
+          data_import_models.FailedFileImports.__table__, data_import_models.FileImportChunks.__table__,
+          data_import_models.ImportKeys.__table__]
+
+
+class FaqRow(pydantic.BaseModel):
+    question: pydantic.constr(min_length=1)
+    answer: str
+
+
+@pytest.fixture(scope="function")
+def db_session(tmp_path):
+    # parallel imports reach the database from other processes, it has to live in a file
+    engine = create_engine(f"sqlite:///{tmp_path}/imports.db", connect_args={"timeout": 30})
+    database.Base.metadata.create_all(engine, tables=TABLES)
+    session = Session(bind=engine)
+    yield session
+    session.close()
+
+
+@pytest.fixture
+def csv_file(tmp_path):
+    lines = ["question,answer"]
+    for i in range(1, 26):
+        if i % 10 == 0:
+            lines.append(f",missing question {i}")
+        else:
+            lines.append(f'"question {i}","answer, with a comma {i}"')
+    lines.insert(4, '"multi\nline question","answer"')
+    lines.insert(6, "too,many,columns")
+    path = tmp_path / "faqs.csv"
+    path.write_bytes("\r\n".join(lines).encode() + b"\r\n")
+    return str(path)
+
+
+def start_import(db):
+    return data_import_services.create_import_start_point(
+        "u1", "faqs.csv", 0, 0, "faq", "org", db)
+
+
+def converter():
+    return data_import_services.schema_converter(FaqRow, id=data_import_services.new_id, created_by="u1")
+
+
+def failures(db):
+    return sorted((row.line, row.error) for row in db.query(data_import_models.FailedFileImports))
+
+
+def test_import_streams_in_chunks(db_session, csv_file):
+    file_import = start_import(db_session)
+
+    data_import_services.import_csv(file_import.id, csv_file, faq_models.Faq, converter(),
+                                    db=db_session, chunk_size=4)
+
+    assert db_session.query(faq_models.Faq).count() == 24
+    assert db_session.query(faq_models.Faq).filter_by(question="multi\nline question").count() == 1
+    lines = [line for line, _ in failures(db_session)]
+    assert sorted(map(int, lines)) == [8, 14, 24]
+    assert file_import.in_progress is False
+    assert file_import.total_line == "29"
+    assert file_import.current_offset == file_import.total_bytes
+
+
+def test_import_resumes_after_a_crash(db_session, csv_file, monkeypatch):
+    file_import = start_import(db_session)
+    import_chunk = data_import_services.import_chunk
+    calls = []
+
+    def crash_on_third_chunk(*args):
+        calls.append(args)
+        if len(calls) == 3:
+            raise RuntimeError("killed")
+        return import_chunk(*args)
+
+    monkeypatch.setattr(data_import_services, "import_chunk", crash_on_third_chunk)
+    with pytest.raises(RuntimeError):
+        data_import_services.import_csv(file_import.id, csv_file, faq_models.Faq, converter(),
+                                        db=db_session, chunk_size=4)
+    assert db_session.query(faq_models.Faq).count() == 7
+    assert file_import.in_progress is True
+
+    monkeypatch.setattr(data_import_services, "import_chunk", import_chunk)
+    data_import_services.import_csv(file_import.id, csv_file, faq_models.Faq, converter(),
+                                    db=db_session, chunk_size=4)
+
+    assert db_session.query(faq_models.Faq).count() == 24
+    assert len(failures(db_session)) == 3
+
+
+def test_conflicting_rows_are_logged(db_session, csv_file):
+    file_import = start_import(db_session)
+    # every row gets the same id, only the first one of the file can be inserted
+    convert = data_import_services.schema_converter(FaqRow, id="same")
+
+    data_import_services.import_csv(file_import.id, csv_file, faq_models.Faq, convert,
+                                    db=db_session, chunk_size=4)
+
+    assert db_session.query(faq_models.Faq).count() == 1
+    assert len(failures(db_session)) == 26
+
+
+def test_split_ranges_end_on_record_boundaries(csv_file):
+    with open(csv_file, "rb") as file:
+        header, offset, line = data_import_services.read_csv_header(file)
+        sequential = list(data_import_services.CsvRecords(file, offset=offset, line=line))
+
+        for chunk_bytes in [1, 10, 64, 10_000]:
+            ranges, last_line = data_import_services.split_csv(csv_file, offset, line, chunk_bytes)
+            records = []
+            for start, end, first_line in ranges:
+                records.extend(data_import_services.CsvRecords(file, offset=start, end=end, line=first_line))
+
+            assert records == sequential
+            assert last_line == 29
+
+
+def test_parallel_import_keeps_the_first_duplicate(db_session, csv_file, tmp_path):
+    path = tmp_path / "duplicates.csv"
+    rows = [f'"question {i % 7}","answer {i}"' for i in range(40)]
+    path.write_text("question,answer\n" + "\n".join(rows) + "\n")
+    file_import = start_import(db_session)
+
+    data_import_services.import_csv_parallel(
+        file_import.id, str(path), faq_models.Faq, converter(), unique=["question"],
+        db=db_session, workers=2, chunk_bytes=100)
+
+    progress = data_import_services.get_import_progress(file_import.id, db_session)
+    assert progress.in_progress is False
+    assert len(progress.chunks) > 2
+    assert {chunk.status for chunk in progress.chunks} == {"done"}
+    assert sum(chunk.rows for chunk in progress.chunks) == 7
+    assert progress.current_offset == progress.total_bytes
+    # the first line of every question wins, whatever range finished first
+    assert sorted(faq.answer for faq in db_session.query(faq_models.Faq)) == sorted(
+        f"answer {i}" for i in range(7))
+    assert ("9", "duplicate of line 2") in failures(db_session)
+    assert db_session.query(data_import_models.ImportKeys).count() == 0
+
+
+def test_parallel_import_resumes_failed_ranges(db_session, csv_file, monkeypatch):
+    file_import = start_import(db_session)
+    pool_map = data_import_services.pool_map
+
+    def skip_last_range(pool, work, task, chunk_ids):
+        pool_map(pool, work, task, chunk_ids[:-1])
+
+    monkeypatch.setattr(data_import_services, "pool_map", skip_last_range)
+    data_import_services.import_csv_parallel(
+        file_import.id, csv_file, faq_models.Faq, converter(), db=db_session, workers=2, chunk_bytes=200)
+    assert file_import.in_progress is True
+    imported = db_session.query(faq_models.Faq).count()
+    assert 0 < imported < 24
+
+    monkeypatch.setattr(data_import_services, "pool_map", pool_map)
+    data_import_services.import_csv_parallel(
+        file_import.id, csv_file, faq_models.Faq, converter(), db=db_session, workers=2)
+
+    assert file_import.in_progress is False
+    assert db_session.query(faq_models.Faq).count() == 24
+    assert sorted(int(line) for line, _ in failures(db_session)) == [8, 14, 24]
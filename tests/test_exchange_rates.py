@@ -0,0 +1,117 @@
+import asyncio
+
+import pytest
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import Session, sessionmaker
+
+from bigfastapi import credit
+from bigfastapi.db import database
+from bigfastapi.models import credit_wallet_models
+from bigfastapi.services import exchange_rate_services
+from bigfastapi.services.exchange_rate_services import FixtureRateProvider
+
+Conversion = credit_wallet_models.CreditWalletConversion
+
+
+class SlowProvider(FixtureRateProvider):
+    """Answers once `answer` is set"""
+
+    def __init__(self, rates):
+        super().__init__(rates)
+        self.answer = asyncio.Event()
+
+    async def fetch(self):
+        self.calls += 1
+        await self.answer.wait()
+        return dict(self.rates)
+
+
+@pytest.fixture(scope="function")
+def db_session():
+    engine = create_engine("sqlite:///:memory:")
+    database.Base.metadata.create_all(engine, tables=[Conversion.__table__])
+    session = Session(bind=engine)
+    session.add(Conversion(id="usd", currency_code="USD", rate=2, source="manual"))
+    session.commit()
+    provider = exchange_rate_services.exchange_rates.provider
+    yield session
+    exchange_rate_services.exchange_rates.use(provider)
+    session.close()
+
+
+def rates(db):
+    return sorted((row.currency_code, row.rate, row.source) for row in db.query(Conversion))
+
+
+def test_refresh_upserts_one_rate_per_currency(db_session):
+    db_session.add(Conversion(id="eur", currency_code="EUR", rate=9, source="manual"))
+    # rates fetched before rates had a source
+    db_session.execute(insert(Conversion.__table__), [
+        dict(id="ngn-1", currency_code="NGN", rate=800, source=None),
+        dict(id="ngn-2", currency_code="NGN", rate=810, source=None)])
+    db_session.commit()
+    provider = FixtureRateProvider({"NGN": 400, "EUR": 0.9, "GHS": 6})
+    exchange_rate_services.exchange_rates.use(provider)
+
+    asyncio.run(exchange_rate_services.exchange_rates.refresh(db=db_session))
+    provider.rates["GHS"] = 7
+    asyncio.run(exchange_rate_services.exchange_rates.refresh(db=db_session))
+
+    assert provider.calls == 2
+    assert rates(db_session) == [("EUR", 9, "manual"), ("GHS", 14, "market"), ("NGN", 800, "market"),
+                                 ("USD", 2, "manual")]
+
+
+def test_concurrent_refreshes_share_one_call(db_session):
+    provider = SlowProvider({"NGN": 400})
+    exchange_rate_services.exchange_rates.use(provider)
+
+    async def refresh_together():
+        refreshes = [asyncio.ensure_future(exchange_rate_services.exchange_rates.refresh(db=db_session))
+                     for _ in range(10)]
+        await asyncio.sleep(0)
+        provider.answer.set()
+        return await asyncio.gather(*refreshes)
+
+    results = asyncio.run(refresh_together())
+
+    assert provider.calls == 1
+    assert all(result["NGN"] == 400 for result in results)
+
+
+def test_reading_a_rate_never_waits_on_the_provider(db_session):
+    provider = SlowProvider({"NGN": 400})
+    exchange_rate_services.exchange_rates.use(provider)
+
+    async def read_then_answer():
+        before = exchange_rate_services.credit_rate("ngn", db_session)
+        provider.answer.set()
+        # the background refresh started by the read completes
+        for _ in range(10):
+            await asyncio.sleep(0)
+        return before, exchange_rate_services.credit_rate("ngn", db_session)
+
+    before, after = asyncio.run(read_then_answer())
+
+    assert before is None
+    assert provider.calls == 1
+    assert (after.currency_code, after.rate) == ("NGN", 800)
+
+
+def test_credit_router_refreshes_rates_on_startup(db_session, monkeypatch):
+    monkeypatch.setattr(exchange_rate_services, "SessionLocal", sessionmaker(bind=db_session.get_bind()))
+    provider = FixtureRateProvider({"NGN": 400})
+    exchange_rate_services.exchange_rates.use(provider)
+
+    async def run_scheduler():
+        await credit.start_exchange_rates()
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if ("NGN", 800, "market") in rates(db_session):
+                break
+        await credit.stop_exchange_rates()
+
+    asyncio.run(run_scheduler())
+
+    assert provider.calls == 1
+    assert ("NGN", 800, "market") in rates(db_session)
@@ -0,0 +1,127 @@
+import csv
+import json
+import zipfile
+from datetime import datetime
+from uuid import uuid4
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from bigfastapi.db import database
+from bigfastapi.models import data_import_models, file_models, receipt_models
+from bigfastapi.services import export_services
+
+
+@pytest.fixture(scope="function")
+def db_session(tmp_path, monkeypatch):
+    monkeypatch.setattr(export_services.settings, "FILES_BASE_FOLDER", str(tmp_path))
+    engine = create_engine("sqlite:///:memory:")
+    database.Base.metadata.create_all(engine, tables=[
+        file_models.File.__table__, receipt_models.Receipt.__table__, data_import_models.FileExports.__table__])
+    session = Session(bind=engine)
+    yield session
+    session.close()
+
+
+@pytest.fixture
+def receipts(db_session):
+    rows = [receipt_models.Receipt(id=f"{i:04d}{uuid4().hex}", organization_id="org", sender_email="a@example.com",
+                                   recipient="b@example.com", subject=f"receipt {i}", message="thanks, \"friend\"\n",
+                                   is_deleted=False, date_created=datetime(2026, 1, 1))
+            for i in range(25)]
+    rows.append(receipt_models.Receipt(id=uuid4().hex, organization_id="other", subject="other", is_deleted=False))
+    rows.append(receipt_models.Receipt(id=uuid4().hex, organization_id="org", subject="deleted", is_deleted=True))
+    db_session.add_all(rows)
+    db_session.commit()
+    return rows[:25]
+
+
+def exported_path(db, export):
+    file = db.get(file_models.File, export.file_id)
+    return export_services.export_file_path(file.filename)
+
+
+def test_csv_export_is_written_in_chunks(db_session, receipts):
+    export = export_services.create_export("org", "u1", "receipts", "csv", db=db_session)
+
+    export_services.run_export(export.id, db=db_session, chunk_size=10)
+
+    with open(exported_path(db_session, export), newline="") as file:
+        rows = list(csv.DictReader(file))
+    assert [row["subject"] for row in rows] == [f"receipt {i}" for i in range(25)]
+    assert rows[0]["message"] == "thanks, \"friend\"\n"
+    progress = export_services.get_export_progress(export.id, db_session)
+    assert (progress.current_line, progress.totat_count, progress.in_progress) == ("25", "25", False)
+
+
+def test_interrupted_export_resumes_after_last_id(db_session, receipts, monkeypatch):
+    export = export_services.create_export("org", "u1", "receipts", "ndjson", db=db_session)
+    commit = db_session.commit
+    commits = []
+
+    def crash_after_two_chunks():
+        commits.append(1)
+        if len(commits) == 5:
+            raise RuntimeError("killed")
+        commit()
+
+    monkeypatch.setattr(db_session, "commit", crash_after_two_chunks)
+    with pytest.raises(RuntimeError):
+        export_services.run_export(export.id, db=db_session, chunk_size=10)
+    monkeypatch.setattr(db_session, "commit", commit)
+    db_session.rollback()
+    assert export.last_id == receipts[19].id
+    assert export.file_id is None
+
+    # the crashed worker still holds the export until its lease runs out
+    with pytest.raises(export_services.fastapi.HTTPException):
+        export_services.run_export(export.id, db=db_session, chunk_size=10)
+    monkeypatch.setattr(export_services.settings, "EXPORT_LEASE", 0)
+    export_services.run_export(export.id, db=db_session, chunk_size=10)
+
+    with open(exported_path(db_session, export)) as file:
+        rows = [json.loads(line) for line in file]
+    assert [row["id"] for row in rows] == [receipt.id for receipt in receipts]
+
+
+def test_xlsx_export(db_session, receipts, monkeypatch):
+    monkeypatch.setattr(export_services, "XLSX_MAX_ROWS", 10)
+    export = export_services.create_export("org", "u1", "receipts", "xlsx", db=db_session)
+
+    export_services.run_export(export.id, db=db_session, chunk_size=7)
+
+    with zipfile.ZipFile(exported_path(db_session, export)) as workbook:
+        sheets = sorted(name for name in workbook.namelist() if name.startswith("xl/worksheets/"))
+        assert sheets == ["xl/worksheets/sheet1.xml", "xl/worksheets/sheet2.xml", "xl/worksheets/sheet3.xml"]
+        last = workbook.read("xl/worksheets/sheet3.xml").decode()
+        assert last.count("<row>") == 6
+        assert "receipt 24" in last
+        assert "sheet3.xml" in workbook.read("[Content_Types].xml").decode()
+
+
+def test_xlsx_export_interrupted_before_it_is_registered(db_session, receipts, monkeypatch):
+    monkeypatch.setattr(export_services.settings, "EXPORT_LEASE", 0)
+    export = export_services.create_export("org", "u1", "receipts", "xlsx", db=db_session)
+
+    def killed(file_name, path, db):
+        raise RuntimeError("killed")
+
+    register_file = export_services.register_file
+    monkeypatch.setattr(export_services, "register_file", killed)
+    with pytest.raises(RuntimeError):
+        export_services.run_export(export.id, db=db_session, chunk_size=10)
+    db_session.rollback()
+    monkeypatch.setattr(export_services, "register_file", register_file)
+
+    export_services.run_export(export.id, db=db_session, chunk_size=10)
+
+    path = exported_path(db_session, export)
+    with zipfile.ZipFile(path) as workbook:
+        assert workbook.read("xl/worksheets/sheet1.xml").decode().count("<row>") == 26
+    assert not export_services.os.path.exists(f"{path}.ndjson")
+
+
+def test_unknown_report_is_rejected(db_session):
+    with pytest.raises(export_services.fastapi.HTTPException):
+        export_services.create_export("org", "u1", "everything", db=db_session)
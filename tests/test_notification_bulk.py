@@ -0,0 +1,108 @@
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+
+from bigfastapi.db import database
+from bigfastapi.models import notification_models, organization_models, user_models
+from bigfastapi.services import notification_services
+
+TABLES = [
+    user_models.User.__table__,
+    organization_models.Organization.__table__,
+    organization_models.OrganizationUser.__table__,
+    notification_models.Notification.__table__,
+    notification_models.NotificationRecipient.__table__,
+    notification_models.NotificationUnreadCount.__table__,
+    notification_models.NotificationSetting.__table__,
+]
+
+
+@pytest.fixture(scope="function")
+def db_session():
+    engine = create_engine("sqlite:///:memory:")
+    database.Base.metadata.create_all(engine, tables=TABLES)
+    session = Session(bind=engine)
+    yield session
+    session.close()
+
+
+def seed_organization(db, owner_id, member_id):
+    organization_id = uuid4().hex
+    db.add(organization_models.Organization(id=organization_id, user_id=owner_id, name="test"))
+    db.add(organization_models.OrganizationUser(
+        id=uuid4().hex, organization_id=organization_id, user_id=member_id, is_deleted=False))
+    db.commit()
+    return organization_id
+
+
+def notify(db, organization_id, creator_id, count=1):
+    return [
+        notification_services.create_notification({
+            "creator_id": creator_id, "message": "a new sale was recorded", "organization_id": organization_id,
+            "access_level": "admin", "module": "sales", "mentions": None,
+        }, user=None, db=db)
+        for _ in range(count)
+    ]
+
+
+def inbox(db, user_id):
+    return db.query(notification_models.NotificationRecipient).filter_by(recipient_id=user_id)
+
+
+@pytest.fixture
+def two_organizations(db_session):
+    owner_id, member_id = uuid4().hex, uuid4().hex
+    first = seed_organization(db_session, owner_id, member_id)
+    second = seed_organization(db_session, owner_id, member_id)
+    notify(db_session, first, owner_id, count=3)
+    notify(db_session, second, owner_id, count=2)
+    return owner_id, member_id, first, second
+
+
+def test_mark_all_read_is_scoped_to_the_user(db_session, two_organizations):
+    owner_id, member_id, first, second = two_organizations
+
+    statements = []
+    listen = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(db_session.get_bind(), "before_cursor_execute", listen)
+    affected = notification_services.bulk_mark_notifications(member_id, db_session, is_read=True)
+    event.remove(db_session.get_bind(), "before_cursor_execute", listen)
+
+    assert affected == 5
+    # the counter update and the recipient update, whatever the inbox size
+    assert len([s for s in statements if s.startswith("UPDATE")]) == 2
+    assert all(row.is_read for row in inbox(db_session, member_id))
+    assert not any(row.is_read for row in inbox(db_session, owner_id))
+    assert notification_services.get_unread_count(member_id, first, db_session) == 0
+    assert notification_services.get_unread_count(owner_id, first, db_session) == 3
+    # rows already read are not touched again
+    assert notification_services.bulk_mark_notifications(member_id, db_session, is_read=True) == 0
+
+
+def test_filters_narrow_the_update(db_session, two_organizations):
+    owner_id, member_id, first, second = two_organizations
+    first_ids = [row.notification_id for row in inbox(db_session, member_id).join(
+        notification_models.Notification).filter(notification_models.Notification.organization_id == first)]
+
+    assert notification_services.bulk_mark_notifications(
+        member_id, db_session, is_read=True, organization_id=second) == 2
+    assert notification_services.get_unread_count(member_id, first, db_session) == 3
+
+    assert notification_services.bulk_mark_notifications(
+        member_id, db_session, is_cleared=True, notification_ids=first_ids[:2]) == 2
+    assert notification_services.bulk_mark_notifications(
+        member_id, db_session, is_read=True, before=datetime.utcnow() - timedelta(days=1)) == 0
+
+
+def test_bulk_delete_keeps_other_recipients(db_session, two_organizations):
+    owner_id, member_id, first, second = two_organizations
+
+    assert notification_services.bulk_delete_notifications(member_id, db_session, organization_id=first) == 3
+
+    assert inbox(db_session, member_id).count() == 2
+    assert inbox(db_session, owner_id).count() == 5
+    assert notification_services.get_unread_count(member_id, first, db_session) == 0
+    assert notification_services.get_unread_count(member_id, second, db_session) == 2
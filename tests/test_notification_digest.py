@@ -0,0 +1,167 @@
+import asyncio
+from uuid import uuid4
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from bigfastapi.db import database
+from bigfastapi.models import notification_models, organization_models, user_models
+from bigfastapi.services import notification_services
+
+TABLES = [
+    user_models.User.__table__,
+    organization_models.Organization.__table__,
+    organization_models.OrganizationUser.__table__,
+    notification_models.Notification.__table__,
+    notification_models.NotificationRecipient.__table__,
+    notification_models.NotificationUnreadCount.__table__,
+    notification_models.NotificationSetting.__table__,
+]
+
+
+@pytest.fixture(scope="function")
+def db_session():
+    engine = create_engine("sqlite:///:memory:")
+    database.Base.metadata.create_all(engine, tables=TABLES)
+    session = Session(bind=engine)
+    yield session
+    session.close()
+
+
+def seed_organization(db, send_via="email"):
+    owner = user_models.User(id=uuid4().hex, first_name="Ada", email=f"{uuid4().hex}@example.com", password_hash="x")
+    member = user_models.User(id=uuid4().hex, first_name="Grace", email=f"{uuid4().hex}@example.com", password_hash="x")
+    organization_id = uuid4().hex
+    db.add_all([
+        owner, member,
+        organization_models.Organization(id=organization_id, user_id=owner.id, name="test"),
+        organization_models.OrganizationUser(id=uuid4().hex, organization_id=organization_id,
+                                             user_id=member.id, is_deleted=False),
+        notification_models.NotificationSetting(id=uuid4().hex, organization_id=organization_id,
+                                                access_level="admin", send_via=send_via, status=True),
+    ])
+    db.commit()
+    return organization_id, owner.id, member.id
+
+
+def notify(db, organization_id, creator_id, target="invoice-1", message="an invoice was updated"):
+    return notification_services.create_notification({
+        "creator_id": creator_id, "message": message, "organization_id": organization_id,
+        "access_level": "admin", "module": "invoices", "target": target, "mentions": None,
+    }, user=None, db=db)
+
+
+def test_burst_is_coalesced_into_one_digest_row(db_session):
+    organization_id, owner_id, member_id = seed_organization(db_session)
+
+    notifications = [notify(db_session, organization_id, owner_id, message=f"update {i}") for i in range(3)]
+    other_target = notify(db_session, organization_id, owner_id, target="invoice-2")
+
+    assert len({n.id for n in notifications}) == 1
+    digest = notifications[-1]
+    assert digest.occurrences == 3
+    assert digest.message == "update 2"
+    assert other_target.id != digest.id
+    assert db_session.query(notification_models.NotificationRecipient).filter_by(
+        notification_id=digest.id).count() == 2
+    assert notification_services.get_unread_count(member_id, organization_id, db_session) == 2
+
+
+def test_untargeted_notifications_are_not_coalesced(db_session):
+    organization_id, owner_id, member_id = seed_organization(db_session)
+
+    notifications = [notify(db_session, organization_id, owner_id, target=None, message=f"sale {i}")
+                     for i in range(2)]
+
+    assert [n.message for n in notifications] == ["sale 0", "sale 1"]
+    assert notifications[0].id != notifications[1].id
+    assert notification_services.get_unread_count(member_id, organization_id, db_session) == 2
+
+
+def test_new_occurrence_reopens_read_digest(db_session):
+    organization_id, owner_id, member_id = seed_organization(db_session)
+    digest = notify(db_session, organization_id, owner_id)
+    notification_services.bulk_mark_notifications(member_id, db_session, is_read=True)
+    assert notification_services.get_unread_count(member_id, organization_id, db_session) == 0
+
+    notify(db_session, organization_id, owner_id)
+
+    row = db_session.query(notification_models.NotificationRecipient).filter_by(
+        notification_id=digest.id, recipient_id=member_id).one()
+    assert row.is_read is False
+    assert notification_services.get_unread_count(member_id, organization_id, db_session) == 1
+    assert notification_services.get_unread_count(owner_id, organization_id, db_session) == 1
+
+
+def test_coalescing_can_be_disabled(db_session, monkeypatch):
+    monkeypatch.setattr(notification_services.settings, "NOTIFICATION_COALESCE_WINDOW", 0)
+    organization_id, owner_id, member_id = seed_organization(db_session)
+
+    first = notify(db_session, organization_id, owner_id)
+    second = notify(db_session, organization_id, owner_id)
+
+    assert first.id != second.id
+
+
+def test_digest_sends_one_email_per_user(db_session, monkeypatch):
+    emailed = []
+
+    async def send(rows):
+        emailed.append((rows[0].email, [row.message for row in rows]))
+
+    monkeypatch.setattr(notification_services, "send_digest_email", send)
+    organization_id, owner_id, member_id = seed_organization(db_session)
+    quiet_organization, _, _ = seed_organization(db_session, send_via="in_app")
+    notify(db_session, organization_id, owner_id, target="invoice-1")
+    notify(db_session, organization_id, owner_id, target="invoice-2")
+    notify(db_session, quiet_organization, owner_id)
+
+    assert asyncio.run(notification_services.send_notification_digests(db_session)) == 2
+    assert all(len(messages) == 2 for _, messages in emailed)
+    # everything pending was digested, a second run has nothing to send
+    assert asyncio.run(notification_services.send_notification_digests(db_session)) == 0
+
+
+def test_concurrent_digest_runs_email_once(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path}/notifications.db")
+    database.Base.metadata.create_all(engine, tables=TABLES)
+    emailed = []
+
+    async def send(rows):
+        await asyncio.sleep(0)
+        emailed.append(rows[0].email)
+
+    monkeypatch.setattr(notification_services, "send_digest_email", send)
+    db = Session(bind=engine)
+    organization_id, owner_id, _ = seed_organization(db)
+    notify(db, organization_id, owner_id)
+
+    async def workers():
+        sessions = [Session(bind=engine) for _ in range(3)]
+        sent = await asyncio.gather(*[notification_services.send_notification_digests(s) for s in sessions])
+        for session in sessions:
+            session.close()
+        return sent
+
+    assert sum(asyncio.run(workers())) == 2
+    assert len(emailed) == 2
+    db.close()
+
+
+def test_failed_digests_are_sent_on_the_next_run(db_session, monkeypatch):
+    failures = [ConnectionError("smtp down")]
+    emailed = []
+
+    async def send(rows):
+        if failures:
+            raise failures.pop()
+        emailed.append(rows[0].email)
+
+    monkeypatch.setattr(notification_services, "send_digest_email", send)
+    organization_id, owner_id, _ = seed_organization(db_session)
+    notify(db_session, organization_id, owner_id)
+
+    assert asyncio.run(notification_services.send_notification_digests(db_session)) == 1
+    assert asyncio.run(notification_services.send_notification_digests(db_session)) == 1
+    assert len(emailed) == 2
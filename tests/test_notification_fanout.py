@@ -0,0 +1,148 @@
+from uuid import uuid4
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+
+from bigfastapi.db import database
+from bigfastapi.models import notification_models, organization_models, user_models
+from bigfastapi.services import notification_services
+
+TABLES = [
+    user_models.User.__table__,
+    organization_models.Organization.__table__,
+    organization_models.OrganizationUser.__table__,
+    notification_models.Notification.__table__,
+    notification_models.NotificationRecipient.__table__,
+    notification_models.NotificationUnreadCount.__table__,
+    notification_models.NotificationSetting.__table__,
+]
+
+
+@pytest.fixture(scope="function")
+def db_session():
+    engine = create_engine("sqlite:///:memory:")
+    database.Base.metadata.create_all(engine, tables=TABLES)
+    session = Session(bind=engine)
+    yield session
+    session.close()
+
+
+def seed_organization(db, members: int):
+    owner_id = uuid4().hex
+    organization_id = uuid4().hex
+    db.add(organization_models.Organization(id=organization_id, user_id=owner_id, name="test"))
+    member_ids = [uuid4().hex for _ in range(members - 1)]
+    # the owner is usually a member too, fan-out must not notify them twice
+    member_ids.append(owner_id)
+    db.bulk_insert_mappings(organization_models.OrganizationUser, [
+        {"id": uuid4().hex, "organization_id": organization_id, "user_id": member_id, "is_deleted": False}
+        for member_id in member_ids
+    ])
+    db.commit()
+    return organization_id, owner_id
+
+
+def notification_payload(organization_id, creator_id, mentions=None):
+    return {
+        "creator_id": creator_id,
+        "message": "a new sale was recorded",
+        "organization_id": organization_id,
+        "access_level": "admin",
+        "module": "sales",
+        "mentions": mentions,
+    }
+
+
+def test_fan_out_deduplicates_creator(db_session):
+    organization_id, owner_id = seed_organization(db_session, members=5)
+
+    notification = notification_services.create_notification(
+        notification_payload(organization_id, owner_id), user=None, db=db_session)
+
+    recipients = db_session.query(notification_models.NotificationRecipient).filter_by(
+        notification_id=notification.id).all()
+    recipient_ids = [recipient.recipient_id for recipient in recipients]
+    assert len(recipient_ids) == 5
+    assert len(set(recipient_ids)) == 5
+    assert len({recipient.id for recipient in recipients}) == 5
+    assert all(recipient.is_read is False for recipient in recipients)
+
+
+def test_fan_out_skips_removed_members(db_session):
+    organization_id, owner_id = seed_organization(db_session, members=3)
+    removed = db_session.query(organization_models.OrganizationUser).filter(
+        organization_models.OrganizationUser.user_id != owner_id).first()
+    removed.is_deleted = True
+    db_session.commit()
+
+    recipient_ids = notification_services.get_notification_recipients(
+        organization_id, "sales", None, db_session, None)
+
+    assert removed.user_id not in recipient_ids
+    assert owner_id in recipient_ids
+
+
+@pytest.mark.parametrize("members", [10, 1000])
+def test_fan_out_statements_do_not_grow_with_members(db_session, members):
+    organization_id, owner_id = seed_organization(db_session, members=members)
+    statements = []
+
+    def listen(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db_session.get_bind(), "before_cursor_execute", listen)
+    notification = notification_services.create_notification(
+        notification_payload(organization_id, owner_id), user=None, db=db_session)
+    event.remove(db_session.get_bind(), "before_cursor_execute", listen)
+
+    count = db_session.query(notification_models.NotificationRecipient).filter_by(
+        notification_id=notification.id).count()
+    assert count == members
+    # one INSERT ... SELECT fans out to every member, whatever their number
+    assert len(statements) < 10
+
+
+def seed_named_members(db, organization_id, first_names):
+    users = [
+        user_models.User(id=uuid4().hex, first_name=first_name, email=f"{first_name}@example.com", password_hash="x")
+        for first_name in first_names
+    ]
+    db.add_all(users)
+    db.bulk_insert_mappings(organization_models.OrganizationUser, [
+        {"id": uuid4().hex, "organization_id": organization_id, "user_id": user.id, "is_deleted": False}
+        for user in users
+    ])
+    db.commit()
+    return {user.first_name: user.id for user in users}
+
+
+def test_mentions_resolve_in_one_query(db_session):
+    organization_id, owner_id = seed_organization(db_session, members=1)
+    db_session.add(user_models.User(id=owner_id, first_name="Ada", email="ada@example.com", password_hash="x"))
+    members = seed_named_members(db_session, organization_id, [f"member{i}" for i in range(20)] + ["Grace"])
+
+    statements = []
+    listen = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(db_session.get_bind(), "before_cursor_execute", listen)
+    mentions = [f"member{i}" for i in range(20)] + ["ada", "Ada", "member1"]
+    recipient_ids = notification_services.get_notification_recipients(
+        organization_id, "comments", None, db_session, mentions)
+    event.remove(db_session.get_bind(), "before_cursor_execute", listen)
+
+    assert len(statements) == 1
+    # member1 also prefixes member10..member19, every id still appears once
+    assert sorted(recipient_ids) == sorted([members[f"member{i}"] for i in range(20)] + [owner_id])
+
+
+def test_comment_notification_only_reaches_mentioned(db_session):
+    organization_id, owner_id = seed_organization(db_session, members=3)
+    members = seed_named_members(db_session, organization_id, ["Grace", "Linus"])
+
+    notification = notification_services.create_notification(
+        {**notification_payload(organization_id, owner_id, mentions=["grace"]), "module": "comments"},
+        user=None, db=db_session)
+
+    recipients = db_session.query(notification_models.NotificationRecipient).filter_by(
+        notification_id=notification.id).all()
+    assert [recipient.recipient_id for recipient in recipients] == [members["Grace"]]
@@ -0,0 +1,96 @@
+import asyncio
+import json
+import threading
+from uuid import uuid4
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+
+from bigfastapi.db import database
+from bigfastapi.models import notification_models, organization_models, user_models
+from bigfastapi.notification import notification_events
+from bigfastapi.services import notification_broker, notification_services
+
+TABLES = [
+    user_models.User.__table__,
+    organization_models.Organization.__table__,
+    organization_models.OrganizationUser.__table__,
+    notification_models.Notification.__table__,
+    notification_models.NotificationRecipient.__table__,
+    notification_models.NotificationUnreadCount.__table__,
+    notification_models.NotificationSetting.__table__,
+]
+
+
+@pytest.fixture(scope="function")
+def db_session():
+    engine = create_engine(
+        "sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    database.Base.metadata.create_all(engine, tables=TABLES)
+    session = Session(bind=engine)
+    yield session
+    session.close()
+
+
+@pytest.fixture(autouse=True)
+def in_memory_broker():
+    backend = notification_broker.InMemoryPubSub()
+    previous = notification_broker.broker.backend
+    notification_broker.set_backend(backend)
+    yield backend
+    notification_broker.set_backend(previous)
+
+
+def test_in_memory_pubsub_delivers_across_threads(in_memory_broker):
+    async def scenario():
+        async with notification_broker.broker.subscribe("org") as subscription:
+            assert in_memory_broker.subscriber_count("notifications:org") == 1
+            publisher = threading.Thread(
+                target=in_memory_broker.publish, args=("notifications:org", {"notification_id": "1"}))
+            publisher.start()
+            publisher.join()
+            message = await subscription.get(timeout=1)
+        assert in_memory_broker.subscriber_count("notifications:org") == 0
+        return message
+
+    assert asyncio.run(scenario()) == {"notification_id": "1"}
+
+
+def test_stream_only_forwards_own_notifications(db_session):
+    owner_id, member_id, organization_id = uuid4().hex, uuid4().hex, uuid4().hex
+    db_session.add_all([
+        user_models.User(id=owner_id, first_name="Ada", email="ada@example.com", password_hash="x"),
+        user_models.User(id=member_id, first_name="Grace", email="grace@example.com", password_hash="x"),
+        organization_models.Organization(id=organization_id, user_id=owner_id, name="test"),
+        organization_models.OrganizationUser(id=uuid4().hex, organization_id=organization_id,
+                                             user_id=member_id, is_deleted=False),
+    ])
+    db_session.commit()
+
+    def create(mentions):
+        return notification_services.create_notification({
+            "creator_id": owner_id, "message": "hello", "organization_id": organization_id,
+            "access_level": "admin", "module": "comments", "mentions": mentions,
+        }, user=None, db=db_session)
+
+    async def scenario():
+        subscription = notification_broker.broker.subscribe(organization_id)
+        events = notification_events(subscription, user_id=member_id,
+                                     organization_id=organization_id, db=db_session)
+        received = asyncio.ensure_future(events.__anext__())
+        await asyncio.sleep(0)
+        # mentions only the owner, the member's stream must skip it
+        create(["ada"])
+        mentioned = create(["grace"])
+        event = await asyncio.wait_for(received, timeout=2)
+        await events.aclose()
+        return mentioned, event
+
+    mentioned, event = asyncio.run(scenario())
+
+    assert event.startswith(f"id: {mentioned.id}\nevent: notification\n")
+    payload = json.loads(event.split("data: ", 1)[1])
+    assert payload["Notification"]["id"] == mentioned.id
+    assert payload["is_read"] is False
@@ -0,0 +1,122 @@
+import asyncio
+from uuid import uuid4
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session, sessionmaker
+
+from bigfastapi import notification
+from bigfastapi.db import database
+from bigfastapi.models import notification_models, organization_models, user_models
+from bigfastapi.schemas import notification_schemas
+from bigfastapi.services import notification_services
+
+TABLES = [
+    user_models.User.__table__,
+    organization_models.Organization.__table__,
+    organization_models.OrganizationUser.__table__,
+    notification_models.Notification.__table__,
+    notification_models.NotificationRecipient.__table__,
+    notification_models.NotificationUnreadCount.__table__,
+    notification_models.NotificationSetting.__table__,
+]
+
+
+@pytest.fixture(scope="function")
+def db_session():
+    engine = create_engine("sqlite:///:memory:")
+    database.Base.metadata.create_all(engine, tables=TABLES)
+    session = Session(bind=engine)
+    yield session
+    session.close()
+
+
+def seed_organization(db, members: int):
+    owner_id = uuid4().hex
+    organization_id = uuid4().hex
+    member_ids = [uuid4().hex for _ in range(members - 1)]
+    db.add(organization_models.Organization(id=organization_id, user_id=owner_id, name="test"))
+    db.bulk_insert_mappings(organization_models.OrganizationUser, [
+        {"id": uuid4().hex, "organization_id": organization_id, "user_id": member_id, "is_deleted": False}
+        for member_id in member_ids
+    ])
+    db.commit()
+    return organization_id, owner_id, member_ids
+
+
+def notify(db, organization_id, creator_id):
+    return notification_services.create_notification({
+        "creator_id": creator_id, "message": "a new sale was recorded", "organization_id": organization_id,
+        "access_level": "admin", "module": "sales", "mentions": None,
+    }, user=None, db=db)
+
+
+def test_fan_out_increments_every_recipient(db_session):
+    organization_id, owner_id, member_ids = seed_organization(db_session, members=4)
+
+    notify(db_session, organization_id, owner_id)
+    notify(db_session, organization_id, owner_id)
+
+    for user_id in member_ids + [owner_id]:
+        assert notification_services.get_unread_count(user_id, organization_id, db_session) == 2
+    assert notification_services.get_unread_count(owner_id, uuid4().hex, db_session) == 0
+
+
+def test_mark_read_and_delete_decrement(db_session):
+    organization_id, owner_id, member_ids = seed_organization(db_session, members=3)
+    first = notify(db_session, organization_id, owner_id)
+    second = notify(db_session, organization_id, owner_id)
+    reader = member_ids[0]
+
+    status = notification_schemas.NotificationStatus(is_read=True, is_cleared=False)
+    asyncio.run(notification.mark_notification_read(status, first.id, reader, db=db_session))
+    # marking the same notification read again must not count twice
+    asyncio.run(notification.mark_notification_read(status, first.id, reader, db=db_session))
+    assert notification_services.get_unread_count(reader, organization_id, db_session) == 1
+    assert notification_services.get_unread_count(owner_id, organization_id, db_session) == 2
+
+    notification.delete_notification(second.id, db=db_session)
+    assert notification_services.get_unread_count(reader, organization_id, db_session) == 0
+    assert notification_services.get_unread_count(owner_id, organization_id, db_session) == 1
+    assert db_session.query(notification_models.NotificationRecipient).filter_by(
+        notification_id=second.id).count() == 0
+
+
+def test_reconcile_rebuilds_drifted_counters(db_session):
+    organization_id, owner_id, member_ids = seed_organization(db_session, members=3)
+    notify(db_session, organization_id, owner_id)
+    notify(db_session, organization_id, owner_id)
+    db_session.query(notification_models.NotificationUnreadCount).update(
+        {"unread": 42}, synchronize_session=False)
+    db_session.commit()
+
+    written = notification_services.reconcile_unread_counts(db_session, organization_id=organization_id)
+
+    assert written == 3
+    for user_id in member_ids + [owner_id]:
+        assert notification_services.get_unread_count(user_id, organization_id, db_session) == 2
+
+
+def test_counters_are_reconciled_by_the_scheduler(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path}/notifications.db", connect_args={"check_same_thread": False})
+    database.Base.metadata.create_all(engine, tables=TABLES)
+    monkeypatch.setattr(notification_services, "SessionLocal", sessionmaker(bind=engine))
+    db = Session(bind=engine)
+    organization_id, owner_id, _ = seed_organization(db, members=1)
+    notify(db, organization_id, owner_id)
+    db.query(notification_models.NotificationUnreadCount).update({"unread": 42}, synchronize_session=False)
+    db.commit()
+
+    async def run_scheduler():
+        scheduler = asyncio.create_task(notification_services.unread_count_scheduler(interval=0.01))
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            db.expire_all()
+            if notification_services.get_unread_count(owner_id, organization_id, db) == 1:
+                break
+        scheduler.cancel()
+
+    asyncio.run(run_scheduler())
+
+    assert notification_services.get_unread_count(owner_id, organization_id, db) == 1
+    db.close()
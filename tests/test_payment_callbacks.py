@@ -0,0 +1,151 @@
+import asyncio
+
+import pytest
+from fastapi import BackgroundTasks
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session, sessionmaker
+
+from bigfastapi import credit
+from bigfastapi.db import database
+from bigfastapi.models import credit_wallet_models, organization_models, user_models, wallet_models  # noqa: F401
+from bigfastapi.services import exchange_rate_services, payment_services
+from bigfastapi.services.exchange_rate_services import FixtureRateProvider
+from bigfastapi.services.payment_services import Verification
+
+TABLES = [wallet_models.Wallet.__table__, wallet_models.WalletTransaction.__table__,
+          credit_wallet_models.CreditWallet.__table__, credit_wallet_models.CreditWalletHistory.__table__,
+          credit_wallet_models.CreditWalletConversion.__table__, credit_wallet_models.CreditPayment.__table__]
+
+
+class FixtureVerifier:
+    def __init__(self, *results):
+        self.results = list(results)
+        self.calls = 0
+
+    async def verify(self, payment):
+        self.calls += 1
+        await asyncio.sleep(0)
+        result = self.results[min(self.calls, len(self.results)) - 1]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+@pytest.fixture(scope="function")
+def db_session(monkeypatch):
+    engine = create_engine("sqlite:///:memory:")
+    database.Base.metadata.create_all(engine, tables=TABLES)
+    session = Session(bind=engine)
+    session.add_all([
+        wallet_models.Wallet(id="wallet", organization_id="org", currency_code="NGN", balance=0),
+        wallet_models.WalletTransaction(id="tx", wallet_id="wallet", currency_code="NGN", amount=1000,
+                                        status=False, transaction_ref="user-org-1"),
+        credit_wallet_models.CreditWalletConversion(id="ngn", currency_code="NGN", rate=10, source="manual"),
+    ])
+    payment_services.create_payment("tx", "flutterwave", "org", "https://app.example.com/credits", session)
+    session.commit()
+
+    provider = exchange_rate_services.exchange_rates.provider
+    exchange_rate_services.exchange_rates.use(FixtureRateProvider({}))
+    monkeypatch.setattr(payment_services.settings, "PAYMENT_RETRY_INTERVAL", 0)
+    yield session
+    exchange_rate_services.exchange_rates.use(provider)
+    session.close()
+
+
+def use_verifier(monkeypatch, verifier):
+    monkeypatch.setitem(payment_services.VERIFIERS, "flutterwave", verifier)
+    return verifier
+
+
+def credits(db):
+    credit_wallet = db.query(credit_wallet_models.CreditWallet).filter_by(organization_id="org").first()
+    return credit_wallet.amount if credit_wallet else 0
+
+
+def test_callbacks_are_acknowledged_and_queued_once(db_session):
+    tasks = BackgroundTasks()
+
+    first = credit._record_payment_callback("flutterwave", "successful", "tx", "flw-1", tasks, db_session)
+    again = credit._record_payment_callback("flutterwave", "successful", "tx", "flw-1", tasks, db_session)
+
+    assert first.headers["location"] == "https://app.example.com/credits?status=queued&tx_ref=tx"
+    assert again.headers["location"] == first.headers["location"]
+    assert len(tasks.tasks) == 2
+    payment = payment_services.get_payment("tx", db_session)
+    assert (payment.status, payment.transaction_id) == ("queued", "flw-1")
+
+
+def test_unknown_transactions_are_not_recorded(db_session):
+    response = credit._record_payment_callback("flutterwave", "successful", "nope", "flw-1", BackgroundTasks(),
+                                               db_session)
+
+    assert "Transaction%20not%20found" in response.headers["location"]
+    assert db_session.query(credit_wallet_models.CreditPayment).count() == 1
+
+
+def test_payments_are_applied_exactly_once(db_session, monkeypatch):
+    verifier = use_verifier(monkeypatch, FixtureVerifier(Verification(True, amount=1200, currency="NGN")))
+    payment_services.record_callback("tx", "flutterwave", True, "flw-1", db_session)
+
+    async def workers():
+        return await asyncio.gather(*[payment_services.process_payment("tx", db_session) for _ in range(5)])
+
+    asyncio.run(workers())
+    payment_services.record_callback("tx", "flutterwave", True, "flw-1", db_session)
+    asyncio.run(payment_services.process_payment("tx", db_session))
+
+    payment = payment_services.get_payment("tx", db_session)
+    assert (payment.status, payment.credits, payment.attempts) == ("succeeded", 120, 1)
+    assert verifier.calls == 1
+    assert credits(db_session) == 120
+    transactions = db_session.query(wallet_models.WalletTransaction).order_by(wallet_models.WalletTransaction.sequence)
+    assert [(row.amount, row.balance_after) for row in transactions] == [(1200, 1200), (-1200, 0)]
+
+
+def test_failed_verifications_are_retried_then_given_up(db_session, monkeypatch):
+    monkeypatch.setattr(payment_services.settings, "PAYMENT_MAX_ATTEMPTS", 2)
+    use_verifier(monkeypatch, FixtureVerifier(ConnectionError("timed out")))
+    payment_services.record_callback("tx", "flutterwave", True, "flw-1", db_session)
+
+    asyncio.run(payment_services.process_payment("tx", db_session))
+    payment = payment_services.get_payment("tx", db_session)
+    assert (payment.status, payment.attempts) == ("queued", 1)
+    assert "timed out" in payment.error
+
+    assert asyncio.run(payment_services.process_due_payments(db_session)) == 1
+    assert payment_services.get_payment("tx", db_session).status == "failed"
+    assert credits(db_session) == 0
+
+
+def test_unpaid_payments_fail_without_credits(db_session, monkeypatch):
+    use_verifier(monkeypatch, FixtureVerifier(Verification(False, error="Payment was not successful")))
+    payment_services.record_callback("tx", "flutterwave", True, "flw-1", db_session)
+
+    payment = asyncio.run(payment_services.process_payment("tx", db_session))
+
+    assert (payment.status, payment.error) == ("failed", "Payment was not successful")
+    assert db_session.get(wallet_models.Wallet, "wallet").balance == 0
+
+
+def test_retries_are_picked_up_by_the_scheduler(db_session, monkeypatch):
+    monkeypatch.setattr(payment_services, "SessionLocal", sessionmaker(bind=db_session.get_bind()))
+    use_verifier(monkeypatch, FixtureVerifier(ConnectionError("timed out"),
+                                              Verification(True, amount=1200, currency="NGN")))
+    payment_services.record_callback("tx", "flutterwave", True, "flw-1", db_session)
+    asyncio.run(payment_services.process_payment("tx", db_session))
+    assert payment_services.get_payment("tx", db_session).status == "queued"
+
+    async def run_scheduler():
+        await credit.start_payment_callbacks()
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if payment_services.get_payment("tx", db_session).status != "queued":
+                break
+        await credit.stop_payment_callbacks()
+
+    asyncio.run(run_scheduler())
+
+    payment = payment_services.get_payment("tx", db_session)
+    assert (payment.status, payment.attempts) == ("succeeded", 2)
+    assert credits(db_session) == 120
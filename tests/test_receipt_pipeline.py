@@ -0,0 +1,155 @@
+import asyncio
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session, sessionmaker
+
+from bigfastapi import receipts
+from bigfastapi.db import database
+from bigfastapi.models import file_models, receipt_models
+from bigfastapi.schemas import receipt_schemas
+from bigfastapi.services import receipts_services
+
+Receipt = receipt_models.Receipt
+TABLES = [file_models.File.__table__, Receipt.__table__]
+
+
+class FakeMail:
+    def __init__(self, *failures):
+        self.failures = list(failures)
+        self.sent = []
+
+    async def send_html_email(self, title, recipients, html, attachments=None):
+        await asyncio.sleep(0)
+        if self.failures:
+            raise self.failures.pop(0)
+        self.sent.append((title, recipients, html, attachments))
+
+
+@pytest.fixture(scope="function")
+def db_session(monkeypatch):
+    engine = create_engine("sqlite:///:memory:")
+    database.Base.metadata.create_all(engine, tables=TABLES)
+    session = Session(bind=engine)
+    monkeypatch.setattr(receipts_services.settings, "RECEIPT_RETRY_INTERVAL", 0)
+    yield session
+    session.close()
+
+
+@pytest.fixture
+def pdfs(monkeypatch, tmp_path):
+    converted = []
+
+    def from_string(html, file_name):
+        converted.append(html)
+        (tmp_path / file_name).write_text(html)
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(receipts_services.settings, "FILES_BASE_FOLDER", str(tmp_path / "files"))
+    monkeypatch.setattr(receipts_services.pdfs.pdfkit, "from_string", from_string)
+    return converted
+
+
+def use_mail(monkeypatch, mail):
+    monkeypatch.setattr(receipts_services.email_services, "send_html_email", mail.send_html_email)
+    return mail
+
+
+def queue_receipt(db, tmp_path, create_file=False):
+    (tmp_path / "receipt.html").write_text("Thanks {{ name }}")
+    payload = receipt_schemas.attributes(
+        organization_id="org", sender_email="shop@example.com", subject="Your receipt",
+        template="receipt.html", custom_template_dir=str(tmp_path), data={"name": "Ada"},
+        recipients=["ada@example.com", "grace@example.com"])
+    receipt = receipts_services.create_receipt(payload, create_file=create_file, db=db)
+    db.commit()
+    return receipt.id
+
+
+def test_receipts_are_queued_then_rendered_and_sent(db_session, tmp_path, monkeypatch, pdfs):
+    mail = use_mail(monkeypatch, FakeMail())
+    receipt_id = queue_receipt(db_session, tmp_path)
+    assert (db_session.get(Receipt, receipt_id).status, mail.sent) == ("queued", [])
+
+    receipt = asyncio.run(receipts_services.process_receipt(receipt_id, db_session))
+
+    assert (receipt.status, receipt.stage, receipt.attempts, receipt.message) == ("sent", None, 1, "Thanks Ada")
+    assert mail.sent == [("Your receipt", ["ada@example.com", "grace@example.com"], "Thanks Ada", [])]
+    assert pdfs == []
+
+
+def test_receipt_files_are_attached(db_session, tmp_path, monkeypatch, pdfs):
+    mail = use_mail(monkeypatch, FakeMail())
+    receipt_id = queue_receipt(db_session, tmp_path, create_file=True)
+
+    receipt = asyncio.run(receipts_services.process_receipt(receipt_id, db_session))
+
+    file = db_session.get(file_models.File, receipt.file_id)
+    assert pdfs == ["Thanks Ada"]
+    assert mail.sent[0][3] == [str(tmp_path / "files" / "pdfs" / file.filename)]
+    assert (tmp_path / "files" / "pdfs" / file.filename).read_text() == "Thanks Ada"
+
+
+def test_receipts_are_processed_once(db_session, tmp_path, monkeypatch, pdfs):
+    mail = use_mail(monkeypatch, FakeMail())
+    receipt_id = queue_receipt(db_session, tmp_path, create_file=True)
+
+    async def workers():
+        return await asyncio.gather(*[receipts_services.process_receipt(receipt_id, db_session) for _ in range(5)])
+
+    asyncio.run(workers())
+
+    assert (len(pdfs), len(mail.sent)) == (1, 1)
+    assert db_session.get(Receipt, receipt_id).status == "sent"
+
+
+def test_failed_stages_are_retried_where_they_failed(db_session, tmp_path, monkeypatch, pdfs):
+    monkeypatch.setattr(receipts_services.settings, "RECEIPT_MAX_ATTEMPTS", 3)
+    mail = use_mail(monkeypatch, FakeMail(ConnectionError("timed out"), ConnectionError("timed out")))
+    receipt_id = queue_receipt(db_session, tmp_path, create_file=True)
+
+    receipt = asyncio.run(receipts_services.process_receipt(receipt_id, db_session))
+    assert (receipt.status, receipt.stage, receipt.attempts) == ("queued", "email", 1)
+    assert "timed out" in receipt.error
+
+    assert asyncio.run(receipts_services.process_due_receipts(db_session)) == 1
+    assert asyncio.run(receipts_services.process_due_receipts(db_session)) == 1
+    receipt = receipts_services.get_pipeline_receipt(receipt_id, db_session)
+    assert (receipt.status, receipt.attempts, receipt.error) == ("sent", 3, None)
+    assert (len(pdfs), len(mail.sent)) == (1, 1)
+
+
+def test_receipts_that_cannot_be_rendered_fail_at_once(db_session, tmp_path, monkeypatch, pdfs):
+    mail = use_mail(monkeypatch, FakeMail())
+    receipt_id = queue_receipt(db_session, tmp_path)
+    (tmp_path / "receipt.html").unlink()
+
+    receipt = asyncio.run(receipts_services.process_receipt(receipt_id, db_session))
+
+    assert (receipt.status, receipt.stage, receipt.attempts) == ("failed", "render", 1)
+    assert asyncio.run(receipts_services.process_due_receipts(db_session)) == 0
+    assert mail.sent == []
+
+
+def test_retries_are_picked_up_by_the_scheduler(db_session, tmp_path, monkeypatch, pdfs):
+    sessions = sessionmaker(bind=db_session.get_bind())
+    monkeypatch.setattr(receipts, "SessionLocal", sessions)
+    monkeypatch.setattr(receipts_services, "SessionLocal", sessions)
+    mail = use_mail(monkeypatch, FakeMail(ConnectionError("timed out")))
+    receipt_id = queue_receipt(db_session, tmp_path)
+    asyncio.run(receipts_services.process_receipt(receipt_id, db_session))
+    assert receipts_services.get_pipeline_receipt(receipt_id, db_session).status == "queued"
+
+    async def run_scheduler():
+        await receipts.start_receipts()
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if receipts_services.get_pipeline_receipt(receipt_id, db_session).status != "queued":
+                break
+        await receipts.stop_receipts()
+
+    asyncio.run(run_scheduler())
+
+    receipt = receipts_services.get_pipeline_receipt(receipt_id, db_session)
+    assert (receipt.status, receipt.attempts) == ("sent", 2)
+    assert len(mail.sent) == 1
@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session
+
+from bigfastapi.db import database
+from bigfastapi.models import file_models, receipt_models
+from bigfastapi.services import receipts_services
+
+Receipt = receipt_models.Receipt
+TABLES = [file_models.File.__table__, Receipt.__table__]
+
+
+@pytest.fixture(scope="function")
+def db_session():
+    engine = create_engine("sqlite:///:memory:")
+    database.Base.metadata.create_all(engine, tables=TABLES)
+    session = Session(bind=engine)
+    session.add_all([
+        Receipt(id="r1", organization_id="org", recipient="ada@example.com", sender_email="shop@example.com",
+                subject="Invoice 12", message="Thanks for buying the blue lamp"),
+        Receipt(id="r2", organization_id="org", recipient="grace@example.com", sender_email="shop@example.com",
+                subject="Lamp lamp lamp", message="Your lamp order shipped"),
+        Receipt(id="r3", organization_id="org", recipient="linus@example.com", sender_email="billing@example.com",
+                subject="Invoice 13", message="Thanks for the chair"),
+        Receipt(id="r4", organization_id="other", recipient="ada@example.com", sender_email="shop@example.com",
+                subject="Lamp", message="lamp"),
+        Receipt(id="r5", organization_id="org", recipient="ada@example.com", sender_email="shop@example.com",
+                subject="Lamp", message="deleted lamp", is_deleted=True),
+    ])
+    session.commit()
+    yield session
+    session.close()
+
+
+def search(db, value, cursor=None, size=50):
+    return asyncio.run(receipts_services.search_receipts("org", value, cursor=cursor, size=size, db=db))
+
+
+def test_search_matches_every_field_best_first(db_session):
+    assert [receipt.id for receipt in search(db_session, "lamp")[0]] == ["r2", "r1"]
+    assert [receipt.id for receipt in search(db_session, "billing")[0]] == ["r3"]
+    assert sorted(receipt.id for receipt in search(db_session, "invoice thanks")[0]) == ["r1", "r3"]
+    # words are matched as prefixes, addresses as a whole
+    assert [receipt.id for receipt in search(db_session, "lin")[0]] == ["r3"]
+    assert [receipt.id for receipt in search(db_session, "ada@example.com")[0]] == ["r1"]
+    assert search(db_session, 'lamp" OR "chair') == ([], 0, None)
+
+
+def test_search_pages_follow_the_cursor(db_session):
+    receipts, total, cursor = search(db_session, "example", size=2)
+    assert total == 3
+    assert cursor == receipts[-1].id
+
+    rest, total, last = search(db_session, "example", cursor=cursor, size=2)
+    assert total == 3
+    assert last is None
+    assert sorted(receipt.id for receipt in receipts + rest) == ["r1", "r2", "r3"]
+
+    with pytest.raises(HTTPException):
+        search(db_session, "example", cursor="r4")
+
+
+def test_index_follows_writes(db_session):
+    receipt = db_session.get(Receipt, "r3")
+    receipt.subject = "Refund 13"
+    db_session.delete(db_session.get(Receipt, "r1"))
+    db_session.commit()
+
+    assert [receipt.id for receipt in search(db_session, "refund")[0]] == ["r3"]
+    assert [receipt.id for receipt in search(db_session, "invoice")[0]] == []
+    assert [receipt.id for receipt in search(db_session, "lamp")[0]] == ["r2"]
+
+
+def test_index_is_added_to_existing_tables(db_session):
+    db_session.execute(text("DROP TABLE receipts_fts"))
+    for trigger in ("insert", "update", "delete"):
+        db_session.execute(text(f"DROP TRIGGER receipts_fts_{trigger}"))
+    db_session.commit()
+
+    assert receipts_services.ensure_receipt_search_index(db_session)
+    assert not receipts_services.ensure_receipt_search_index(db_session)
+    assert [receipt.id for receipt in search(db_session, "lamp")[0]] == ["r2", "r1"]
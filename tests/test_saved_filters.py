@@ -0,0 +1,107 @@
+from datetime import datetime
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import create_engine, event, update
+from sqlalchemy.orm import Session
+
+from bigfastapi.db import database
+from bigfastapi.models import file_models, filter_models, receipt_models, user_models  # noqa: F401
+from bigfastapi.schemas import filter_schemas
+from bigfastapi.services import filter_services
+
+TABLES = [file_models.File.__table__, receipt_models.Receipt.__table__, filter_models.SavedFilter.__table__]
+
+
+@pytest.fixture(scope="function")
+def db_session():
+    engine = create_engine("sqlite:///:memory:")
+    database.Base.metadata.create_all(engine, tables=TABLES)
+    session = Session(bind=engine)
+    for i in range(12):
+        session.add(receipt_models.Receipt(
+            id=f"r{i:02d}", organization_id="org" if i < 10 else "other", sender_email="shop@example.com",
+            recipient="ada@example.com" if i % 2 else "bob@example.com", subject=f"invoice {i}",
+            message="100% paid" if i == 3 else "thanks", is_deleted=i == 9, date_created=datetime(2022, 1, i + 1)))
+    session.commit()
+    filter_services.compiled_filter.cache_clear()
+    filter_services.result_counts.invalidate("receipts")
+    yield session
+    session.close()
+
+
+def save(db, filter_query, table_name="receipts"):
+    return filter_services.create_filter(filter_schemas.FilterCreate(
+        organization_id="org", table_name=table_name, name="mine", filter_query=filter_query), "user", db)
+
+
+def count_statements(db):
+    statements = []
+    event.listen(db.get_bind(), "before_cursor_execute",
+                 lambda conn, cursor, statement, *args: statements.append(statement))
+    return statements
+
+
+def test_filters_are_parsed_into_conditions():
+    assert filter_services.parse_filter('not subject = "a" or id in (1, 2) and message is not null') == (
+        "or", [("not", ("compare", "subject", "=", "a")),
+               ("and", [("in", "id", [1, 2]), ("null", "message", True)])])
+
+
+@pytest.mark.parametrize("filter_query", [
+    'subject = ', 'subject ~ "a"', '(subject = "a"', 'secret = "a"', 'date_created > "yesterday"',
+    'subject = true', 'subject = "a" subject = "b"',
+])
+def test_invalid_filters_are_rejected(db_session, filter_query):
+    with pytest.raises(HTTPException) as error:
+        save(db_session, filter_query)
+
+    assert error.value.status_code == 400
+
+
+def test_filters_match_the_rows_of_their_organization(db_session):
+    saved_filter = save(db_session, 'recipient = "ada@example.com" and date_created >= "2022-01-04"')
+
+    results = filter_services.run_filter(saved_filter, db_session, size=2)
+
+    assert results["total"] == 3
+    assert [row["id"] for row in results["items"]] == ["r03", "r05"]
+    rest = filter_services.run_filter(saved_filter, db_session, cursor=results["next_cursor"], size=2)
+    assert [row["id"] for row in rest["items"]] == ["r07"]
+    assert rest["next_cursor"] is None
+
+
+def test_contains_matches_wildcards_literally(db_session):
+    saved_filter = save(db_session, 'message contains "%"')
+
+    assert [row["id"] for row in filter_services.run_filter(saved_filter, db_session)["items"]] == ["r03"]
+
+
+def test_compiled_filters_are_reused(db_session):
+    saved_filter = save(db_session, 'subject startswith "invoice"')
+
+    filter_services.run_filter(saved_filter, db_session)
+    filter_services.run_filter(saved_filter, db_session)
+    assert filter_services.compiled_filter.cache_info().misses == 1
+    assert filter_services.compiled_filter.cache_info().hits == 1
+
+    saved_filter.filter_query = 'subject = "invoice 2"'
+    assert filter_services.run_filter(saved_filter, db_session)["total"] == 1
+
+
+def test_result_counts_are_cached_until_the_table_is_written(db_session):
+    saved_filter = save(db_session, 'recipient = "bob@example.com"')
+    assert filter_services.run_filter(saved_filter, db_session)["total"] == 5
+
+    statements = count_statements(db_session)
+    assert filter_services.run_filter(saved_filter, db_session)["total"] == 5
+    assert not [statement for statement in statements if "count(" in statement]
+
+    db_session.add(receipt_models.Receipt(id="r20", organization_id="org", recipient="bob@example.com",
+                                          is_deleted=False))
+    db_session.commit()
+    assert filter_services.run_filter(saved_filter, db_session)["total"] == 6
+
+    db_session.execute(update(receipt_models.Receipt).where(receipt_models.Receipt.id == "r00").values(is_deleted=True))
+    db_session.commit()
+    assert filter_services.run_filter(saved_filter, db_session)["total"] == 5
@@ -0,0 +1,81 @@
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from types import SimpleNamespace
+
+import pytest
+
+from bigfastapi.services import slack_services
+
+URL = "https://hooks.slack.com/services/test"
+
+
+@pytest.fixture
+def notifier():
+    notifier = slack_services.SlackNotifier(flush_interval=60, batch_size=3, max_pending=5, rate=0)
+    # keep the worker thread out of the way, tests flush explicitly
+    notifier._closed = True
+    return notifier
+
+
+def respond(notifier, monkeypatch, *statuses, retry_after="0"):
+    posts = []
+    statuses = list(statuses)
+
+    def post(url, text, verify):
+        posts.append(text)
+        status = statuses.pop(0) if statuses else 200
+        return SimpleNamespace(status_code=status, headers={"Retry-After": retry_after}, text="")
+
+    monkeypatch.setattr(notifier, "_post", post)
+    return posts
+
+
+def test_messages_are_coalesced_into_batches(notifier, monkeypatch):
+    posts = respond(notifier, monkeypatch)
+    for i in range(4):
+        notifier.notify(URL, f"login {i}")
+
+    assert notifier.flush() == 2
+    assert posts == ["login 0\nlogin 1\nlogin 2", "login 3"]
+
+
+def test_excess_messages_are_summarised(notifier, monkeypatch):
+    posts = respond(notifier, monkeypatch)
+    results = [notifier.notify(URL, f"login {i}") for i in range(8)]
+
+    assert results.count(False) == 3
+    notifier.flush()
+    assert posts[-1] == "login 3\nlogin 4\n... and 3 more messages were dropped"
+
+
+def test_rate_limited_posts_are_retried(notifier, monkeypatch):
+    posts = respond(notifier, monkeypatch, 429)
+    notifier.notify(URL, "login")
+
+    assert notifier.flush() == 0
+    assert notifier.pending(URL) == 1
+    assert notifier.flush() == 1
+    assert posts == ["login", "login"]
+
+
+def test_retry_after_reads_seconds_and_dates():
+    later = datetime.now(timezone.utc) + timedelta(seconds=120)
+
+    assert slack_services.retry_after("30", 5) == 30
+    assert 110 < slack_services.retry_after(format_datetime(later, usegmt=True), 5) <= 120
+    assert slack_services.retry_after("Wed, 21 Oct 2015 07:28:00 GMT", 5) == 0
+    assert slack_services.retry_after("soon", 5) == 5
+    assert slack_services.retry_after(None, 5) == 5
+
+
+def test_unreadable_retry_after_keeps_the_batch(notifier, monkeypatch):
+    respond(notifier, monkeypatch, 503, retry_after="soon")
+    notifier.notify(URL, "login")
+
+    assert notifier.flush() == 0
+    assert notifier.pending(URL) == 1
+
+
+def test_unset_webhook_is_ignored(notifier):
+    assert notifier.notify("", "login") is False
+    assert notifier.flush() == 0
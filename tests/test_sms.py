@@ -0,0 +1,118 @@
+import asyncio
+import datetime as dt
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session, sessionmaker
+
+from bigfastapi import sms
+from bigfastapi.db import database
+from bigfastapi.models import sms_models
+from bigfastapi.services import sms_services
+from bigfastapi.utils.rate_limiter import RateLimiter
+
+
+@pytest.fixture(scope="function")
+def db_session():
+    engine = create_engine("sqlite:///:memory:")
+    database.Base.metadata.create_all(engine, tables=[sms_models.SMS.__table__])
+    session = Session(bind=engine)
+    yield session
+    session.close()
+
+
+@pytest.fixture(autouse=True)
+def no_rate_limit(monkeypatch):
+    monkeypatch.setattr(sms_services, "rate_limiter", RateLimiter(0))
+
+
+def test_enqueue_does_not_contact_provider(db_session, monkeypatch):
+    def fail(**kwargs):
+        raise AssertionError("provider must not be called on enqueue")
+
+    monkeypatch.setattr(sms_services, "post_to_provider", fail)
+    messages = sms_services.enqueue_sms("bfa", ["1", "2", "2"], "hello", db=db_session)
+
+    assert len(messages) == 2
+    assert {m.status for m in messages} == {"queued"}
+
+
+def test_dispatch_coalesces_recipients(db_session, monkeypatch):
+    calls = []
+
+    def post(sender, recipients, content, message_type):
+        calls.append((content, list(recipients)))
+        return {"status": True}
+
+    monkeypatch.setattr(sms_services, "post_to_provider", post)
+    monkeypatch.setattr(sms_services.settings, "SMS_BATCH_SIZE", 2)
+    sms_services.enqueue_sms("bfa", ["1", "2", "3"], "hello", db=db_session)
+    sms_services.enqueue_sms("bfa", ["4"], "bye", db=db_session)
+
+    summary = sms_services.dispatch_pending_sms(db=db_session)
+
+    assert summary["sent"] == 4
+    assert sorted(calls) == [("bye", ["4"]), ("hello", ["1", "2"]), ("hello", ["3"])]
+    statuses = {m.status for m in db_session.query(sms_models.SMS)}
+    assert statuses == {"sent"}
+
+
+def test_transient_failure_is_retried_later(db_session, monkeypatch):
+    def post(**kwargs):
+        raise sms_services.TransientSMSError("timeout")
+
+    monkeypatch.setattr(sms_services, "post_to_provider", post)
+    sms_services.enqueue_sms("bfa", ["1"], "hello", db=db_session)
+
+    summary = sms_services.dispatch_pending_sms(db=db_session)
+    message = db_session.query(sms_models.SMS).one()
+
+    assert summary["retrying"] == 1
+    assert message.status == "retrying"
+    assert message.attempts == 1
+    assert message.next_attempt_at > message.date_created
+    # not due yet, so a second pass leaves it alone
+    assert sms_services.dispatch_pending_sms(db=db_session)["retrying"] == 0
+
+
+def test_permanent_failure_is_not_retried(db_session, monkeypatch):
+    def post(**kwargs):
+        raise sms_services.PermanentSMSError("invalid sender")
+
+    monkeypatch.setattr(sms_services, "post_to_provider", post)
+    sms_services.enqueue_sms("bfa", ["1"], "hello", db=db_session)
+
+    sms_services.dispatch_pending_sms(db=db_session)
+    message = db_session.query(sms_models.SMS).one()
+
+    assert message.status == "failed"
+    assert message.last_error == "invalid sender"
+
+
+def test_retries_are_dispatched_by_the_scheduler(tmp_path, monkeypatch):
+    # the dispatcher runs in a thread, so the database has to outlive a connection
+    engine = create_engine(f"sqlite:///{tmp_path}/sms.db", connect_args={"check_same_thread": False})
+    database.Base.metadata.create_all(engine, tables=[sms_models.SMS.__table__])
+    monkeypatch.setattr(sms_services, "SessionLocal", sessionmaker(bind=engine))
+    sent = []
+    monkeypatch.setattr(sms_services, "post_to_provider", lambda **kwargs: sent.append(kwargs) or {"status": True})
+
+    with Session(bind=engine) as db:
+        message = sms_services.enqueue_sms("bfa", ["1"], "hello", db=db)[0]
+        message.status, message.attempts = "retrying", 1
+        message.next_attempt_at = dt.datetime.utcnow() - dt.timedelta(seconds=1)
+        db.commit()
+
+    async def run_scheduler():
+        await sms.start_sms_dispatch()
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if sent:
+                break
+        await sms.stop_sms_dispatch()
+
+    asyncio.run(run_scheduler())
+
+    with Session(bind=engine) as db:
+        assert db.query(sms_models.SMS).one().status == "sent"
+    assert len(sent) == 1
@@ -0,0 +1,103 @@
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.orm import Session
+
+from bigfastapi.db import database
+from bigfastapi.models import virtual_table_models
+from bigfastapi.schemas import virtual_table_schemas as schemas
+from bigfastapi.services import virtual_table_services
+
+TABLES = [virtual_table_models.VirtualTable.__table__, virtual_table_models.VirtualTableColumn.__table__,
+          virtual_table_models.VirtualTableData.__table__]
+
+
+@pytest.fixture(scope="function")
+def db_session():
+    engine = create_engine("sqlite:///:memory:")
+    database.Base.metadata.create_all(engine, tables=TABLES)
+    session = Session(bind=engine)
+    yield session
+    session.close()
+
+
+@pytest.fixture
+def table(db_session):
+    table = virtual_table_services.create_virtual_table(schemas.VirtualTableCreate(
+        organization_id="org", name="books", columns=[
+            {"name": "title", "type": "str"}, {"name": "pages", "type": "int"}, {"name": "year", "type": "int"}]),
+        db_session)
+    virtual_table_services.insert_rows(table, [
+        {"title": f"book {i:02d}", "pages": i * 10, "year": None if i % 5 == 0 else 2000 + i % 3}
+        for i in range(20)
+    ], db_session)
+    return table
+
+
+def query(db, table, **options):
+    return virtual_table_services.query_rows(table, schemas.VirtualTableQuery(**options), db)
+
+
+def all_pages(db, table, **options):
+    rows, cursor = [], None
+    while True:
+        page = query(db, table, cursor=cursor, **options)
+        rows.extend(page.items)
+        cursor = page.next_cursor
+        if cursor is None:
+            return rows
+
+
+def test_columns_map_to_typed_physical_columns(db_session, table):
+    columns = virtual_table_services.table_columns(table.id, db_session)
+
+    assert {name: column.db_table_column_name for name, column in columns.items()} == {
+        "title": "str_column_1", "pages": "int_column_1", "year": "int_column_2"}
+    row = db_session.query(virtual_table_models.VirtualTableData).filter_by(str_column_1="book 03").one()
+    assert row.int_column_1 == 30
+
+
+def test_range_filters_compare_numbers(db_session, table):
+    page = query(db_session, table, filters=[{"column": "pages", "op": "gte", "value": "90"},
+                                              {"column": "pages", "op": "lt", "value": 120}],
+                 sort=[{"column": "pages"}])
+
+    assert [row.values["title"] for row in page.items] == ["book 09", "book 10", "book 11"]
+
+
+def test_keyset_pages_follow_the_sort(db_session, table):
+    rows = all_pages(db_session, table, size=3, sort=[{"column": "year", "direction": "desc"},
+                                                       {"column": "pages", "direction": "asc"}])
+
+    assert len(rows) == 20
+    years = [row.values["year"] for row in rows]
+    assert years == [2002] * 5 + [2001] * 6 + [2000] * 5 + [None] * 4
+    assert [row.values["pages"] for row in rows[:5]] == [20, 80, 110, 140, 170]
+
+    ascending = all_pages(db_session, table, size=4, sort=[{"column": "year"}])
+    assert [row.values["year"] for row in ascending][:4] == [None] * 4
+    assert len({row.id for row in ascending}) == 20
+
+
+def test_invalid_queries_are_rejected(db_session, table):
+    for filters in [[{"column": "missing", "value": 1}], [{"column": "pages", "value": "many"}],
+                    [{"column": "pages", "op": "contains", "value": 1}], [{"column": "title", "op": "like"}]]:
+        with pytest.raises(HTTPException):
+            query(db_session, table, filters=filters)
+    with pytest.raises(HTTPException):
+        virtual_table_services.insert_rows(table, [{"author": "nobody"}], db_session)
+
+
+def test_frequently_filtered_columns_get_an_index(db_session, table, monkeypatch):
+    monkeypatch.setattr(virtual_table_services.settings, "VIRTUAL_TABLE_INDEX_THRESHOLD", 3)
+    index = "ix_virtual_table_data_table_id_int_column_1"
+    indexes = lambda: {i["name"] for i in inspect(db_session.get_bind()).get_indexes("virtual_table_data")}
+
+    for _ in range(2):
+        query(db_session, table, filters=[{"column": "pages", "op": "gt", "value": 10}])
+    assert index not in indexes()
+
+    query(db_session, table, filters=[{"column": "pages", "op": "gt", "value": 10}])
+    assert index in indexes()
+    # the index belongs to the database, not to tables created from the models
+    assert index not in {i.name for i in virtual_table_models.VirtualTableData.__table__.indexes}
@@ -0,0 +1,112 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from bigfastapi.db import database
+from bigfastapi.models import credit_wallet_models, organization_models, user_models, wallet_models  # noqa: F401
+from bigfastapi.services import wallet_services
+
+TABLES = [wallet_models.Wallet.__table__, wallet_models.WalletTransaction.__table__,
+          credit_wallet_models.CreditWallet.__table__, credit_wallet_models.CreditWalletHistory.__table__]
+
+
+@pytest.fixture(scope="function")
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/ledger.db",
+                           connect_args={"check_same_thread": False, "timeout": 60})
+    database.Base.metadata.create_all(engine, tables=TABLES)
+    with Session(bind=engine) as session:
+        session.add(wallet_models.Wallet(id="wallet", organization_id="org", currency_code="USD", balance=0,
+                                         last_updated=datetime.utcnow()))
+        session.commit()
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def db_session(engine):
+    session = Session(bind=engine)
+    yield session
+    session.close()
+
+
+def ledger(db):
+    return (db.query(wallet_models.WalletTransaction)
+            .filter(wallet_models.WalletTransaction.status == True)
+            .order_by(wallet_models.WalletTransaction.sequence)
+            .all())
+
+
+def test_transactions_move_the_balance_in_sequence(db_session):
+    wallet_services.post_wallet_transaction("wallet", 100, "USD", db_session)
+    wallet_services.post_wallet_transaction("wallet", -30, "USD", db_session)
+
+    wallet = db_session.get(wallet_models.Wallet, "wallet")
+    assert (wallet.balance, wallet.version) == (70, 2)
+    assert [(row.sequence, row.amount, row.balance_after) for row in ledger(db_session)] == [
+        (1, 100, 100), (2, -30, 70)]
+
+
+def test_debits_do_not_overdraw(db_session):
+    wallet_services.post_wallet_transaction("wallet", 10, "USD", db_session)
+
+    with pytest.raises(HTTPException) as error:
+        wallet_services.post_wallet_transaction("wallet", -11, "USD", db_session)
+
+    assert error.value.status_code == 403
+    assert db_session.get(wallet_models.Wallet, "wallet").balance == 10
+    assert len(ledger(db_session)) == 1
+
+
+def test_idempotency_keys_apply_once(db_session):
+    first = wallet_services.post_wallet_transaction("wallet", 25, "USD", db_session, idempotency_key="flw-1")
+    again = wallet_services.post_wallet_transaction("wallet", 25, "USD", db_session, idempotency_key="flw-1")
+
+    assert again.id == first.id
+    assert db_session.get(wallet_models.Wallet, "wallet").balance == 25
+
+
+def test_pending_transactions_settle_once(db_session):
+    db_session.add(wallet_models.WalletTransaction(id="pending", wallet_id="wallet", amount=40, currency_code="USD",
+                                                   status=False, transaction_ref="top up"))
+    db_session.commit()
+
+    assert wallet_services.settle_wallet_transaction("pending", db_session, amount=50) is not None
+    assert wallet_services.settle_wallet_transaction("pending", db_session, amount=50) is None
+
+    assert db_session.get(wallet_models.Wallet, "wallet").balance == 50
+    assert [(row.id, row.balance_after) for row in ledger(db_session)] == [("pending", 50)]
+
+
+def test_credits_are_added_with_their_history(db_session):
+    wallet_services.add_credits("org", 5, "5 credits Top Up", db_session)
+    credit_wallet = wallet_services.add_credits("org", 3, "3 credits Top Up", db_session)
+
+    assert credit_wallet.amount == 8
+    assert db_session.query(credit_wallet_models.CreditWalletHistory).count() == 2
+
+
+def test_concurrent_payments_lose_no_updates(engine):
+    def pay(worker):
+        with Session(bind=engine) as session:
+            for payment in range(25):
+                wallet_services.post_wallet_transaction("wallet", 1, "USD", session)
+                # every payment callback is delivered twice
+                for _ in range(2):
+                    wallet_services.post_wallet_transaction("wallet", 2, "USD", session,
+                                                            idempotency_key=f"callback-{payment}")
+
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        list(pool.map(pay, range(16)))
+
+    with Session(bind=engine) as session:
+        wallet = session.get(wallet_models.Wallet, "wallet")
+        rows = ledger(session)
+    assert wallet.balance == 16 * 25 + 25 * 2
+    assert wallet.version == len(rows) == 16 * 25 + 25
+    assert [row.sequence for row in rows] == list(range(1, len(rows) + 1))
+    assert rows[-1].balance_after == wallet.balance
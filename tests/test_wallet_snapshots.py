@@ -0,0 +1,105 @@
+from datetime import date, datetime
+
+import pytest
+from sqlalchemy import create_engine, event, update
+from sqlalchemy.orm import Session
+
+from bigfastapi.db import database
+from bigfastapi.models import organization_models, user_models, wallet_models  # noqa: F401
+from bigfastapi.services import wallet_services
+
+TABLES = [wallet_models.Wallet.__table__, wallet_models.WalletTransaction.__table__,
+          wallet_models.WalletBalanceSnapshot.__table__]
+
+# (day, amount) posted in this order
+PAYMENTS = [(1, 100), (1, -20), (2, 50), (4, -30), (4, 10), (5, 5)]
+
+
+def post(db, day, amount):
+    transaction = wallet_services.post_wallet_transaction("wallet", amount, "USD", db)
+    db.execute(update(wallet_models.WalletTransaction)
+               .where(wallet_models.WalletTransaction.id == transaction.id)
+               .values(transaction_date=datetime(2022, 3, day, 12, transaction.sequence)))
+    db.commit()
+
+
+@pytest.fixture(scope="function")
+def db_session():
+    engine = create_engine("sqlite:///:memory:")
+    database.Base.metadata.create_all(engine, tables=TABLES)
+    session = Session(bind=engine)
+    session.add(wallet_models.Wallet(id="wallet", organization_id="org", currency_code="USD", balance=0))
+    session.commit()
+    for day, amount in PAYMENTS:
+        post(session, day, amount)
+    yield session
+    session.close()
+
+
+def snapshots(db):
+    return [(row.day.day, row.balance, row.credits, row.debits, row.transactions)
+            for row in db.query(wallet_models.WalletBalanceSnapshot).order_by(wallet_models.WalletBalanceSnapshot.day)]
+
+
+def test_finished_days_are_checkpointed_once(db_session):
+    assert wallet_services.snapshot_wallet_balances(db_session, until=date(2022, 3, 5)) == 3
+    assert snapshots(db_session) == [(1, 80, 100, 20, 2), (2, 130, 50, 0, 1), (4, 110, 10, 30, 2)]
+
+    assert wallet_services.snapshot_wallet_balances(db_session, until=date(2022, 3, 5)) == 0
+    assert wallet_services.snapshot_wallet_balances(db_session, until=date(2022, 3, 6)) == 1
+    assert snapshots(db_session)[-1] == (5, 115, 5, 0, 1)
+
+
+def test_late_transactions_are_merged_into_their_checkpoint(db_session):
+    wallet_services.snapshot_wallet_balances(db_session, until=date(2022, 3, 6))
+    # committed after day 5 was checkpointed, but dated on it
+    transaction = wallet_services.post_wallet_transaction("wallet", 7, "USD", db_session)
+    db_session.execute(update(wallet_models.WalletTransaction)
+                       .where(wallet_models.WalletTransaction.id == transaction.id)
+                       .values(transaction_date=datetime(2022, 3, 5, 23, 59, 59)))
+    db_session.commit()
+
+    assert wallet_services.snapshot_wallet_balances(db_session, until=date(2022, 3, 6)) == 1
+    assert snapshots(db_session)[-2:] == [(4, 110, 10, 30, 2), (5, 122, 12, 0, 2)]
+    assert wallet_services.snapshot_wallet_balances(db_session, until=date(2022, 3, 6)) == 0
+    assert wallet_services.balance_at("wallet", datetime(2022, 3, 6), db_session) == 122
+
+
+def test_balance_at_reads_a_checkpoint_and_one_day(db_session):
+    wallet_services.snapshot_wallet_balances(db_session, until=date(2022, 3, 5))
+    statements = []
+    event.listen(db_session.get_bind(), "before_cursor_execute",
+                 lambda conn, cursor, statement, *args: statements.append(statement))
+
+    assert wallet_services.balance_at("wallet", datetime(2022, 3, 4, 12, 4), db_session) == 100
+    assert wallet_services.balance_at("wallet", datetime(2022, 3, 3), db_session) == 130
+    assert wallet_services.balance_at("wallet", datetime(2022, 3, 6), db_session) == 115
+    assert wallet_services.balance_at("wallet", datetime(2022, 2, 1), db_session) == 0
+    assert not [statement for statement in statements if "sum(" in statement]
+
+
+def test_daily_balances_fill_quiet_days(db_session):
+    wallet_services.snapshot_wallet_balances(db_session, until=date(2022, 3, 3))
+
+    statement = wallet_services.daily_balances("wallet", date(2022, 3, 2), date(2022, 3, 6), db_session)
+
+    assert statement["opening_balance"] == 80
+    assert [(row["day"].day, row["balance"], row["transactions"]) for row in statement["days"]] == [
+        (2, 130, 1), (3, 130, 0), (4, 110, 2), (5, 115, 1), (6, 115, 0)]
+
+
+def test_daily_balances_without_snapshots(db_session):
+    statement = wallet_services.daily_balances("wallet", date(2022, 3, 3), date(2022, 3, 5), db_session)
+
+    assert statement["opening_balance"] == 130
+    assert [(row["day"].day, row["balance"], row["transactions"]) for row in statement["days"]] == [
+        (3, 130, 0), (4, 110, 2), (5, 115, 1)]
+
+
+def test_opening_balance_folds_days_after_the_last_snapshot(db_session):
+    wallet_services.snapshot_wallet_balances(db_session, until=date(2022, 3, 2))
+
+    statement = wallet_services.daily_balances("wallet", date(2022, 3, 5), date(2022, 3, 6), db_session)
+
+    assert statement["opening_balance"] == 110
+    assert [(row["day"].day, row["balance"]) for row in statement["days"]] == [(5, 115), (6, 115)]